@@ -60,60 +60,84 @@ export default function ChatDetail({ route, navigation }) {
   };
 
   useEffect(() => {
-    const socketUrl = `ws://192.168.1.60:8000/ws/socket-server/${chatId}/`;
+    let socket;
+    let cancelled = false;
 
-    const socket = new WebSocket(socketUrl);
-    socketRef.current = socket;
+    const connect = async () => {
+      const token = await AsyncStorage.getItem('user_token');
+      if (cancelled) return;
+      const socketUrl = `ws://192.168.1.60:8000/ws/socket-server/${chatId}/?token=${encodeURIComponent(token || '')}`;
 
-    socket.onopen = () => {
-      socket.send(
-        JSON.stringify({
-          type: 'mark_all_as_read',
-          chat_id: chatId,
-        })
-      );
-    };
+      socket = new WebSocket(socketUrl);
+      socketRef.current = socket;
 
-    socket.onmessage = async (e) => {
-      const response = JSON.parse(e.data);
-      console.log('Received WebSocket message:', response);
-
-      if (response.type === 'new_message' && response.chat_id === chatId) {
-        const currentUserId = await getCurrentUserId();
-        if (response.message.sender.id !== currentUserId) {
-          const modifiedMessage = {
-            ...response.message,
-            isFromCurrentUser: false,
-          };
-
-          setMessages((prev) => [...prev, modifiedMessage]);
-          updateChatList(modifiedMessage);
-          markAllMessagesAsRead();
-          socketRef.current.send(
-            JSON.stringify({
-              type: 'mark_as_read',
-              chat_id: chatId,
-              message_id: modifiedMessage.id,
-            })
+      socket.onopen = () => {
+        socket.send(
+          JSON.stringify({
+            type: 'mark_all_as_read',
+            chat_id: chatId,
+          })
+        );
+      };
+
+      socket.onmessage = async (e) => {
+        const response = JSON.parse(e.data);
+        console.log('Received WebSocket message:', response);
+
+        if (response.type === 'new_message' && response.chat_id === chatId) {
+          const currentUserId = await getCurrentUserId();
+          if (response.message.sender.id !== currentUserId) {
+            const modifiedMessage = {
+              ...response.message,
+              isFromCurrentUser: false,
+            };
+
+            setMessages((prev) => [...prev, modifiedMessage]);
+            updateChatList(modifiedMessage);
+            markAllMessagesAsRead();
+            socketRef.current.send(
+              JSON.stringify({
+                type: 'mark_as_read',
+                chat_id: chatId,
+                message_id: modifiedMessage.id,
+              })
+            );
+          }
+        } else if (response.type === 'ack' && response.chat_id === chatId) {
+          const newMessage = response.message;
+          setMessages((prev) => {
+            const updated = prev.map((msg) =>
+              msg.id === response.client_id ? { ...newMessage, status: 'sent' } : msg
+            );
+            AsyncStorage.setItem(`local_messages_${chatId}`, JSON.stringify(updated));
+            return updated;
+          });
+          updateChatList(newMessage);
+        } else if (response.type === 'error' && response.client_id) {
+          setMessages((prev) =>
+            prev.map((msg) => (msg.id === response.client_id ? { ...msg, status: 'error' } : msg))
+          );
+        } else if (response.type === 'mark_as_read' && response.chat_id === chatId) {
+          setMessages((prev) =>
+            prev.map((msg) =>
+              msg.id === response.message_id ? { ...msg, is_read: true, status: 'read' } : msg
+            )
+          );
+        } else if (response.type === 'mark_all_as_read' && response.chat_id === chatId) {
+          setMessages((prev) =>
+            prev.map((msg) =>
+              msg.isFromCurrentUser ? { ...msg, is_read: true, status: 'read' } : msg
+            )
           );
         }
-      } else if (response.type === 'mark_as_read' && response.chat_id === chatId) {
-        setMessages((prev) =>
-          prev.map((msg) =>
-            msg.id === response.message_id ? { ...msg, is_read: true, status: 'read' } : msg
-          )
-        );
-      } else if (response.type === 'mark_all_as_read' && response.chat_id === chatId) {
-        setMessages((prev) =>
-          prev.map((msg) =>
-            msg.isFromCurrentUser ? { ...msg, is_read: true, status: 'read' } : msg
-          )
-        );
-      }
+      };
     };
 
+    connect();
+
     return () => {
-      socket.close();
+      cancelled = true;
+      if (socket) socket.close();
     };
   }, [chatId]);
 
@@ -270,32 +294,19 @@ export default function ChatDetail({ route, navigation }) {
         flatListRef.current.scrollToEnd({ animated: false });
       }
 
-      const response = await axios.post(
-        `http://192.168.1.60:8000/securetalk/api/social/chats/${chatId}/new_message`,
-        { content: messageToSend },
-        { headers: { Authorization: `Bearer ${token}` } }
-      );
-      if (response.data && response.data.message) {
-        const newMessage = response.data.message;
-        setMessages((prev) =>
-          prev.map((msg) => (msg.id === localMessage.id ? { ...newMessage, status: 'sent' } : msg))
-        );
-        socketRef.current.send(
-          JSON.stringify({
-            type: 'new_message',
-            chat_id: chatId,
-            message: newMessage,
-          })
-        );
-        updateChatList(newMessage);
-        if (flatListRef.current) {
-          flatListRef.current.scrollToEnd({ animated: false });
-        }
-        await AsyncStorage.setItem(
-          `local_messages_${chatId}`,
-          JSON.stringify([...messages, newMessage])
-        );
+      // The server stores the message and answers with an 'ack' carrying it (handled in onmessage).
+      const socket = socketRef.current;
+      if (!socket || socket.readyState !== WebSocket.OPEN) {
+        throw new Error('Socket is not connected');
       }
+      socket.send(
+        JSON.stringify({
+          type: 'send_message',
+          chat_id: chatId,
+          client_id: localMessage.id,
+          content: messageToSend,
+        })
+      );
     } catch (error) {
       console.error('Failed to send message:', error);
       Alert.alert('Error', 'Failed to send message. Please try again.');
@@ -16,7 +16,7 @@ const ChatDetailHeader = ({ contactName, contactImage, onBackPress }) => {
         <Image
           style={styles.avatar}
           source={
-            contactImage && contactImage.startsWith("https")
+            contactImage && contactImage.startsWith("http")
               ? { uri: contactImage }
               : defaultImage
           }
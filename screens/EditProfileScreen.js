@@ -127,7 +127,8 @@ export default function EditProfileScreen({ navigation }) {
         );
   
         if (response.data && response.data.imageUrl) {
-          setProfilePic(response.data.imageUrl);
+          // A pending picture is still being processed on the server; show the picked file meanwhile
+          setProfilePic(response.data.status === 'pending' ? imageUri : response.data.imageUrl);
           console.log(response.data.imageUrl);
         } else {
           Alert.alert('Error', 'Failed to upload image. Please try again.');
@@ -191,7 +192,7 @@ export default function EditProfileScreen({ navigation }) {
               <TouchableOpacity onPress={handlePickImage} style={styles.profilePicWrapper}>
                 <Image 
                   source={
-                    profilePic && profilePic.startsWith("https") // If it's a remote image, use uri
+                    profilePic && /^(https?|file):/.test(profilePic) // If it's a remote or picked image, use uri
                     ? { uri: profilePic }
                     : defaultImage // Fallback to default if local path is invalid
                   }
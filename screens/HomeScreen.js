@@ -7,7 +7,8 @@ import {
   StatusBar, 
   Image,
   ActivityIndicator,
-  Alert
+  Alert,
+  AppState
 } from 'react-native';
 import { 
   Text, 
@@ -40,13 +41,15 @@ export default function HomeScreen({ navigation, route }) {
   const [contactsSearchQuery, setContactsSearchQuery] = useState('');
   const [filteredContacts, setFilteredContacts] = useState([]);
   const [loadingContacts, setLoadingContacts] = useState(true);
+  const [contactsCursor, setContactsCursor] = useState(null);
+  const [hasMoreContacts, setHasMoreContacts] = useState(false);
 
   // States for messages tab
   const [messagesSearchQuery, setMessagesSearchQuery] = useState('');
   const [loadingChats, setLoadingChats] = useState(true);
 
   // Use chats from the SocketProvider for real-time updates
-  const { chats, setChats, updateChatsList } = useContext(SocketContext);
+  const { chats, setChats, updateChatsList, resyncCount, onlineUsers, seedOnlineUsers, currentUserId } = useContext(SocketContext);
 
   // Custom theme colors
   const colors = {
@@ -77,42 +80,52 @@ export default function HomeScreen({ navigation, route }) {
     loadLocalChats();
   }, [setChats]);
 
-  // Fetch contacts from API
-  useEffect(() => {
-    const fetchContacts = async () => {
-      try {
-        const token = await AsyncStorage.getItem('user_token');
-        if (!token) {
-          navigation.replace('SignIn');
-          return;
-        }
+  // Fetch contacts from API, one alphabetical page at a time
+  const fetchContacts = async (after = null) => {
+    try {
+      const token = await AsyncStorage.getItem('user_token');
+      if (!token) {
+        navigation.replace('SignIn');
+        return;
+      }
 
-        const response = await axios.get(
-          'http://192.168.1.60:8000/securetalk/api/social/contacts',
-          { headers: { Authorization: `Bearer ${token}` } }
-        );
-        
-        if (response.data.users && Array.isArray(response.data.users)) {
-          const contactsList = response.data.users;
-          // Cache profile pictures
-          await Promise.all(contactsList.map(async (contact) => {
-            if (contact.profile_picture.startsWith("https")) {
-              const imageKey = `profile_picture_${contact.id}`;
-              await AsyncStorage.setItem(imageKey, contact.profile_picture);
-            }
-          }));
-          setContacts(contactsList);
-          setFilteredContacts(contactsList);
-        }
-      } catch (error) {
-        console.error('Failed to fetch contacts', error);
-      } finally {
-        setLoadingContacts(false);
+      const response = await axios.get(
+        'http://192.168.1.60:8000/securetalk/api/social/contacts',
+        { params: after ? { after } : {}, headers: { Authorization: `Bearer ${token}` } }
+      );
+      
+      if (response.data.users && Array.isArray(response.data.users)) {
+        const contactsList = response.data.users;
+        // Cache profile pictures
+        await Promise.all(contactsList.map(async (contact) => {
+          if (contact.profile_picture.startsWith("http")) {
+            const imageKey = `profile_picture_${contact.id}`;
+            await AsyncStorage.setItem(imageKey, contact.profile_picture);
+          }
+        }));
+        seedOnlineUsers(contactsList);
+        setContacts((prev) => (after ? [...prev, ...contactsList] : contactsList));
+        setContactsCursor(response.data.after);
+        setHasMoreContacts(response.data.hasMore);
       }
-    };
+    } catch (error) {
+      console.error('Failed to fetch contacts', error);
+    } finally {
+      setLoadingContacts(false);
+    }
+  };
+
+  useEffect(() => {
     fetchContacts();
   }, [navigation]);
 
+  const loadMoreContacts = () => {
+    if (hasMoreContacts && !contactsSearchQuery.trim()) {
+      setHasMoreContacts(false);
+      fetchContacts(contactsCursor);
+    }
+  };
+
   // Function to fetch chats/messages from API
   const fetchChats = async () => {
     try {
@@ -132,6 +145,7 @@ export default function HomeScreen({ navigation, route }) {
           (a, b) => new Date(b.updatedAt) - new Date(a.updatedAt)
         );
         setChats(sortedChats);
+        seedOnlineUsers(sortedChats.flatMap((chat) => chat.users || []));
         // Store chats in AsyncStorage
         await AsyncStorage.setItem('local_chats', JSON.stringify(sortedChats));
       }
@@ -142,11 +156,61 @@ export default function HomeScreen({ navigation, route }) {
     }
   };
 
-  // Fetch chats when HomeScreen mounts
+  // Catch up with only what changed since the last sync; the server asks for a
+  // full reload the first time or after too long away.
+  const syncChats = async () => {
+    try {
+      const token = await AsyncStorage.getItem('user_token');
+      if (!token) {
+        navigation.replace('SignIn');
+        return;
+      }
+      const localChatsJson = await AsyncStorage.getItem('local_chats');
+      const cursor = localChatsJson ? await AsyncStorage.getItem('sync_cursor') : null;
+
+      const response = await axios.get(
+        'http://192.168.1.60:8000/securetalk/api/social/sync',
+        { params: cursor ? { cursor } : {}, headers: { Authorization: `Bearer ${token}` } }
+      );
+
+      if (response.data.fullResync) {
+        await fetchChats();
+      } else if (response.data.chats.length) {
+        const changed = new Map(response.data.chats.map((chat) => [chat.id, chat]));
+        const merged = [
+          ...response.data.chats,
+          ...JSON.parse(localChatsJson).filter((chat) => !changed.has(chat.id)),
+        ].sort((a, b) => new Date(b.updatedAt) - new Date(a.updatedAt));
+        setChats(merged);
+        seedOnlineUsers(response.data.chats.flatMap((chat) => chat.users || []));
+        await AsyncStorage.setItem('local_chats', JSON.stringify(merged));
+      }
+      await AsyncStorage.setItem('sync_cursor', response.data.cursor);
+    } catch (error) {
+      console.error('Failed to sync chats', error);
+    } finally {
+      setLoadingChats(false);
+    }
+  };
+
+  // Sync when HomeScreen mounts and whenever the app returns to the foreground
   useEffect(() => {
-    fetchChats();
+    syncChats();
+    const subscription = AppState.addEventListener('change', (state) => {
+      if (state === 'active') {
+        syncChats();
+      }
+    });
+    return () => subscription.remove();
   }, []);
 
+  // The socket missed more than the server could replay
+  useEffect(() => {
+    if (resyncCount > 0) {
+      syncChats();
+    }
+  }, [resyncCount]);
+
   const handleLogout = async () => {
     try {
       const token = await AsyncStorage.getItem('user_token');
@@ -164,6 +228,8 @@ export default function HomeScreen({ navigation, route }) {
       // Clear the token and local data
       await AsyncStorage.removeItem('user_token');
       await AsyncStorage.removeItem('local_chats');
+      await AsyncStorage.removeItem('sync_cursor');
+      await AsyncStorage.removeItem('socket_seq');
   
       navigation.replace('SignIn');
     } catch (error) {
@@ -184,16 +250,33 @@ export default function HomeScreen({ navigation, route }) {
     }, [navigation, route.params?.refreshChats])
   );
 
-  // Filter contacts
+  // Search contacts on the server, once typing pauses
   useEffect(() => {
-    if (contactsSearchQuery.trim() === '') {
+    const query = contactsSearchQuery.trim();
+    if (query === '') {
       setFilteredContacts(contacts);
-    } else {
-      const filtered = contacts.filter(contact => 
-        contact.fullName.toLowerCase().includes(contactsSearchQuery.toLowerCase())
-      );
-      setFilteredContacts(filtered);
+      return;
     }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const token = await AsyncStorage.getItem('user_token');
+        const response = await axios.get(
+          'http://192.168.1.60:8000/securetalk/api/social/contacts',
+          { params: { q: query }, headers: { Authorization: `Bearer ${token}` } }
+        );
+        if (!cancelled && Array.isArray(response.data.users)) {
+          seedOnlineUsers(response.data.users);
+          setFilteredContacts(response.data.users);
+        }
+      } catch (error) {
+        console.error('Failed to search contacts', error);
+      }
+    }, 250);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
   }, [contactsSearchQuery, contacts]);
 
   // Filter chats
@@ -315,14 +398,17 @@ export default function HomeScreen({ navigation, route }) {
                     style={styles.contactItem}
                     onPress={() => handleOpenContact(item.id, item.fullName)}
                   >
-                    <Avatar.Image 
-                      source={item.profile_picture.startsWith("https")
-                        ? { uri: item.profile_picture }
-                        : require('../assets/default-avatar.png')
-                      } 
-                      size={50} 
-                      style={styles.avatar}
-                    />
+                    <View style={styles.avatarContainer}>
+                      <Avatar.Image 
+                        source={item.profile_picture.startsWith("http")
+                          ? { uri: item.profile_picture }
+                          : require('../assets/default-avatar.png')
+                        } 
+                        size={50} 
+                        style={styles.avatar}
+                      />
+                      {onlineUsers[item.id] && <View style={styles.onlineDot} />}
+                    </View>
                     <View style={styles.contactInfo}>
                       <Text style={styles.contactName}>{item.fullName}</Text>
                       {item.status && (
@@ -335,6 +421,8 @@ export default function HomeScreen({ navigation, route }) {
                 )}
                 ItemSeparatorComponent={() => <Divider style={styles.divider} />}
                 contentContainerStyle={styles.listContent}
+                onEndReached={loadMoreContacts}
+                onEndReachedThreshold={0.5}
               />
             ) : (
               <View style={styles.emptyState}>
@@ -387,13 +475,16 @@ export default function HomeScreen({ navigation, route }) {
                   >
                     <View style={styles.avatarContainer}>
                       <Avatar.Image 
-                        source={item.contactImage && item.contactImage.startsWith("https") 
+                        source={item.contactImage && item.contactImage.startsWith("http") 
                           ? { uri: item.contactImage }
                           : require('../assets/default-avatar.png')
                         } 
                         size={50} 
                         style={styles.avatar}
                       />
+                      {(item.users || []).some((user) => user.id !== currentUserId && onlineUsers[user.id]) && (
+                        <View style={styles.onlineDot} />
+                      )}
                       {item.unreadCount > 0 && (
                         <Badge style={styles.unreadBadge}>{item.unreadCount}</Badge>
                       )}
@@ -580,6 +671,17 @@ const styles = StyleSheet.create({
   avatar: {
     backgroundColor: '#F3F4F6',
   },
+  onlineDot: {
+    position: 'absolute',
+    bottom: 1,
+    right: 1,
+    width: 12,
+    height: 12,
+    borderRadius: 6,
+    borderWidth: 2,
+    borderColor: '#FFFFFF',
+    backgroundColor: '#10B981',
+  },
   unreadBadge: {
     position: 'absolute',
     top: -2,
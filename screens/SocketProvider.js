@@ -12,10 +12,16 @@ export function SocketProvider({ children }) {
   const [currentUserId, setCurrentUserId] = useState(null);
 
   const [activeChatId, setActiveChatId] = useState(null);
+  // user id -> true/false, seeded from the is_online of fetched users and kept
+  // current by the server's presence events
+  const [onlineUsers, setOnlineUsers] = useState({});
+  // Bumped when the server can no longer replay what this device missed
+  const [resyncCount, setResyncCount] = useState(0);
 
   const socketRef = useRef(null);
 
   const BASE_SOCKET_URL = 'ws://192.168.1.60:8000/ws/socket-server/home/';
+  const HEARTBEAT_INTERVAL_MS = 30000;
 
   // Request permission to show notifications
   useEffect(() => {
@@ -60,42 +66,68 @@ export function SocketProvider({ children }) {
 
   // Connect to the "home" WebSocket when the provider mounts
   useEffect(() => {
-    const socket = new WebSocket(BASE_SOCKET_URL);
-    socketRef.current = socket;
-
-    socket.onopen = () => {
-      console.log('Connected to home socket');
-      setIsConnected(true);
-    };
-
-    socket.onmessage = async (e) => {
-      try {
-        const response = JSON.parse(e.data);
-        if (response.type === 'new_message' && response.chat_id) {
-          updateChatsList(response.chat_id, response.message);
-            console.log(activeChatId, response.chat_id);
-          if (activeChatId !== response.chat_id) {
-            const notificationTitle = response.message.sender.fullName;
-            const notificationBody = response.message.content;
-            sendLocalNotification(notificationTitle, notificationBody);
+    let socket;
+    let heartbeat;
+    let cancelled = false;
+
+    const connect = async () => {
+      const token = await AsyncStorage.getItem('user_token');
+      // Number of the last event received, so the server replays only what came after it
+      const lastSeq = await AsyncStorage.getItem('socket_seq');
+      if (cancelled) return;
+      const resume = lastSeq ? `&last_seq=${encodeURIComponent(lastSeq)}` : '';
+      socket = new WebSocket(`${BASE_SOCKET_URL}?token=${encodeURIComponent(token || '')}${resume}`);
+      socketRef.current = socket;
+
+      socket.onopen = () => {
+        console.log('Connected to home socket');
+        setIsConnected(true);
+        heartbeat = setInterval(() => {
+          socket.send(JSON.stringify({ type: 'heartbeat' }));
+        }, HEARTBEAT_INTERVAL_MS);
+      };
+
+      socket.onmessage = async (e) => {
+        try {
+          const response = JSON.parse(e.data);
+          if (typeof response.seq === 'number') {
+            AsyncStorage.setItem('socket_seq', String(response.seq));
+          }
+          if (response.type === 'resync_required') {
+            setResyncCount((count) => count + 1);
+          } else if (response.type === 'presence') {
+            setOnlineUsers((prev) => ({ ...prev, [response.user_id]: response.online }));
+          } else if (response.type === 'new_message' && response.chat_id) {
+            updateChatsList(response.chat_id, response.message);
+              console.log(activeChatId, response.chat_id);
+            if (activeChatId !== response.chat_id) {
+              const notificationTitle = response.message.sender.fullName;
+              const notificationBody = response.message.content;
+              sendLocalNotification(notificationTitle, notificationBody);
+            }
           }
+        } catch (error) {
+          console.error('Failed to parse socket message:', error);
         }
-      } catch (error) {
-        console.error('Failed to parse socket message:', error);
-      }
-    };
+      };
 
-    socket.onerror = (error) => {
-      console.log('WebSocket error:', error);
-    };
+      socket.onerror = (error) => {
+        console.log('WebSocket error:', error);
+      };
 
-    socket.onclose = () => {
-      console.log('Disconnected from home socket');
-      setIsConnected(false);
+      socket.onclose = () => {
+        console.log('Disconnected from home socket');
+        setIsConnected(false);
+        clearInterval(heartbeat);
+      };
     };
 
+    connect();
+
     return () => {
-      socket.close();
+      cancelled = true;
+      clearInterval(heartbeat);
+      if (socket) socket.close();
     };
   }, [activeChatId, updateChatsList]);
 
@@ -149,6 +181,14 @@ export function SocketProvider({ children }) {
     }
   }, [currentUserId]);
 
+  const seedOnlineUsers = (users) => {
+    const seen = users.filter((user) => typeof user.is_online === 'boolean');
+    setOnlineUsers((prev) => ({
+      ...prev,
+      ...Object.fromEntries(seen.map((user) => [user.id, user.is_online])),
+    }));
+  };
+
   return (
     <SocketContext.Provider
       value={{
@@ -159,6 +199,10 @@ export function SocketProvider({ children }) {
         updateChatsList,
         activeChatId,
         setActiveChatId,
+        onlineUsers,
+        seedOnlineUsers,
+        currentUserId,
+        resyncCount,
       }}
     >
       {children}
@@ -12,15 +12,20 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-import social_app.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+django_asgi_app = get_asgi_application()
+
+import social_app.routing
+from users_app.authentication import TokenAuthMiddleware
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            social_app.routing.websocket_urlpatterns
+    "http": django_asgi_app,
+    "websocket": TokenAuthMiddleware(
+        AuthMiddlewareStack(
+            URLRouter(
+                social_app.routing.websocket_urlpatterns
+            )
         )
     ),
 })
\ No newline at end of file
@@ -0,0 +1,101 @@
+import contextvars
+import functools
+from django.conf import settings
+
+# Applied to every connection of the production profile. WAL lets readers run
+# while a write commits; synchronous=NORMAL syncs at checkpoints rather than every
+# commit, which under WAL can lose the last commits on power loss but never
+# corrupts the database.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA foreign_keys=ON',
+]
+SQLITE_BUSY_TIMEOUT = 20
+SQLITE_CONN_MAX_AGE = 60
+
+REPLICA = 'replica'
+
+def sqlite_database(path, read_only=False):
+    """
+    Settings for one alias of the production SQLite profile.
+
+    Connections are reused for up to SQLITE_CONN_MAX_AGE seconds and checked before
+    reuse, which saves re-running the pragmas on every request. The age is finite,
+    as Django advises under ASGI, where the threads holding connections come and go:
+    an expired connection is closed when a request ends, or around a socket handler
+    by Channels' database_sync_to_async, instead of living as long as its thread.
+
+    A writer waits up to SQLITE_BUSY_TIMEOUT seconds for the database lock instead of
+    failing with "database is locked". Write transactions begin IMMEDIATE, so they
+    take the lock when they start and queue behind each other. A deferred
+    transaction that read first would instead fail when another writer got in
+    between. Read-only aliases use `query_only`, so a write routed to one by mistake
+    fails loudly.
+    """
+    pragmas = SQLITE_PRAGMAS + (['PRAGMA query_only=1'] if read_only else [])
+    options = {'timeout': SQLITE_BUSY_TIMEOUT, 'init_command': '; '.join(pragmas)}
+    if not read_only:
+        options['transaction_mode'] = 'IMMEDIATE'
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path,
+        'CONN_MAX_AGE': SQLITE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': options,
+        # Tests run on one in-memory database; the replica reads it through the default alias.
+        'TEST': {'MIRROR': 'default'} if read_only else {},
+    }
+
+reading_replica = contextvars.ContextVar('reading_replica', default=False)
+
+def read_only(view):
+    """
+    Sends the view's queries to the replica alias when there is one. Writes still go
+    to the default alias. Responses streamed after the view returns keep reading from
+    the replica (see social_app.streaming).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = reading_replica.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            reading_replica.reset(token)
+    return wrapper
+
+def replica_iterator(iterator):
+    # Each step runs in whatever context its caller has, so the flag is set around every one.
+    iterator = iter(iterator)
+    try:
+        while True:
+            token = reading_replica.set(True)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                reading_replica.reset(token)
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+class ReadReplicaRouter:
+    """Reads in read_only views go to REPLICA; all writes and migrations go to default."""
+    def db_for_read(self, model, **hints):
+        if reading_replica.get() and REPLICA in settings.DATABASES:
+            return REPLICA
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == 'default'
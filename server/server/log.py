@@ -0,0 +1,32 @@
+import json
+import logging
+
+# Attributes every LogRecord has; anything else came in through `extra`.
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+def format_field(value):
+    text = str(value)
+    if not text or any(character in text for character in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    One `key=value` line per record: time, level, logger and message, then whatever
+    the call passed as `extra` (e.g. `extra={'user_id': 1}`), so log search can
+    filter on fields. Tracebacks follow on their own lines.
+    """
+    def format(self, record):
+        fields = [
+            ('time', self.formatTime(record)),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('message', record.getMessage()),
+        ]
+        fields.extend((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        line = ' '.join(f'{key}={format_field(value)}' for key, value in fields)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        if record.stack_info:
+            line += '\n' + self.formatStack(record.stack_info)
+        return line
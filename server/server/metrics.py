@@ -0,0 +1,257 @@
+import contextvars
+import hmac
+import ipaddress
+import math
+import threading
+import time
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+# Process-local metrics in the Prometheus text format. Each worker process exposes
+# its own numbers; Prometheus scrapes every worker and sums them.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+SIZE_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.label_names, key, value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{format_labels(names, key)} {format_value(value)}' for name, names, key, value in self.samples())
+        return lines
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        # An unlabelled gauge can read its value when scraped instead of being kept current.
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), (), self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), then the sum.
+                series = self.values[key] = [0] * len(self.buckets) + [0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(series)) for key, series in sorted(self.values.items())]
+        samples = []
+        names = self.label_names + ('le',)
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', names, key + (format_value(bound),), cumulative))
+            samples.append((f'{self.name}_sum', self.label_names, key, series[-1]))
+            samples.append((f'{self.name}_count', self.label_names, key, cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+registry = Registry()
+
+http_request_seconds = registry.histogram('securetalk_http_request_seconds', "Time spent answering HTTP requests.", ('view', 'method', 'status'))
+http_request_queries = registry.histogram('securetalk_http_request_queries', "Database queries run per HTTP request.", ('view',), buckets=QUERY_BUCKETS)
+http_request_query_seconds = registry.histogram('securetalk_http_request_query_seconds', "Time spent in database queries per HTTP request.", ('view',))
+http_response_bytes = registry.histogram('securetalk_http_response_bytes', "Size of HTTP response bodies; streamed bodies are not counted.", ('view',), buckets=BYTES_BUCKETS)
+socket_event_seconds = registry.histogram('securetalk_websocket_event_seconds', "Time spent handling websocket consumer events.", ('consumer', 'event'))
+socket_event_queries = registry.histogram('securetalk_websocket_event_queries', "Database queries run per websocket consumer event.", ('consumer', 'event'), buckets=QUERY_BUCKETS)
+socket_event_query_seconds = registry.histogram('securetalk_websocket_event_query_seconds', "Time spent in database queries per websocket consumer event.", ('consumer', 'event'))
+socket_frame_bytes = registry.histogram('securetalk_websocket_frame_bytes', "Size of websocket frames.", ('consumer', 'direction'), buckets=BYTES_BUCKETS)
+socket_connections = registry.gauge('securetalk_websocket_connections', "Websockets accepted and still open in this process.", ('consumer',))
+fanout_groups = registry.histogram('securetalk_fanout_groups', "Personal groups an event was sent to.", ('event',), buckets=SIZE_BUCKETS)
+
+class QueryStats:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+# The QueryStats of the request or consumer event being handled. Context variables
+# are copied into sync_to_async threads, so queries run there are counted too.
+query_stats = contextvars.ContextVar('query_stats', default=None)
+
+def count_queries(execute, sql, params, many, context):
+    stats = query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.seconds += time.perf_counter() - started
+
+def install_query_counter(sender, connection, **kwargs):
+    # Connected to connection_created, so every new database connection counts its queries.
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+def record_request(request, response, stats, seconds):
+    view = view_name(request)
+    http_request_seconds.observe(seconds, view=view, method=request.method, status=response.status_code)
+    http_request_queries.observe(stats.queries, view=view)
+    http_request_query_seconds.observe(stats.seconds, view=view)
+    if not response.streaming:
+        http_response_bytes.observe(len(response.content), view=view)
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Records latency, database queries and response size per view. Goes first in
+    MIDDLEWARE so the other middleware's work is included.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            stats = QueryStats()
+            token = query_stats.set(stats)
+            started = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                query_stats.reset(token)
+            record_request(request, response, stats, time.perf_counter() - started)
+            return response
+    else:
+        def middleware(request):
+            stats = QueryStats()
+            token = query_stats.set(stats)
+            started = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                query_stats.reset(token)
+            record_request(request, response, stats, time.perf_counter() - started)
+            return response
+    return middleware
+
+def metrics_view(request):
+    """
+    Serves the registry to Prometheus. Scrapers must send METRICS_TOKEN as a bearer
+    token or connect from one of METRICS_ALLOWED_NETWORKS; with neither configured
+    nobody is served.
+    """
+    networks = [ipaddress.ip_network(network) for network in getattr(settings, 'METRICS_ALLOWED_NETWORKS', ())]
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        address = None
+    if address is None or not any(address in network for network in networks):
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        if not token:
+            return HttpResponse(status=403)
+        header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(header.encode(), f'Bearer {token}'.encode()):
+            return HttpResponse(status=401)
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
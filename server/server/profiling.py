@@ -0,0 +1,331 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from users_app.authentication import admin_only, authenticate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.0,
+    'USER_IDS': (),
+    'HEADER': 'X-Profile',
+    'INTERVAL': 0.005,
+    'MAX_ACTIVE': 2,
+    'SPOOL_DIR': '',
+    'MAX_PROFILES': 200,
+    'MAX_BYTES': 50 * 1024 * 1024,
+}
+
+PROFILE_ID = re.compile(r'^[0-9]+-[0-9a-f]{8}$')
+
+class StackSampler:
+    """
+    Records the stack of one thread every `interval` seconds from a thread of its own,
+    as collapsed stacks (root first, frames joined by ';') with their sample counts.
+    Frames above `root` are left out. The sampled thread runs untouched, so the cost
+    is the sampler taking the GIL briefly once per interval.
+    """
+    def __init__(self, thread_id, root, interval):
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self.labels = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def label(self, frame):
+        code = frame.f_code
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{frame.f_globals.get('__name__', '?')}:{code.co_qualname}"
+        return label
+
+    def collapse(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self.label(frame))
+            if frame is self.root:
+                break
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self.collapse(frame)] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class ProfileSession:
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.token = None
+        # Section name -> [calls, seconds].
+        self.sections = {}
+
+    def add_section(self, name, seconds):
+        section = self.sections.setdefault(name, [0, 0.0])
+        section[0] += 1
+        section[1] += seconds
+
+# The ProfileSession of the request being profiled in this context, if any.
+active_profile = contextvars.ContextVar('active_profile', default=None)
+
+def profiled_section(name):
+    """
+    Decorates a function so that, in profiled requests, its calls and time are
+    recorded as section `name`. Outside them it costs one context variable lookup.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            session = active_profile.get()
+            if session is None:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                session.add_section(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class ProfiledSerializerMixin:
+    """
+    Times to_representation of a serializer in profiled requests, so the profile
+    shows how long serializing took and for how many objects.
+    """
+    def to_representation(self, instance):
+        session = active_profile.get()
+        if session is None:
+            return super().to_representation(instance)
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            session.add_section(type(self).__name__, time.perf_counter() - started)
+
+class ProfileSpool:
+    """
+    Profiles as JSON files in `directory`, newest kept. After each save the oldest
+    are deleted until at most MAX_PROFILES files and MAX_BYTES remain.
+    """
+    def __init__(self, directory, max_profiles, max_bytes):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def path(self, profile_id):
+        if not PROFILE_ID.match(profile_id):
+            raise KeyError(profile_id)
+        return os.path.join(self.directory, f'{profile_id}.json')
+
+    def save(self, profile):
+        profile_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        data = json.dumps(dict(profile, id=profile_id)).encode()
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, self.path(profile_id))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.prune()
+        return profile_id
+
+    def files(self):
+        # Oldest first; ids start with the time they were saved.
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith('.json') and PROFILE_ID.match(name[:-5]))
+
+    def prune(self):
+        with self.lock:
+            profile_ids = self.files()
+            sizes = {}
+            for profile_id in profile_ids:
+                try:
+                    sizes[profile_id] = os.path.getsize(self.path(profile_id))
+                except FileNotFoundError:
+                    pass
+            total = sum(sizes.values())
+            for profile_id in profile_ids:
+                if len(sizes) <= self.max_profiles and total <= self.max_bytes:
+                    break
+                if profile_id in sizes:
+                    total -= sizes.pop(profile_id)
+                    self.delete(profile_id)
+
+    def delete(self, profile_id):
+        try:
+            os.unlink(self.path(profile_id))
+        except FileNotFoundError:
+            pass
+
+    def load(self, profile_id):
+        try:
+            with open(self.path(profile_id), 'rb') as file:
+                return json.loads(file.read())
+        except FileNotFoundError:
+            raise KeyError(profile_id)
+
+    def list(self):
+        """Every profile without its stacks, newest first."""
+        profiles = []
+        for profile_id in reversed(self.files()):
+            try:
+                profile = self.load(profile_id)
+            except KeyError:
+                continue
+            profile.pop('stacks', None)
+            profiles.append(profile)
+        return profiles
+
+class RequestProfiler:
+    """
+    Samples the stacks of chosen requests while their view runs.
+
+    Nothing happens unless ENABLED. Then a request is profiled when its user is in
+    USER_IDS, when an admin sends the HEADER header, or at random for a SAMPLE_RATE
+    fraction of requests. At most MAX_ACTIVE requests are profiled at once; others
+    run as usual. Each profile (collapsed stacks, serializer timings, view, user and
+    duration) goes to the spool, where admins can list and download it.
+
+    Only the view call is covered; the body of a streaming response is produced
+    after it returns. Async views are sampled on the event loop's thread, so their
+    stacks also show whatever else the loop ran meanwhile.
+    """
+    def __init__(self, spool, enabled, sample_rate, user_ids, header, interval, max_active):
+        self.spool = spool
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.user_ids = frozenset(user_ids)
+        self.header = header
+        self.interval = interval
+        self.slots = threading.BoundedSemaphore(max_active)
+
+    def trigger(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.id in self.user_ids:
+            return 'user'
+        if user is not None and user.is_admin and self.header in request.headers:
+            return 'header'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def profile(self, view):
+        """Decorator for views; goes under @authenticate so users can be matched."""
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                trigger = self.trigger(request) if self.enabled else None
+                if trigger is None or not self.slots.acquire(blocking=False):
+                    return await view(request, *args, **kwargs)
+                session, sampler, started = self.begin(trigger, sys._getframe())
+                try:
+                    return await view(request, *args, **kwargs)
+                finally:
+                    self.end(request, view, session, sampler, started)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            trigger = self.trigger(request) if self.enabled else None
+            if trigger is None or not self.slots.acquire(blocking=False):
+                return view(request, *args, **kwargs)
+            session, sampler, started = self.begin(trigger, sys._getframe())
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                self.end(request, view, session, sampler, started)
+        return wrapper
+
+    def begin(self, trigger, root):
+        session = ProfileSession(trigger)
+        sampler = StackSampler(threading.get_ident(), root, self.interval)
+        session.token = active_profile.set(session)
+        sampler.start()
+        return session, sampler, time.perf_counter()
+
+    def end(self, request, view, session, sampler, started):
+        try:
+            duration = time.perf_counter() - started
+            sampler.stop()
+            active_profile.reset(session.token)
+            self.spool.save({
+                'view': f'{view.__module__}.{view.__qualname__}',
+                'method': request.method,
+                'path': request.path,
+                'user_id': getattr(request, 'user_id', None),
+                'trigger': session.trigger,
+                'started_at': time.time() - duration,
+                'duration_ms': round(duration * 1000, 3),
+                'interval_ms': self.interval * 1000,
+                'samples': sum(sampler.stacks.values()),
+                'sections': {name: {'calls': calls, 'ms': round(seconds * 1000, 3)} for name, (calls, seconds) in session.sections.items()},
+                'stacks': dict(sampler.stacks.most_common()),
+            })
+        except Exception:
+            # A profile that cannot be stored must not fail the request it measured.
+            logger.exception("Error saving request profile")
+        finally:
+            self.slots.release()
+
+def build_request_profiler():
+    config = dict(DEFAULT_PROFILING, **getattr(settings, 'PROFILING', {}))
+    spool = ProfileSpool(config['SPOOL_DIR'] or os.path.join(tempfile.gettempdir(), 'securetalk-profiles'), config['MAX_PROFILES'], config['MAX_BYTES'])
+    return RequestProfiler(spool, config['ENABLED'], config['SAMPLE_RATE'], config['USER_IDS'], config['HEADER'], config['INTERVAL'], config['MAX_ACTIVE'])
+
+request_profiler = build_request_profiler()
+profiled = request_profiler.profile
+
+@authenticate
+@admin_only
+def list_profiles(request):
+    return JsonResponse({'profiles': request_profiler.spool.list()}, status=200)
+
+@authenticate
+@admin_only
+def download_profile(request, profile_id):
+    """
+    The stored profile as JSON, or with ?format=folded its stacks in the collapsed
+    format flamegraph.pl and speedscope read.
+    """
+    try:
+        profile = request_profiler.spool.load(profile_id)
+    except KeyError:
+        return JsonResponse({'error': 'Profile not found'}, status=404)
+    if request.GET.get('format') == 'folded':
+        body, content_type, extension = ''.join(f'{stack} {count}\n' for stack, count in profile['stacks'].items()), 'text/plain; charset=utf-8', 'folded'
+    else:
+        body, content_type, extension = json.dumps(profile), 'application/json', 'json'
+    response = HttpResponse(body, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.{extension}"'
+    return response
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
 from pathlib import Path
+from server.database import sqlite_database
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,13 +50,46 @@ INSTALLED_APPS = [
 
 ASGI_APPLICATION = 'server.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# CHANNEL_LAYER selects how websocket events travel between workers:
+#   memory - in-process only, for a single worker (default)
+#   redis  - shared through Redis at REDIS_URL, for several processes or hosts
+#   broker - shared through the Unix-socket broker started with `manage.py run_channel_broker`,
+#            for several workers on one host without Redis
+CHANNEL_LAYER = os.environ.get('CHANNEL_LAYER', 'memory')
+
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')],
+                'capacity': 1000,
+                'expiry': 60,
+                'group_expiry': 86400,
+            },
+        }
+    }
+elif CHANNEL_LAYER == 'broker':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'social_app.layers.BrokerChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_BROKER_PATH', '/tmp/securetalk-channels.sock'),
+                'capacity': 1000,
+                'expiry': 60,
+                'group_expiry': 86400,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
     }
-}
 
 MIDDLEWARE = [
+    'server.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -97,11 +131,145 @@ WSGI_APPLICATION = 'server.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+SQLITE_PATH = os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': SQLITE_PATH,
+    }
+}
+
+# DATABASE_PROFILE=production: WAL and tuned pragmas, persistent connections, busy
+# waits instead of "database is locked", and a read-only 'replica' alias on the same
+# file that the listing endpoints read from (server.database).
+if os.environ.get('DATABASE_PROFILE') == 'production':
+    DATABASES = {
+        'default': sqlite_database(SQLITE_PATH),
+        'replica': sqlite_database(SQLITE_PATH, read_only=True),
     }
+
+DATABASE_ROUTERS = ['server.database.ReadReplicaRouter']
+
+# Verified-token and user cache used by users_app.authentication.authenticate.
+# BACKEND is 'local' (per-process LRU) or 'django' (the CACHES entry named CACHE_ALIAS,
+# shared between workers). TTLs are in seconds.
+AUTH_CACHE = {
+    'BACKEND': 'local',
+    'MAX_ENTRIES': 10000,
+    'TOKEN_TTL': 300,
+    'USER_TTL': 60,
+}
+
+# Password hashing (users_app.passwords): bcrypt cost ROUNDS, run on WORKERS threads
+# with at most MAX_QUEUE more waiting; beyond that logins are answered with a 503.
+# Stored hashes with another cost are upgraded at the user's next login.
+PASSWORD_HASHING = {
+    'ROUNDS': 12,
+    'WORKERS': 4,
+    'MAX_QUEUE': 32,
+}
+
+# Profile pictures (users_app.images): uploads are cropped to SIZE x SIZE JPEGs by
+# WORKERS background threads, with at most MAX_QUEUE more waiting (then 503s).
+# Uploads over MAX_BYTES or MAX_PIXELS are refused.
+PROFILE_PICTURES = {
+    'SIZE': 500,
+    'WORKERS': 2,
+    'MAX_QUEUE': 16,
+    'MAX_BYTES': 10 * 1024 * 1024,
+    'MAX_PIXELS': 40_000_000,
+}
+
+# Where the pictures are stored: 'local' (files under MEDIA_ROOT, with URLs under
+# BASE_URL + MEDIA_URL, or the request's host when BASE_URL is empty), 'cloudinary'
+# or the dotted path of a class with url/save/delete (users_app.storage).
+IMAGE_STORAGE = {
+    'BACKEND': os.environ.get('IMAGE_STORAGE', 'local'),
+    'BASE_URL': os.environ.get('MEDIA_BASE_URL', ''),
+    'CLOUDINARY': {
+        'cloud_name': os.environ.get('CLOUDINARY_CLOUD_NAME', ''),
+        'api_key': os.environ.get('CLOUDINARY_API_KEY', ''),
+        'api_secret': os.environ.get('CLOUDINARY_API_SECRET', ''),
+    },
+}
+
+# Presence (social_app.presence): activity is written to users.last_activity every
+# FLUSH_INTERVAL seconds, and users on other workers count as online while it is
+# within ONLINE_WINDOW seconds.
+PRESENCE = {
+    'FLUSH_INTERVAL': 30,
+    'ONLINE_WINDOW': 90,
+}
+
+# Websocket event log (social_app.events): chat events stay replayable for RETENTION
+# seconds, up to MAX_REPLAY per reconnect. Each worker keeps the last RING_SIZE
+# events of its RING_USERS most recent users in memory, and old rows are deleted
+# every PRUNE_EVERY events.
+EVENT_LOG = {
+    'RING_SIZE': 256,
+    'RING_USERS': 10000,
+    'RETENTION': 86400,
+    'MAX_REPLAY': 1000,
+    'PRUNE_EVERY': 1000,
+}
+
+# Recent messages cache (social_app.recent): the newest RING_SIZE messages of recently
+# opened chats, ready to render, within about MAX_BYTES per process. Entries are
+# checked against the database on every request and refilled at least every
+# MAX_AGE seconds.
+RECENT_MESSAGES = {
+    'ENABLED': True,
+    'RING_SIZE': 100,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'MAX_AGE': 60,
+}
+
+# Message search backend: 'fts5' (SQLite FTS5 table from social_app migration 0006),
+# 'basic' (unindexed icontains, for engines without one configured) or the dotted
+# path of a class implementing social_app.search's index/rebuild/search interface.
+# Left unset, it is 'fts5' on SQLite and 'basic' on any other engine.
+MESSAGE_SEARCH = {}
+
+# Metrics (server.metrics) are served at /metrics in the Prometheus text format, to
+# scrapers sending METRICS_TOKEN as a bearer token or connecting from one of
+# METRICS_ALLOWED_NETWORKS (comma-separated CIDRs). Unless one is set, nobody is served.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_NETWORKS = [network for network in os.environ.get('METRICS_ALLOWED_NETWORKS', '').split(',') if network]
+
+# Request profiling (server.profiling), off unless PROFILING=1. Views then sample the
+# stacks of requests from USER_IDS, of admins sending the HEADER header, and of a
+# SAMPLE_RATE fraction of the rest, at most MAX_ACTIVE at once. Profiles are kept
+# in SPOOL_DIR, the newest MAX_PROFILES up to MAX_BYTES, and admins read them at
+# /securetalk/api/admin/profiles.
+PROFILING = {
+    'ENABLED': os.environ.get('PROFILING') == '1',
+    'SAMPLE_RATE': float(os.environ.get('PROFILING_SAMPLE_RATE', '0')),
+    'USER_IDS': [int(user_id) for user_id in os.environ.get('PROFILING_USER_IDS', '').split(',') if user_id],
+    'HEADER': 'X-Profile',
+    'INTERVAL': 0.005,
+    'MAX_ACTIVE': 2,
+    'SPOOL_DIR': os.environ.get('PROFILING_DIR', ''),
+    'MAX_PROFILES': 200,
+    'MAX_BYTES': 50 * 1024 * 1024,
+}
+
+# The apps log key=value lines (server.log) to stderr at LOG_LEVEL. Connection
+# notices are DEBUG; errors carry their traceback.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'keyvalue': {'()': 'server.log.KeyValueFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'keyvalue'},
+    },
+    'loggers': {
+        name: {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False}
+        for name in ('server', 'social_app', 'users_app')
+    },
 }
 
 REST_FRAMEWORK = {
@@ -2,8 +2,13 @@ from django.urls import path
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from server.metrics import metrics_view
+from server.profiling import download_profile, list_profiles
 
 urlpatterns = [
     path('securetalk/api/users', include('users_app.urls')),
     path('securetalk/api/social', include('social_app.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path('securetalk/api/admin/profiles', list_profiles),
+    path('securetalk/api/admin/profiles/<str:profile_id>', download_profile),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class SocialAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'social_app'
+
+    def ready(self):
+        from server.metrics import install_query_counter
+        connection_created.connect(install_query_counter, dispatch_uid='securetalk_query_counter')
@@ -0,0 +1,189 @@
+import contextlib
+import datetime
+import json
+import random
+import jwt
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery
+from django.db.models.functions import Mod
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+from users_app.models import User
+
+SEED_BATCH_SIZE = 5000
+SEED_PASSWORD = 'benchmark'
+MAX_SEEDED_GROUP_SIZE = 50
+
+@contextlib.contextmanager
+def throwaway_database(verbosity=0):
+    """
+    Runs a benchmark against a freshly migrated test database, so benchmarks never
+    read or write the configured one.
+    """
+    old_config = setup_databases(verbosity=verbosity, interactive=False, aliases={'default'})
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+
+def create_users(count, prefix='bench', password='x'):
+    now = timezone.now()
+    users = [
+        User(first_name=f'{prefix.title()}{i}', last_name='User', email=f'{prefix}{i}@example.com', email_key=f'{prefix}{i}@example.com', password=password,
+             date_of_birth=datetime.date(1990, 1, 1), gender='other', last_activity=now)
+        for i in range(count)
+    ]
+    # bulk_create skips save(), which is what fills the search and email key columns.
+    for user in users:
+        user.set_search_names()
+    User.objects.bulk_create(users, batch_size=500)
+    return list(User.objects.filter(email__startswith=prefix).order_by('id'))
+
+@contextlib.contextmanager
+def explicit_timestamps(*models):
+    # auto_now and auto_now_add would stamp every seeded row with the time of the insert.
+    fields = [field for model in models for field in model._meta.fields if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+def skewed_counts(total, buckets, rng, exponent=1.1):
+    """
+    Splits `total` over `buckets` following a Zipf-like law, in random order: a few
+    buckets get most of it and a long tail gets a handful each.
+    """
+    if not buckets:
+        return []
+    weights = [1 / (rank + 1) ** exponent for rank in range(buckets)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for i in range(total - sum(counts)):
+        counts[i % buckets] += 1
+    rng.shuffle(counts)
+    return counts
+
+def seed_dataset(users, chats, messages, seed=0, prefix='seed', days=90, group_share=0.2, log=None):
+    """
+    Bulk-loads a realistic dataset and returns what was created.
+
+    Each user's password is SEED_PASSWORD, hashed once. A `group_share` fraction of
+    the chats are groups whose member counts follow a power law: most have three or
+    four members, a few up to MAX_SEEDED_GROUP_SIZE. The rest are one-to-one.
+    Popular users start many of the chats, and message counts follow
+    skewed_counts, so a few chats hold long histories. Messages are spread over the
+    last `days` days. Previews, inbox rows and read watermarks are filled as the
+    write paths would leave them: most members have read everything, the rest are
+    a few messages behind. The search index is rebuilt once at the end.
+    """
+    from social_app.models import Chat, ChatMembership, Message, direct_chat_key
+    from social_app.search import message_search
+    from users_app.passwords import password_hasher
+    rng = random.Random(seed)
+    log = log or (lambda text: None)
+    hashed = password_hasher._hash(SEED_PASSWORD)
+    people = create_users(users, prefix=prefix, password=hashed)
+    log(f'{len(people)} users')
+
+    popularity = skewed_counts(users * 10, users, rng)
+    groups = round(chats * group_share) if users >= 3 else 0
+    pairs = {}
+    while len(pairs) < min(chats - groups, users * (users - 1) // 2):
+        first, second = rng.choices(people, weights=popularity, k=1)[0], rng.choice(people)
+        if first.id != second.id:
+            pairs.setdefault(direct_chat_key(first.id, second.id), (first, second))
+    sizes = list(range(3, min(users, MAX_SEEDED_GROUP_SIZE) + 1))
+    group_sizes = rng.choices(sizes, weights=[1 / (size - 2) ** 1.5 for size in sizes], k=groups) if groups else []
+    group_members = []
+    for size in group_sizes:
+        owner = rng.choices(people, weights=popularity, k=1)[0]
+        others = [person for person in rng.sample(people, size) if person.id != owner.id][:size - 1]
+        group_members.append((owner, *others))
+    keys = list(pairs) + [None] * groups
+    chat_members = list(pairs.values()) + group_members
+    now = timezone.now()
+    with transaction.atomic():
+        created = Chat.objects.bulk_create([Chat(direct_key=key) for key in keys], batch_size=SEED_BATCH_SIZE)
+        Chat.users.through.objects.bulk_create([
+            Chat.users.through(chat_id=chat.id, user_id=member.id) for chat, members in zip(created, chat_members) for member in members
+        ], batch_size=SEED_BATCH_SIZE)
+        memberships = []
+        for chat, members in zip(created, chat_members):
+            for member in members:
+                chat_name, contact_image = ChatMembership.objects.display_for(member, members)
+                # As create_memberships: the member with the lowest id among the others.
+                other_id = min(m.id for m in members if m.id != member.id)
+                memberships.append(ChatMembership(chat=chat, user=member, other_user_id=other_id, chat_name=chat_name, contact_image=contact_image, last_activity_at=chat.created_at))
+        ChatMembership.objects.bulk_create(memberships, batch_size=SEED_BATCH_SIZE)
+    log(f'{len(created)} chats, {groups} of them groups')
+
+    start = now - datetime.timedelta(days=days)
+    span = days * 86400
+    batch, written = [], 0
+    with explicit_timestamps(Message):
+        for chat, members, count in zip(created, chat_members, skewed_counts(messages, len(created), rng)):
+            at = start + datetime.timedelta(seconds=rng.uniform(0, span / 2))
+            step = (now - at).total_seconds() / (count + 1)
+            for i in range(count):
+                at += datetime.timedelta(seconds=step)
+                batch.append(Message(chat_id=chat.id, sender_id=rng.choice(members).id, content=f'Message {i} of chat {chat.id}', created_at=at, updated_at=at))
+                if len(batch) == SEED_BATCH_SIZE:
+                    Message.objects.bulk_create(batch)
+                    written += len(batch)
+                    batch = []
+                    if written % 100000 == 0:
+                        log(f'{written} messages')
+        Message.objects.bulk_create(batch)
+    written += len(batch)
+    log(f'{written} messages')
+
+    chat_ids = [chat.id for chat in created]
+    newest = Message.objects.filter(chat_id=OuterRef('chat_id')).order_by('-id')
+    with transaction.atomic():
+        for offset in range(0, len(chat_ids), SEED_BATCH_SIZE):
+            ids = chat_ids[offset:offset + SEED_BATCH_SIZE]
+            latest = Message.objects.filter(chat_id=OuterRef('id')).order_by('-id')
+            Chat.objects.filter(Exists(Message.objects.filter(chat_id=OuterRef('id'))), id__in=ids).update(
+                last_message=Subquery(latest.values('content')[:1]), last_message_id=Subquery(latest.values('id')[:1]), updated_at=Subquery(latest.values('created_at')[:1]),
+            )
+            ChatMembership.objects.filter(chat_id__in=ids, chat__last_message_id__gt=0).update(
+                last_message=Subquery(newest.values('content')[:1]), last_message_id=Subquery(newest.values('id')[:1]),
+                last_activity_at=Subquery(newest.values('created_at')[:1]), updated_at=now,
+            )
+        # Seven in ten members are fully read; the rest stopped three messages back.
+        ChatMembership.objects.alias(bucket=Mod('id', 10)).filter(bucket__lt=7).update(last_read_message_id=F('last_message_id'))
+        ChatMembership.objects.alias(bucket=Mod('id', 10)).filter(bucket__gte=7, last_message_id__gt=3).update(last_read_message_id=F('last_message_id') - 3)
+    message_search.rebuild()
+    return {'users': len(people), 'chats': len(created), 'group_chats': groups, 'messages': written}
+
+def make_token(user):
+    return jwt.encode({'user_id': user.id}, settings.SECRET_KEY, algorithm='HS256')
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(samples):
+    """
+    Latency summary in milliseconds for a list of durations in seconds.
+    """
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+def write_report(stdout, report):
+    stdout.write(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,40 @@
+import hashlib
+import json
+from django.views.decorators.http import condition
+from social_app.models import ChatMembership
+
+# Part of every ETag; bump it when the shape of the payloads changes.
+PAYLOAD_VERSION = 2
+
+def conditional_on_memberships(lookup, extra=None):
+    """
+    Answers conditional GETs (If-None-Match) for a view whose payload is built from
+    the memberships `lookup(request, *args, **kwargs)` selects. `extra`, called the
+    same way, returns JSON-serializable state the payload also depends on that the
+    memberships do not track, such as presence.
+
+    The validators come from one ChatMembership.objects.version() query, so a 304 is
+    sent without loading or rendering the payload. The ETag also covers the viewer
+    and the query string, since both change what is rendered. No Last-Modified is
+    sent: its one-second resolution would let If-Modified-Since alone revalidate a
+    payload changed in the same second. Must be applied under `authenticate`.
+    """
+    def version(request, *args, **kwargs):
+        # Views read the version again (the recent messages cache); query once.
+        if not hasattr(request, 'membership_version'):
+            request.membership_version = ChatMembership.objects.version(**lookup(request, *args, **kwargs))
+        return request.membership_version
+
+    def etag(request, *args, **kwargs):
+        state = version(request, *args, **kwargs)
+        if not state['count']:
+            return None
+        validators = [
+            PAYLOAD_VERSION, request.user.id, request.path, request.META.get('QUERY_STRING', ''),
+            state['count'], state['updated_at'].isoformat(), state['last_message_id'], state['read'],
+        ]
+        if extra is not None:
+            validators.append(extra(request, *args, **kwargs))
+        return hashlib.sha1(json.dumps(validators).encode()).hexdigest()
+
+    return condition(etag_func=etag)
@@ -1,106 +1,276 @@
 import json
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+import logging
+import time
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.utils import timezone
+from server.metrics import QueryStats, query_stats, socket_connections, socket_event_queries, socket_event_query_seconds, socket_event_seconds, socket_frame_bytes
+from social_app.events import event_log
+from social_app.fanout import chat_members, publish_to_chat_members, send_numbered, send_to_contacts, user_group
+from social_app.models import ChatMembership, MAX_MESSAGE_LENGTH
+from social_app.presence import presence_tracker
+from social_app.writebehind import message_writer
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        self.accept()
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        async_to_sync(self.channel_layer.group_add)(
-            self.chat_id,
-            self.channel_name
-        )
-        print(f"Connected to chat: {self.chat_id}")
-
-    def disconnect(self, close_code):
-        print(f"Disconnected from chat: {self.chat_id}")
-        async_to_sync(self.channel_layer.group_discard)(
-            self.chat_id,
-            self.channel_name
-        )
-
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        print("ChatConsumer received:", text_data_json)
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.chat_id,
-            {
-                'type': text_data_json['type'],
-                'message': text_data_json
-            }
-        )
-
-        async_to_sync(self.channel_layer.group_send)(
-            'home',
-            {
-                'type': text_data_json['type'],
-                'message': text_data_json
-            }
-        )
-
-    def new_message(self, event):
-        message = event['message']
-        self.send(text_data=json.dumps({
-            'message': message['message'],
-            'type': message['type'],
-            'chat_id': message['chat_id'],
-        }))
+logger = logging.getLogger(__name__)
 
-    def mark_as_read(self, event):
-        message = event['message']
-        self.send(text_data=json.dumps({
-            'message_id': message['message_id'],
-            'type': message['type'],
-            'chat_id': message['chat_id'],
-        }))
+# Frame types clients send. Others are counted as 'unknown', so metric labels stay few.
+CLIENT_FRAME_TYPES = ('heartbeat', 'send_message', 'mark_as_read', 'mark_all_as_read')
 
-    def mark_all_as_read(self, event):
-        message = event['message']
-        self.send(text_data=json.dumps({
-            'type': message['type'],
-            'chat_id': message['chat_id'],
-        }))
+# Keys of each chat event as its members' sockets receive it.
+CLIENT_FRAME_FIELDS = {
+    'new_message': ('message', 'type', 'chat_id'),
+    'mark_as_read': ('message_id', 'type', 'chat_id', 'user_id', 'last_read_message_id'),
+    'mark_all_as_read': ('type', 'chat_id', 'user_id', 'last_read_message_id'),
+}
+
+def client_frame(event):
+    return {key: event.get(key) for key in CLIENT_FRAME_FIELDS[event['type']]}
+
+class ChatEventsConsumer(AsyncWebsocketConsumer):
+    """
+    Shared wire protocol of the chat and home sockets. Handlers run on the event loop,
+    so an idle socket costs a coroutine rather than a thread from the sync executor.
+
+    Every socket joins its user's personal group and events are sent only to the
+    groups of the chat's members, so fan-out grows with the chat, not with everyone online.
+
+    Clients send messages with a `send_message` frame carrying `content` and their own
+    `client_id`. The server stores it, answers with an `ack` holding the saved message,
+    and then sends `new_message` to the chat's members. It never relays a client's
+    `new_message` frame.
+
+    Accepted sockets count towards their user's presence. Contacts receive a `presence`
+    event when the user's first socket opens and when the last one closes, and
+    `heartbeat` frames keep `last_activity` current without a write per frame.
+
+    Chat events carry `seq`, the next number of the receiving user's event sequence
+    (social_app.events). Once accepted, a socket is sent `session` with the latest
+    number. A client reconnecting with `?last_seq=N` is first sent the events after N,
+    then `session`; when those can no longer be replayed it gets `resync_required`
+    and should reload its chats (the sync endpoint catches up cheaply). A socket
+    that sees a number skipped fills the gap from the log, and never sends the same
+    number twice.
+
+    Every event a consumer handles is timed and its queries counted (server.metrics).
+    Client frames are labelled by their type.
+    """
+    async def dispatch(self, message):
+        self.frame_type = None
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            await super().dispatch(message)
+        finally:
+            query_stats.reset(token)
+            self.record_event(message, stats, time.perf_counter() - started)
+
+    def record_event(self, message, stats, seconds):
+        consumer = type(self).__name__
+        event = message['type']
+        if event == 'websocket.receive':
+            event = f'receive.{self.frame_type if self.frame_type in CLIENT_FRAME_TYPES else "unknown"}'
+            socket_frame_bytes.observe(len(message.get('text') or message.get('bytes') or ''), consumer=consumer, direction='in')
+        socket_event_seconds.observe(seconds, consumer=consumer, event=event)
+        socket_event_queries.observe(stats.queries, consumer=consumer, event=event)
+        socket_event_query_seconds.observe(stats.seconds, consumer=consumer, event=event)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        # json.dumps escapes non-ASCII characters, so a frame has as many bytes as characters.
+        size = len(text_data) if text_data is not None else len(bytes_data or b'')
+        socket_frame_bytes.observe(size, consumer=type(self).__name__, direction='out')
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    def parse_frame(self, text_data):
+        frame = json.loads(text_data)
+        self.frame_type = frame.get('type')
+        # Checked first so that, with debug logging off, a frame costs no extra allocations.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s received a %s frame", type(self).__name__, self.frame_type, extra={'user_id': self.user_id})
+        return frame
+
+    async def join_user_group(self):
+        self.user_id = self.scope.get('user_id')
+        if not self.user_id:
+            await self.close(code=4001)
+            return False
+        await self.channel_layer.group_add(user_group(self.user_id), self.channel_name)
+        return True
+
+    async def leave_user_group(self):
+        if getattr(self, 'user_id', None):
+            await self.channel_layer.group_discard(user_group(self.user_id), self.channel_name)
+        if getattr(self, 'counted_online', False):
+            self.counted_online = False
+            socket_connections.dec(consumer=type(self).__name__)
+            if presence_tracker.disconnect(self.user_id):
+                await self.publish_presence(False)
+
+    async def go_online(self):
+        # Called after accept(), so rejected sockets never count as presence.
+        self.counted_online = True
+        socket_connections.inc(consumer=type(self).__name__)
+        if presence_tracker.connect(self.user_id):
+            await self.publish_presence(True)
+
+    async def publish_presence(self, online):
+        message = {'type': 'presence', 'user_id': self.user_id, 'online': online, 'last_activity': timezone.now().isoformat()}
+        await send_to_contacts(self.channel_layer, self.user_id, {'type': 'presence', 'message': message})
 
-class HomeConsumer(WebsocketConsumer):
-    def connect(self):
-        self.accept()
-        async_to_sync(self.channel_layer.group_add)(
-            'home',
-            self.channel_name
-        )
-        print("Connected to home channel")
-
-    def disconnect(self, close_code):
-        print("Disconnected from home channel")
-        async_to_sync(self.channel_layer.group_discard)(
-            'home',
-            self.channel_name
-        )
-
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        print("HomeConsumer received:", text_data_json)
-
-        async_to_sync(self.channel_layer.group_send)(
-            'home',
-            {
-                'type': text_data_json['type'],
-                'message': text_data_json
-            }
-        )
-
-    def new_message(self, event):
-        message = event['message']
-        self.send(text_data=json.dumps({
-            'message': message['message'],
-            'type': message['type'],
-            'chat_id': message['chat_id'],
+    async def open_session(self):
+        # Called after accept(); no chat_event is handled before this returns.
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq', [''])[0]
+        if last_seq.isdigit():
+            if not await self.replay(int(last_seq)):
+                return
+        else:
+            self.last_seq = await database_sync_to_async(event_log.latest)(self.user_id)
+        await self.send(text_data=json.dumps({'type': 'session', 'seq': self.last_seq}))
+
+    async def replay(self, after):
+        events = await database_sync_to_async(event_log.since)(self.user_id, after)
+        if events is None:
+            self.last_seq = await database_sync_to_async(event_log.latest)(self.user_id)
+            await self.send(text_data=json.dumps({'type': 'resync_required', 'seq': self.last_seq}))
+            return False
+        self.last_seq = after
+        for seq, frame in events:
+            self.last_seq = seq
+            await self.send_event(seq, frame)
+        return True
+
+    async def broadcast(self, chat_id, text_data_json):
+        await publish_to_chat_members(self.channel_layer, chat_id, client_frame(text_data_json))
+
+    def wants(self, message):
+        return True
+
+    async def record_read(self, chat_id, text_data_json):
+        # Read events move the sender's watermark; members see where it ended up.
+        up_to = None
+        if text_data_json['type'] == 'mark_as_read':
+            message_id = text_data_json.get('message_id')
+            try:
+                if isinstance(message_id, bool):
+                    raise TypeError(message_id)
+                up_to = int(message_id)
+            except (TypeError, ValueError):
+                await self.send_error(text_data_json.get('client_id'), 'A valid message_id is required')
+                return False
+            text_data_json['message_id'] = up_to
+        watermark = await ChatMembership.objects.amark_read(chat_id, self.user_id, up_to=up_to)
+        if watermark is None:
+            return False
+        text_data_json['user_id'] = self.user_id
+        text_data_json['last_read_message_id'] = watermark
+        return True
+
+    async def send_chat_message(self, chat_id, text_data_json):
+        client_id = text_data_json.get('client_id')
+        content = text_data_json.get('content')
+        if not isinstance(content, str) or not content:
+            await self.send_error(client_id, 'Message content is required')
+            return
+        if len(content) > MAX_MESSAGE_LENGTH:
+            await self.send_error(client_id, 'Message content is too long')
+            return
+        try:
+            message = await message_writer.submit(self.user_id, int(chat_id), content)
+        except Exception:
+            logger.exception("Error in send_chat_message", extra={'user_id': self.user_id, 'chat_id': chat_id})
+            await self.send_error(client_id, 'Failed to create message')
+            return
+        # The new_message event was numbered in the transaction that stored the message.
+        frame, seqs = message.event
+        await self.send(text_data=json.dumps({
+            'type': 'ack',
+            'client_id': client_id,
+            'chat_id': message.chat_id,
+            'message': frame['message'],
         }))
+        await send_numbered(self.channel_layer, frame, seqs)
+
+    async def send_error(self, client_id, error):
+        await self.send(text_data=json.dumps({'type': 'error', 'client_id': client_id, 'error': error}))
+
+    async def presence(self, event):
+        # Presence is about people rather than chats, so every socket forwards it.
+        await self.send(text_data=json.dumps(event['message']))
+
+    async def chat_event(self, event):
+        seq = event['seq']
+        if seq <= self.last_seq:
+            # Already sent by a replay.
+            return
+        if seq > self.last_seq + 1:
+            # Earlier numbers were lost or are still on their way; the log has them all.
+            await self.replay(self.last_seq)
+            return
+        self.last_seq = seq
+        event_log.remember(self.user_id, seq, event['message'])
+        await self.send_event(seq, event['message'])
+
+    async def send_event(self, seq, frame):
+        if self.wants(frame):
+            await self.send(text_data=json.dumps(dict(frame, seq=seq)))
+
+class ChatConsumer(ChatEventsConsumer):
+    async def connect(self):
+        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
+        if not await self.join_user_group():
+            return
+        if not self.chat_id.isdigit() or self.user_id not in await chat_members.members(self.chat_id):
+            await self.close(code=4003)
+            return
+        await self.accept()
+        await self.open_session()
+        await self.go_online()
+        logger.debug("Connected to chat %s", self.chat_id, extra={'user_id': self.user_id})
+
+    async def disconnect(self, close_code):
+        logger.debug("Disconnected from chat %s", self.chat_id, extra={'user_id': getattr(self, 'user_id', None), 'close_code': close_code})
+        await self.leave_user_group()
+
+    async def receive(self, text_data):
+        text_data_json = self.parse_frame(text_data)
+        if text_data_json.get('type') == 'heartbeat':
+            presence_tracker.heartbeat(self.user_id)
+        elif text_data_json.get('type') == 'send_message':
+            await self.send_chat_message(self.chat_id, text_data_json)
+        elif text_data_json.get('type') in ('mark_as_read', 'mark_all_as_read'):
+            if await self.record_read(self.chat_id, text_data_json):
+                await self.broadcast(self.chat_id, text_data_json)
+
+    def wants(self, message):
+        # The personal group carries events for all of the user's chats; this socket shows one.
+        return str(message.get('chat_id')) == self.chat_id
+
+class HomeConsumer(ChatEventsConsumer):
+    async def connect(self):
+        if not await self.join_user_group():
+            return
+        await self.accept()
+        await self.open_session()
+        await self.go_online()
+        logger.debug("Connected to home channel", extra={'user_id': self.user_id})
+
+    async def disconnect(self, close_code):
+        logger.debug("Disconnected from home channel", extra={'user_id': getattr(self, 'user_id', None), 'close_code': close_code})
+        await self.leave_user_group()
+
+    async def receive(self, text_data):
+        text_data_json = self.parse_frame(text_data)
+        if text_data_json.get('type') == 'heartbeat':
+            presence_tracker.heartbeat(self.user_id)
+            return
+
+        chat_id = text_data_json.get('chat_id')
+        if not str(chat_id).isdigit() or self.user_id not in await chat_members.members(chat_id):
+            return
 
-    def mark_all_as_read(self, event):
-        message = event['message']
-        self.send(text_data=json.dumps({
-            'type': message['type'],
-            'chat_id': message['chat_id'],
-        }))
\ No newline at end of file
+        if text_data_json.get('type') == 'send_message':
+            await self.send_chat_message(chat_id, text_data_json)
+        elif text_data_json.get('type') in ('mark_as_read', 'mark_all_as_read'):
+            if await self.record_read(chat_id, text_data_json):
+                await self.broadcast(chat_id, text_data_json)
@@ -0,0 +1,159 @@
+import logging
+import threading
+from collections import Counter, OrderedDict, deque
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from social_app.models import UserEvent, UserEventSequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_LOG = {
+    'RING_SIZE': 256,
+    'RING_USERS': 10000,
+    'RETENTION': 86400,
+    'MAX_REPLAY': 1000,
+    'PRUNE_EVERY': 1000,
+}
+
+class EventLog:
+    """
+    Numbers the chat events sent to each user's sockets and keeps them for replay.
+
+    `append_many` gives every recipient of a list of events the next numbers of their
+    own sequence (1, 2, 3, ... with no gaps) with one upsert, and stores the frames
+    in UserEvent with one insert. Both run in the caller's transaction, so the
+    message write-behind numbers a whole batch in the transaction that stores it.
+    The newest RING_SIZE events of the RING_USERS most recently active users are
+    also kept in memory, so a socket that drops for a few seconds is caught up
+    without reading the table.
+
+    `since(user_id, seq)` returns the (seq, frame) pairs after `seq`, or None when
+    they can no longer all be replayed: removed after RETENTION seconds, more than
+    MAX_REPLAY of them, or a `seq` the server never handed out. The client then has
+    to reload instead. Every PRUNE_EVERY events a background thread deletes old rows.
+    """
+    def __init__(self, ring_size, ring_users, retention, max_replay, prune_every):
+        self.ring_size = ring_size
+        self.ring_users = ring_users
+        self.retention = timedelta(seconds=retention)
+        self.max_replay = max_replay
+        self.prune_every = prune_every
+        self.rings = OrderedDict()
+        self.appends = 0
+        self.pruning = False
+        self.lock = threading.Lock()
+
+    def append(self, user_ids, frame):
+        """Numbers `frame` for each of `user_ids`; returns {user_id: seq}."""
+        return self.append_many([(user_ids, frame)])[0]
+
+    def append_many(self, events):
+        """
+        Numbers a list of (user_ids, frame) events; returns {user_id: seq} for each
+        event, in order. A user receiving several events gets consecutive numbers in
+        list order.
+        """
+        counts = Counter(user_id for user_ids, _ in events for user_id in set(user_ids))
+        if not counts:
+            return [{} for _ in events]
+        user_ids = sorted(counts)
+        table = connection.ops.quote_name(UserEventSequence._meta.db_table)
+        # Each row moves by the number of events its user gets. The conflicting rows
+        # stay locked until commit, so each user's numbers are handed out, and become
+        # visible, in order.
+        sql = (
+            f'INSERT INTO {table} (user_id, seq) VALUES {", ".join(["(%s, %s)"] * len(user_ids))} '
+            f'ON CONFLICT (user_id) DO UPDATE SET seq = {table}.seq + excluded.seq RETURNING user_id, seq'
+        )
+        now = timezone.now()
+        numbered, rows = [], []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [value for user_id in user_ids for value in (user_id, counts[user_id])])
+                next_seq = {user_id: seq - counts[user_id] for user_id, seq in cursor.fetchall()}
+            for recipients, frame in events:
+                seqs = {}
+                for user_id in sorted(set(recipients)):
+                    next_seq[user_id] += 1
+                    seqs[user_id] = next_seq[user_id]
+                    rows.append(UserEvent(user_id=user_id, seq=next_seq[user_id], frame=frame, created_at=now))
+                numbered.append(seqs)
+            UserEvent.objects.bulk_create(rows)
+            # Numbers of a transaction that rolls back are handed out again.
+            transaction.on_commit(lambda: self.remember_all(events, numbered))
+        self.count(len(events))
+        return numbered
+
+    def remember_all(self, events, numbered):
+        for (_, frame), seqs in zip(events, numbered):
+            for user_id, seq in seqs.items():
+                self.remember(user_id, seq, frame)
+
+    def count(self, appended):
+        with self.lock:
+            due = not self.pruning and (self.appends + appended) // self.prune_every > self.appends // self.prune_every
+            self.appends += appended
+            if due:
+                self.pruning = True
+        if due:
+            threading.Thread(target=self.prune_in_background, name='event-log-prune', daemon=True).start()
+
+    def prune_in_background(self):
+        try:
+            self.prune()
+        except Exception:
+            logger.exception("Error pruning the event log")
+        finally:
+            connection.close()
+            with self.lock:
+                self.pruning = False
+
+    def remember(self, user_id, seq, frame):
+        # A ring only ever holds consecutive numbers; after a jump it starts over.
+        with self.lock:
+            ring = self.rings.get(user_id)
+            if ring is None:
+                ring = self.rings[user_id] = deque(maxlen=self.ring_size)
+            self.rings.move_to_end(user_id)
+            if ring and seq <= ring[-1][0]:
+                return
+            if ring and seq != ring[-1][0] + 1:
+                ring.clear()
+            ring.append((seq, frame))
+            while len(self.rings) > self.ring_users:
+                self.rings.popitem(last=False)
+
+    def latest(self, user_id):
+        return UserEventSequence.objects.filter(user_id=user_id).values_list('seq', flat=True).first() or 0
+
+    def since(self, user_id, seq):
+        latest = self.latest(user_id)
+        if seq > latest or latest - seq > self.max_replay:
+            return None
+        if seq == latest:
+            return []
+        with self.lock:
+            ring = self.rings.get(user_id)
+            if ring and ring[0][0] <= seq + 1 and ring[-1][0] >= latest:
+                return [(n, frame) for n, frame in ring if seq < n <= latest]
+        events = list(
+            UserEvent.objects.filter(user_id=user_id, seq__gt=seq, seq__lte=latest, created_at__gte=timezone.now() - self.retention)
+            .order_by('seq').values_list('seq', 'frame')
+        )
+        return events if len(events) == latest - seq else None
+
+    def prune(self):
+        return UserEvent.objects.filter(created_at__lt=timezone.now() - self.retention).delete()[0]
+
+    def clear(self):
+        with self.lock:
+            self.rings.clear()
+            self.appends = 0
+
+def build_event_log():
+    config = dict(DEFAULT_EVENT_LOG, **getattr(settings, 'EVENT_LOG', {}))
+    return EventLog(config['RING_SIZE'], config['RING_USERS'], config['RETENTION'], config['MAX_REPLAY'], config['PRUNE_EVERY'])
+
+event_log = build_event_log()
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from server.metrics import fanout_groups
+from social_app.events import event_log
+from social_app.models import ChatMembership
+
+CHAT_MEMBERS_CACHE_SIZE = 10000
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+class ChatMembersCache:
+    """
+    Bounded in-process LRU of chat id -> member ids. Members of a chat are fixed once
+    create_chat has run, so entries never go stale; `forget` exists for the rare
+    maintenance paths that do rewrite memberships.
+    """
+    def __init__(self, max_entries=CHAT_MEMBERS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, chat_id):
+        with self.lock:
+            members = self.entries.get(chat_id)
+            if members is not None:
+                self.entries.move_to_end(chat_id)
+            return members
+
+    def _set(self, chat_id, members):
+        with self.lock:
+            self.entries[chat_id] = members
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def members(self, chat_id):
+        chat_id = int(chat_id)
+        members = self._get(chat_id)
+        if members is None:
+            members = frozenset([user_id async for user_id in ChatMembership.objects.filter(chat_id=chat_id).values_list('user_id', flat=True)])
+            if members:
+                self._set(chat_id, members)
+        return members
+
+    def forget(self, chat_id):
+        with self.lock:
+            self.entries.pop(int(chat_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+chat_members = ChatMembersCache()
+
+async def send_to_chat_members(channel_layer, chat_id, event):
+    """
+    Delivers `event` to the personal group of every member of `chat_id`, so only the
+    sockets of people in the chat receive it. Returns the number of groups targeted.
+    """
+    members = await chat_members.members(chat_id)
+    fanout_groups.observe(len(members), event=event['type'])
+    await send_batch(channel_layer, [(user_group(user_id), event) for user_id in members])
+    return len(members)
+
+async def publish_to_chat_members(channel_layer, chat_id, frame):
+    """
+    Like send_to_chat_members for a client `frame`, but numbered: each member's copy
+    is logged under the next number of their event sequence (social_app.events) and
+    carries it as `seq`, so their sockets can tell what they missed. Returns
+    {member id: seq}.
+    """
+    members = await chat_members.members(chat_id)
+    seqs = await database_sync_to_async(event_log.append)(members, frame)
+    await send_numbered(channel_layer, frame, seqs)
+    return seqs
+
+async def send_numbered(channel_layer, frame, seqs):
+    """Delivers a `frame` event_log already numbered as {member id: seq}."""
+    fanout_groups.observe(len(seqs), event=frame['type'])
+    await send_batch(channel_layer, [(user_group(user_id), {'type': 'chat_event', 'message': frame, 'seq': seq}) for user_id, seq in seqs.items()])
+
+async def send_to_contacts(channel_layer, user_id, event):
+    """
+    Delivers `event` to the personal group of everyone who shares a chat with
+    `user_id`. Returns the number of groups targeted.
+    """
+    contacts = ChatMembership.objects.filter(chat__memberships__user_id=user_id).exclude(user_id=user_id).values_list('user_id', flat=True).distinct()
+    groups = [user_group(contact_id) async for contact_id in contacts]
+    fanout_groups.observe(len(groups), event=event['type'])
+    await send_batch(channel_layer, [(group, event) for group in groups])
+    return len(groups)
+
+async def send_batch(channel_layer, batch):
+    if hasattr(channel_layer, 'group_send_batch'):
+        await channel_layer.group_send_batch(batch)
+    else:
+        await asyncio.gather(*(channel_layer.group_send(group, event) for group, event in batch))
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import random
+import string
+import struct
+import time
+import uuid
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+HEADER = struct.Struct('!I')
+
+def encode_frame(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return HEADER.pack(len(data)) + data
+
+async def read_frame(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads(await reader.readexactly(length))
+
+def client_of(channel):
+    # Channels are named "<prefix>.<client id>!<suffix>"; the broker routes on the client id.
+    return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+class ChannelBroker:
+    """
+    Minimal message broker for BrokerChannelLayer, listening on a Unix socket.
+
+    It holds group membership and routes every message to the worker process owning
+    the destination channel, so several ASGI workers on one host can share groups.
+    It keeps nothing on disk: restarting it drops group membership until sockets
+    reconnect. Run it with `manage.py run_channel_broker`.
+    """
+    def __init__(self, path, group_expiry=86400):
+        self.path = path
+        self.group_expiry = group_expiry
+        self.clients = {}
+        self.groups = {}
+
+    async def start(self):
+        return await asyncio.start_unix_server(self.handle, path=self.path)
+
+    async def handle(self, reader, writer):
+        client_id = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame['op']
+                if op == 'hello':
+                    client_id = frame['client']
+                    self.clients[client_id] = writer
+                elif op == 'send':
+                    self.route(frame['channel'], frame['message'], frame['sent_at'])
+                elif op == 'group_send':
+                    for group, message in frame['batch']:
+                        for channel in self.members(group):
+                            self.route(channel, message, frame['sent_at'])
+                elif op == 'group_add':
+                    self.groups.setdefault(frame['group'], {})[frame['channel']] = time.time()
+                    writer.write(encode_frame({'ack': frame['id']}))
+                elif op == 'group_discard':
+                    self.groups.get(frame['group'], {}).pop(frame['channel'], None)
+                    writer.write(encode_frame({'ack': frame['id']}))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if client_id is not None and self.clients.get(client_id) is writer:
+                del self.clients[client_id]
+                for members in self.groups.values():
+                    for channel in [c for c in members if client_of(c) == client_id]:
+                        del members[channel]
+            writer.close()
+
+    def members(self, group):
+        members = self.groups.get(group, {})
+        cutoff = time.time() - self.group_expiry
+        for channel in [c for c, added_at in members.items() if added_at < cutoff]:
+            del members[channel]
+        return list(members)
+
+    def route(self, channel, message, sent_at):
+        writer = self.clients.get(client_of(channel))
+        if writer is not None:
+            writer.write(encode_frame({'channel': channel, 'message': message, 'sent_at': sent_at}))
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared between processes through a ChannelBroker.
+
+    Only process-specific channels (the ones new_channel hands to consumers) are
+    supported; messages must be JSON-serializable. Messages older than `expiry`
+    seconds are dropped on receipt, and group_send_batch delivers many group
+    messages in a single write to the broker.
+
+    Sends wait while the connection's write buffer is full rather than let it grow.
+    group_add and group_discard wait for the broker's ack for at most `ack_timeout`
+    seconds, and fail with ConnectionError if the connection drops first.
+    Frames still buffered when an event loop stops are lost, so code that sends
+    and then ends its loop (scripts, benchmarks) should await `close()` first.
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, ack_timeout=10):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        self.ack_timeout = ack_timeout
+        self.group_expiry = group_expiry
+        self.client_id = uuid.uuid4().hex
+        self.queues = {}
+        self.connections = {}
+        self.connect_locks = {}
+        self.acks = {}
+        self.next_id = 0
+
+    async def connection(self):
+        # One broker connection per event loop; concurrent first callers share it.
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is None:
+            lock = self.connect_locks.setdefault(loop, asyncio.Lock())
+            async with lock:
+                connection = self.connections.get(loop)
+                if connection is None:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                    writer.write(encode_frame({'op': 'hello', 'client': self.client_id}))
+                    connection = self.connections[loop] = (writer, loop.create_task(self.read_loop(reader)))
+        return connection[0]
+
+    async def close(self):
+        """Flushes and closes this event loop's broker connection."""
+        loop = asyncio.get_running_loop()
+        connection = self.connections.pop(loop, None)
+        if connection is not None:
+            writer, reader_task = connection
+            writer.close()
+            await writer.wait_closed()
+            reader_task.cancel()
+            self.fail_requests(loop, ConnectionError("Channel broker connection closed"))
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if 'ack' in frame:
+                    future = self.acks.pop(frame['ack'], None)
+                    if future is not None and not future.done():
+                        future.set_result(True)
+                    continue
+                self.deliver(frame['channel'], frame['message'], frame['sent_at'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            loop = asyncio.get_running_loop()
+            self.connections.pop(loop, None)
+            # Their acks will never come; the next request reconnects.
+            self.fail_requests(loop, ConnectionError("Lost the connection to the channel broker"))
+
+    def fail_requests(self, loop, error):
+        for request_id, future in list(self.acks.items()):
+            if future.get_loop() is loop:
+                del self.acks[request_id]
+                if not future.done():
+                    future.set_exception(error)
+
+    def queue(self, channel):
+        if channel not in self.queues:
+            self.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return self.queues[channel]
+
+    def deliver(self, channel, message, sent_at):
+        try:
+            self.queue(channel).put_nowait((sent_at, message))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def request(self, frame):
+        writer = await self.connection()
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.acks[request_id] = future
+        writer.write(encode_frame(dict(frame, id=request_id)))
+        try:
+            await asyncio.wait_for(future, self.ack_timeout)
+        finally:
+            self.acks.pop(request_id, None)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if client_of(channel) == self.client_id:
+            if not self.deliver(channel, message, time.time()):
+                raise ChannelFull(channel)
+            return
+        writer = await self.connection()
+        writer.write(encode_frame({'op': 'send', 'channel': channel, 'message': message, 'sent_at': time.time()}))
+        await writer.drain()
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self.connection()
+        queue = self.queue(channel)
+        while True:
+            try:
+                sent_at, message = await queue.get()
+            except asyncio.CancelledError:
+                # A consumer cancels its receive when its socket closes; drop the channel's queue with it.
+                if queue.empty():
+                    self.queues.pop(channel, None)
+                raise
+            if time.time() - sent_at <= self.expiry:
+                return message
+
+    async def new_channel(self, prefix='specific'):
+        suffix = ''.join(random.choices(string.ascii_letters, k=12))
+        return f'{prefix}.{self.client_id}!{suffix}'
+
+    async def flush(self):
+        self.queues = {}
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self.request({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self.request({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group, message):
+        await self.group_send_batch([(group, message)])
+
+    async def group_send_batch(self, batch):
+        for group, _ in batch:
+            self.require_valid_group_name(group)
+        writer = await self.connection()
+        writer.write(encode_frame({'op': 'group_send', 'batch': [list(item) for item in batch], 'sent_at': time.time()}))
+        await writer.drain()
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import random
+import time
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from server.asgi import application
+from social_app.benchmarks import SEED_PASSWORD, make_token, seed_dataset, summarize, throwaway_database, write_report
+from social_app.models import ChatMembership
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a throwaway database and drives login, get_chats, get_chat_messages, create_chat_message "
+        "and concurrent chat sockets in-process. Reports throughput, p50/p99 latency and queries per "
+        "request as JSON, so runs can be diffed across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--chats', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=50000)
+        parser.add_argument('--requests', type=int, default=200, help="Requests per REST endpoint.")
+        parser.add_argument('--logins', type=int, default=10, help="Logins; each costs a full bcrypt check.")
+        parser.add_argument('--sockets', type=int, default=20, help="Chats with a sending chat socket and a receiving home socket.")
+        parser.add_argument('--socket-messages', type=int, default=20, help="Messages sent over each chat socket.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the dataset and the requests.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with throwaway_database():
+            dataset = seed_dataset(options['users'], options['chats'], options['messages'], seed=options['seed'], prefix='bench')
+            memberships = list(ChatMembership.objects.select_related('user').order_by('id'))
+            client = Client(HTTP_HOST='localhost')
+            count = options['requests']
+
+            def pick():
+                membership = rng.choice(memberships)
+                return membership, {'HTTP_AUTHORIZATION': f'Bearer {make_token(membership.user)}'}
+
+            def login(i):
+                membership = rng.choice(memberships)
+                return client.post('/securetalk/api/users/login', json.dumps({'email': membership.user.email, 'password': SEED_PASSWORD}), content_type='application/json')
+
+            def get_chats(i):
+                _, auth = pick()
+                return client.get('/securetalk/api/social/chats', **auth)
+
+            def get_chat_messages(i):
+                membership, auth = pick()
+                return client.get(f'/securetalk/api/social/chats/{membership.chat_id}/messages', **auth)
+
+            def create_chat_message(i):
+                membership, auth = pick()
+                return client.post(f'/securetalk/api/social/chats/{membership.chat_id}/new_message', json.dumps({'content': f'benchmark {i}'}), content_type='application/json', **auth)
+
+            report = {'login': self.measure(login, options['logins'])}
+            for name, call in (('get_chats', get_chats), ('get_chat_messages', get_chat_messages), ('create_chat_message', create_chat_message)):
+                report[name] = self.measure(call, count)
+            # The revalidation a client with a cached inbox makes, answered with a 304.
+            revalidations = []
+            for _ in range(count):
+                _, auth = pick()
+                revalidations.append(dict(auth, HTTP_IF_NONE_MATCH=client.get('/securetalk/api/social/chats', **auth)['ETag']))
+            report['get_chats_not_modified'] = self.measure(lambda i: client.get('/securetalk/api/social/chats', **revalidations[i]), count)
+
+            chats = {}
+            for membership in memberships:
+                chats.setdefault(membership.chat_id, []).append(membership.user)
+            pairs = [(chat_id, users) for chat_id, users in chats.items() if len(users) == 2]
+            pairs = rng.sample(pairs, min(options['sockets'], len(pairs)))
+            report['chat_sockets'] = asyncio.run(self.run_sockets(pairs, options['socket_messages']))
+        write_report(self.stdout, dict(report, benchmark='api', dataset=dataset, seed=options['seed']))
+
+    def measure(self, call, count):
+        latencies, queries, failures = [], [], 0
+        started = time.perf_counter()
+        for i in range(count):
+            with CaptureQueriesContext(connection) as captured:
+                began = time.perf_counter()
+                response = call(i)
+                latencies.append(time.perf_counter() - began)
+            if response.status_code >= 400:
+                failures += 1
+            queries.append(len(captured.captured_queries))
+        elapsed = time.perf_counter() - started
+        return dict(
+            summarize(latencies), per_second=round(count / elapsed, 1), failures=failures,
+            queries_per_request=round(sum(queries) / count, 2), max_queries=max(queries),
+        )
+
+    async def run_sockets(self, pairs, per_socket):
+        senders = [WebsocketCommunicator(application, f'/ws/socket-server/{chat_id}/?token={make_token(users[0])}') for chat_id, users in pairs]
+        receivers = [WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(users[1])}') for _, users in pairs]
+        for socket in senders + receivers:
+            await socket.connect()
+        acks, delivered = [], []
+
+        async def send(socket, index):
+            for i in range(per_socket):
+                client_id = f'{index}-{i}'
+                began = time.perf_counter()
+                await socket.send_json_to({'type': 'send_message', 'client_id': client_id, 'content': f'socket message {i}'})
+                while True:
+                    frame = await socket.receive_json_from(timeout=30)
+                    if frame['type'] == 'ack' and frame['client_id'] == client_id:
+                        break
+                acks.append(time.perf_counter() - began)
+
+        async def receive(socket):
+            received = 0
+            while received < per_socket:
+                frame = await socket.receive_json_from(timeout=30)
+                if frame['type'] == 'new_message':
+                    received += 1
+            delivered.append(received)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(socket, index) for index, socket in enumerate(senders)), *(receive(socket) for socket in receivers))
+        elapsed = time.perf_counter() - started
+        for socket in senders + receivers:
+            await socket.disconnect()
+        return dict(summarize(acks), sockets=len(senders) * 2, messages_per_second=round(len(acks) / elapsed, 1), delivered=sum(delivered))
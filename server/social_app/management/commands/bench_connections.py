@@ -0,0 +1,59 @@
+import asyncio
+import time
+import tracemalloc
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from server.asgi import application
+from social_app.benchmarks import create_users, make_token, throwaway_database, write_report
+from social_app.fanout import send_batch, user_group
+
+class Command(BaseCommand):
+    help = "Measures how many concurrent home sockets a single worker process can hold."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--steps', default='100,500,1000,2000', help="Comma separated socket counts to ramp through.")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Seconds allowed for a step to connect and broadcast.")
+
+    def handle(self, *args, **options):
+        steps = [int(step) for step in options['steps'].split(',')]
+        with throwaway_database():
+            users = create_users(max(steps))
+            tokens = [make_token(user) for user in users]
+            results = []
+            for count in steps:
+                result = asyncio.run(self.run_step(tokens[:count], [user.id for user in users[:count]], options['timeout']))
+                results.append(result)
+                if not result['ok']:
+                    break
+        write_report(self.stdout, {'benchmark': 'connections', 'steps': results})
+
+    async def run_step(self, tokens, user_ids, timeout):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        sockets = [WebsocketCommunicator(application, f'/ws/socket-server/home/?token={token}') for token in tokens]
+        result = {'sockets': len(sockets), 'ok': False}
+        try:
+            started = time.perf_counter()
+            connected = await asyncio.wait_for(asyncio.gather(*(s.connect(timeout=timeout) for s in sockets)), timeout)
+            result['connect_seconds'] = round(time.perf_counter() - started, 3)
+            result['connected'] = sum(1 for ok, _ in connected if ok)
+            # Every accepted socket opens with its session frame.
+            await asyncio.wait_for(asyncio.gather(*(s.receive_from(timeout=timeout) for s in sockets)), timeout)
+            result['memory_kb_per_socket'] = round((tracemalloc.get_traced_memory()[0] - baseline) / len(sockets) / 1024, 2)
+            tracemalloc.stop()
+
+            started = time.perf_counter()
+            # Sockets only hear their own users' groups; a presence event reaches every socket.
+            event = {'type': 'presence', 'message': {'type': 'presence', 'user_id': 0, 'online': True}}
+            await send_batch(get_channel_layer(), [(user_group(user_id), event) for user_id in user_ids])
+            await asyncio.wait_for(asyncio.gather(*(s.receive_from(timeout=timeout) for s in sockets)), timeout)
+            result['broadcast_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            result['ok'] = result['connected'] == len(sockets)
+        except asyncio.TimeoutError:
+            result['error'] = 'timeout'
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            await asyncio.gather(*(s.disconnect() for s in sockets), return_exceptions=True)
+        return result
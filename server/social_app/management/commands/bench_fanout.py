@@ -0,0 +1,74 @@
+import asyncio
+import random
+import time
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from server.asgi import application
+from social_app.benchmarks import create_users, make_token, throwaway_database, write_report
+from social_app.fanout import send_to_chat_members, user_group
+from social_app.models import Chat
+
+class Command(BaseCommand):
+    help = "Compares frames delivered per message for the old global 'home' broadcast and per-member fan-out."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help="Online users, each holding one home socket.")
+        parser.add_argument('--chats-per-user', type=int, default=3)
+        parser.add_argument('--messages', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with throwaway_database():
+            users = create_users(options['users'])
+            chat_ids = []
+            for user in users:
+                # Contacts are other users, so no self-chat skews the fan-out.
+                for contact in rng.sample([u for u in users if u.id != user.id], options['chats_per_user']):
+                    chat_ids.append(Chat.objects.get_or_create_direct_chat(user, contact)[0].id)
+            sends = [rng.choice(chat_ids) for _ in range(options['messages'])]
+            report = asyncio.run(self.run(users, sends))
+        write_report(self.stdout, dict(report, benchmark='fanout', users=len(users), messages=len(sends)))
+
+    async def run(self, users, sends):
+        layer = get_channel_layer()
+        sockets = [WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(user)}') for user in users]
+        await asyncio.gather(*(s.connect() for s in sockets))
+        # Each socket opens with a session frame; keep it out of the counts.
+        await asyncio.gather(*(self.drain(s) for s in sockets))
+        online = [user.id for user in users]
+
+        async def global_broadcast(chat_id, event):
+            # What the single 'home' group did: every online user gets every event.
+            for user_id in online:
+                await layer.group_send(user_group(user_id), event)
+
+        report = {}
+        try:
+            for name, deliver in (('global_broadcast', global_broadcast), ('per_member', lambda chat_id, event: send_to_chat_members(layer, chat_id, event))):
+                started = time.perf_counter()
+                for chat_id in sends:
+                    # Sent through the presence handler, which forwards any frame as is, so
+                    # only routing is measured and not the numbering of chat events.
+                    await deliver(chat_id, {
+                        'type': 'presence',
+                        'message': {'type': 'new_message', 'chat_id': chat_id, 'message': {'content': 'benchmark'}},
+                    })
+                elapsed = time.perf_counter() - started
+                frames = sum(await asyncio.gather(*(self.drain(s) for s in sockets)))
+                report[name] = {
+                    'frames': frames,
+                    'frames_per_message': round(frames / len(sends), 2),
+                    'send_ms_per_message': round(elapsed / len(sends) * 1000, 3),
+                }
+        finally:
+            await asyncio.gather(*(s.disconnect() for s in sockets), return_exceptions=True)
+        return report
+
+    async def drain(self, socket):
+        frames = 0
+        while not await socket.receive_nothing(timeout=0.2):
+            await socket.receive_from()
+            frames += 1
+        return frames
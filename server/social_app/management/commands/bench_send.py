@@ -0,0 +1,52 @@
+import asyncio
+import time
+from django.core.management.base import BaseCommand
+from social_app.benchmarks import create_users, throwaway_database, write_report
+from social_app.models import Chat, ChatMembership, Message
+from social_app.writebehind import MessageWriteBuffer
+
+class Command(BaseCommand):
+    help = "Measures messages per second written into a single hot chat by each write path."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help="Messages written by each path.")
+        parser.add_argument('--senders', type=int, default=16, help="Concurrent senders feeding the write buffer.")
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        with throwaway_database():
+            alice, bob = create_users(2)
+            chat = Chat.objects.create_chat(alice, bob)
+            senders = [alice, bob]
+            report = {}
+
+            def legacy(i):
+                # The old path: a full chat save and two more statements, each committed on its own.
+                chat.last_message = f'message {i}'
+                chat.save()
+                message = Message.objects.create(sender=senders[i % 2], chat=chat, content=f'message {i}')
+                ChatMembership.objects.filter(chat_id=chat.id).update(last_message=message.content, last_activity_at=message.created_at)
+
+            for name, send in (('legacy', legacy), ('create_message', lambda i: Message.objects.create_message(senders[i % 2], chat, f'message {i}'))):
+                started = time.perf_counter()
+                for i in range(count):
+                    send(i)
+                report[name] = self.result(count, time.perf_counter() - started)
+
+            writer = MessageWriteBuffer()
+            elapsed = asyncio.run(self.run_buffered(writer, [user.id for user in senders], chat.id, count, options['senders']))
+            report['write_buffer'] = dict(self.result(count, elapsed), senders=options['senders'], transactions=writer.batches)
+            report['last_message_is_newest'] = Chat.objects.get(id=chat.id).last_message_id == Message.objects.filter(chat=chat).latest('id').id
+        write_report(self.stdout, dict(report, benchmark='send', messages=count))
+
+    def result(self, count, elapsed):
+        return {'seconds': round(elapsed, 3), 'messages_per_second': round(count / elapsed, 1)}
+
+    async def run_buffered(self, writer, sender_ids, chat_id, count, senders):
+        async def sender(index):
+            for i in range(index, count, senders):
+                await writer.submit(sender_ids[i % 2], chat_id, f'message {i}')
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(index) for index in range(senders)))
+        return time.perf_counter() - started
@@ -0,0 +1,54 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from social_app.benchmarks import create_users, throwaway_database, write_report
+from social_app.models import Chat, ChatMembership, Message
+from social_app.payloads import INBOX_FIELDS, MESSAGE_FIELDS, MessagePayloads, dumps, inbox_payloads, orjson
+from social_app.serializers import InboxSerializer, MessageSerializer
+
+class Command(BaseCommand):
+    help = "Compares DRF serializers with the row-based payload builders for a message page and an inbox page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100, help="Messages on the page (capped by the page size).")
+        parser.add_argument('--chats', type=int, default=50, help="Chats in the inbox (capped by the page size).")
+        parser.add_argument('--repeat', type=int, default=50, help="Times each page is rendered.")
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        with throwaway_database():
+            users = create_users(options['chats'] + 1)
+            viewer = users[0]
+            chats = [Chat.objects.create_chat(viewer, contact) for contact in users[1:]]
+            Message.objects.create_messages([(users[i % 2].id, chats[0].id, f'message {i}') for i in range(options['messages'])])
+
+            def drf_messages():
+                messages, _ = Chat.objects.get_chat_messages(chats[0].id, limit=options['messages'])
+                context = {'current_user_id': viewer.id, 'read_watermarks': {chats[0].id: ChatMembership.objects.read_watermarks(chats[0].id)}}
+                return json.dumps(MessageSerializer(messages, many=True, context=context).data).encode()
+
+            def fast_messages():
+                rows, _ = Chat.objects.get_chat_messages(chats[0].id, limit=options['messages'], fields=MESSAGE_FIELDS)
+                return dumps(MessagePayloads(viewer.id, {chats[0].id: ChatMembership.objects.read_watermarks(chats[0].id)}).build_many(rows))
+
+            def drf_inbox():
+                memberships, _ = ChatMembership.objects.get_inbox(viewer, limit=options['chats'])
+                return json.dumps(InboxSerializer(memberships, many=True).data).encode()
+
+            def fast_inbox():
+                rows, _ = ChatMembership.objects.get_inbox(viewer, limit=options['chats'], fields=INBOX_FIELDS)
+                return dumps(inbox_payloads(rows))
+
+            report = {}
+            for page, drf, fast in (('messages', drf_messages, fast_messages), ('inbox', drf_inbox, fast_inbox)):
+                results = {name: self.measure(render, repeat) for name, render in (('drf', drf), ('fast', fast))}
+                results['speedup'] = round(results['drf']['ms_per_page'] / results['fast']['ms_per_page'], 2)
+                report[page] = results
+        write_report(self.stdout, dict(report, benchmark='serializers', repeat=repeat, encoder='orjson' if orjson else 'json'))
+
+    def measure(self, render, repeat):
+        size = len(render())
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return {'ms_per_page': round((time.perf_counter() - started) / repeat * 1000, 3), 'bytes': size}
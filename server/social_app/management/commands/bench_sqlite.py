@@ -0,0 +1,118 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError
+from server.database import reading_replica
+from social_app.benchmarks import create_users, summarize, write_report
+from social_app.models import Chat, ChatMembership, Message
+from social_app.payloads import INBOX_FIELDS, MESSAGE_FIELDS
+from users_app.models import User
+
+class Command(BaseCommand):
+    help = (
+        "Runs concurrent writer and reader processes against a scratch SQLite file under each "
+        "database profile and counts the operations that failed with 'database is locked'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', default='default,production', help="Comma separated DATABASE_PROFILE values to compare.")
+        parser.add_argument('--writers', type=int, default=24, help="Processes sending messages and marking chats read.")
+        parser.add_argument('--readers', type=int, default=8, help="Processes loading inboxes and message pages.")
+        parser.add_argument('--seconds', type=float, default=8.0, help="How long every process runs.")
+        parser.add_argument('--users', type=int, default=100, help="Users in the scratch database, each with a few chats.")
+        # Used by the processes the benchmark starts.
+        parser.add_argument('--role', choices=['seed', 'writer', 'reader'], help="Internal.")
+        parser.add_argument('--worker', type=int, default=0, help="Internal.")
+        parser.add_argument('--start-at', type=float, default=0.0, help="Internal.")
+
+    def handle(self, *args, **options):
+        if options['role'] == 'seed':
+            return self.seed(options['users'])
+        if options['role']:
+            return self.work(options)
+        report = {'benchmark': 'sqlite', 'writers': options['writers'], 'readers': options['readers'], 'seconds': options['seconds']}
+        for profile in options['profiles'].split(','):
+            with tempfile.TemporaryDirectory() as directory:
+                report[profile] = self.run_profile(profile, os.path.join(directory, 'bench.sqlite3'), options)
+        write_report(self.stdout, report)
+
+    def manage(self, *args):
+        return [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args]
+
+    def run_profile(self, profile, path, options):
+        env = dict(os.environ, SQLITE_PATH=path, DATABASE_PROFILE=profile)
+        subprocess.run(self.manage('migrate', '--verbosity', '0'), env=env, check=True, capture_output=True)
+        subprocess.run(self.manage('bench_sqlite', '--role', 'seed', '--users', str(options['users'])), env=env, check=True, capture_output=True)
+        # Every process waits for the same moment, so start-up does not spread the load out.
+        start_at = time.time() + 2.0
+        roles = ['writer'] * options['writers'] + ['reader'] * options['readers']
+        processes = [
+            (role, subprocess.Popen(self.manage('bench_sqlite', '--role', role, '--worker', str(worker), '--seconds', str(options['seconds']), '--start-at', str(start_at)),
+                                    env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True))
+            for worker, role in enumerate(roles)
+        ]
+        results = {'writer': [], 'reader': []}
+        for role, process in processes:
+            output, _ = process.communicate()
+            results[role].append(json.loads(output.strip().splitlines()[-1]))
+        summary = {}
+        for role, role_results in results.items():
+            latencies = [latency for result in role_results for latency in result['latencies']]
+            summary[f'{role}s'] = dict(
+                summarize(latencies),
+                per_second=round(len(latencies) / options['seconds'], 1),
+                locked_errors=sum(result['locked'] for result in role_results),
+            )
+        return summary
+
+    def seed(self, count):
+        rng = random.Random(0)
+        users = create_users(count)
+        for user in users:
+            for contact in rng.sample(users, 5):
+                if contact.id != user.id:
+                    Chat.objects.get_or_create_direct_chat(user, contact)
+        Message.objects.create_messages([(chat.users.first().id, chat.id, f'message {i}') for chat in Chat.objects.all() for i in range(20)])
+
+    def work(self, options):
+        rng = random.Random(options['worker'])
+        users = User.objects.in_bulk()
+        members = {}
+        for chat_id, user_id in ChatMembership.objects.values_list('chat_id', 'user_id'):
+            members.setdefault(chat_id, []).append(user_id)
+        chats = Chat.objects.in_bulk()
+        chat_ids = sorted(chats)
+        time.sleep(max(0.0, options['start_at'] - time.time()))
+        deadline = time.time() + options['seconds']
+        latencies, locked = [], 0
+        while time.time() < deadline:
+            chat_id = rng.choice(chat_ids)
+            user = users[rng.choice(members[chat_id])]
+            started = time.perf_counter()
+            try:
+                if options['role'] == 'writer':
+                    if rng.random() < 0.8:
+                        Message.objects.create_message(user, chats[chat_id], 'benchmark')
+                    else:
+                        ChatMembership.objects.mark_read(chat_id, user)
+                else:
+                    # What the read_only views do.
+                    token = reading_replica.set(True)
+                    try:
+                        ChatMembership.objects.get_inbox(user, fields=INBOX_FIELDS)
+                        Chat.objects.get_chat_messages(chat_id, fields=MESSAGE_FIELDS)
+                    finally:
+                        reading_replica.reset(token)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+        self.stdout.write(json.dumps({'latencies': latencies, 'locked': locked}))
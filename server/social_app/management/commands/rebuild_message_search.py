@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from social_app.search import message_search
+
+class Command(BaseCommand):
+    help = "Rebuilds the message search index from the messages table."
+
+    def handle(self, *args, **options):
+        message_search.rebuild()
+        self.stdout.write("Message search index rebuilt.")
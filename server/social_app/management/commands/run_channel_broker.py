@@ -0,0 +1,24 @@
+import asyncio
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from social_app.layers import ChannelBroker
+
+class Command(BaseCommand):
+    help = "Runs the Unix-socket broker that BrokerChannelLayer workers share."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=os.environ.get('CHANNEL_BROKER_PATH', '/tmp/securetalk-channels.sock'))
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if os.path.exists(path):
+            os.unlink(path)
+        group_expiry = settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('group_expiry', 86400)
+        self.stdout.write(f"Channel broker listening on {path}")
+        asyncio.run(self.serve(ChannelBroker(path, group_expiry=group_expiry)))
+
+    async def serve(self, broker):
+        server = await broker.start()
+        async with server:
+            await server.serve_forever()
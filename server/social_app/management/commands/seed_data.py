@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from social_app.benchmarks import SEED_PASSWORD, seed_dataset, write_report
+
+class Command(BaseCommand):
+    help = "Bulk-loads users, chats and messages into the configured database for load testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--chats', type=int, default=5000)
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed; the same seed gives the same dataset.")
+        parser.add_argument('--prefix', default='seed', help=f"Users are <prefix><n>@example.com, all with password {SEED_PASSWORD!r}.")
+        parser.add_argument('--days', type=int, default=90, help="Messages are spread over this many days.")
+        parser.add_argument('--group-share', type=float, default=0.2, help="Fraction of the chats that are group chats.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        result = seed_dataset(
+            options['users'], options['chats'], options['messages'], seed=options['seed'], prefix=options['prefix'], days=options['days'], group_share=options['group_share'],
+            log=lambda text: self.stderr.write(f'{text} ({time.perf_counter() - started:.1f}s)'),
+        )
+        write_report(self.stdout, dict(result, seconds=round(time.perf_counter() - started, 3)))
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 03:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0001_initial'),
+        ('users_app', '0002_alter_user_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_history_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.1.6 on 2026-10-18 03:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def full_name(user):
+    return f"{user.first_name} {user.last_name}"
+
+
+def backfill_memberships(apps, schema_editor):
+    Chat = apps.get_model('social_app', 'Chat')
+    Message = apps.get_model('social_app', 'Message')
+    ChatMembership = apps.get_model('social_app', 'ChatMembership')
+    memberships = []
+    for chat in Chat.objects.prefetch_related('users').iterator(chunk_size=500):
+        members = sorted(chat.users.all(), key=lambda m: m.id)
+        for member in members:
+            others = [m for m in members if m.id != member.id]
+            if not others:
+                chat_name, contact_image, other = f"{full_name(member)} (You)", member.profile_picture, member
+            elif len(others) > 1:
+                chat_name, contact_image, other = f"{full_name(others[0])} and {len(others) - 1} others", others[0].profile_picture or '', others[0]
+            else:
+                chat_name, contact_image, other = full_name(others[0]), others[0].profile_picture or '', others[0]
+            unread_count = Message.objects.filter(chat=chat, is_read=False).exclude(sender=member).count()
+            memberships.append(ChatMembership(
+                chat=chat, user=member, other_user=other, chat_name=chat_name, contact_image=contact_image,
+                last_message=chat.last_message[:200], last_activity_at=chat.updated_at, unread_count=unread_count,
+            ))
+        if len(memberships) >= 500:
+            ChatMembership.objects.bulk_create(memberships)
+            memberships = []
+    ChatMembership.objects.bulk_create(memberships)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0002_message_chat_history_idx'),
+        ('users_app', '0002_alter_user_profile_picture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_name', models.CharField(max_length=255)),
+                ('contact_image', models.CharField(blank=True, default='', max_length=255)),
+                ('last_message', models.TextField(default='')),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='social_app.chat')),
+                ('other_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users_app.user')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_memberships', to='users_app.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'last_activity_at', 'id'], name='membership_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chat', 'user'), name='unique_chat_membership')],
+            },
+        ),
+        migrations.RunPython(backfill_memberships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.6 on 2026-10-18 03:14
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def watermarks_from_is_read(apps, schema_editor):
+    # A member has read up to the newest message from someone else that was flagged as read.
+    Message = apps.get_model('social_app', 'Message')
+    ChatMembership = apps.get_model('social_app', 'ChatMembership')
+    newest_read = (
+        Message.objects.filter(chat_id=OuterRef('chat_id'), is_read=True)
+        .exclude(sender_id=OuterRef('user_id')).order_by().values('chat_id').annotate(newest=Max('id')).values('newest')
+    )
+    ChatMembership.objects.update(last_read_message_id=Coalesce(Subquery(newest_read), 0))
+
+
+def is_read_from_watermarks(apps, schema_editor):
+    Message = apps.get_model('social_app', 'Message')
+    ChatMembership = apps.get_model('social_app', 'ChatMembership')
+    for membership in ChatMembership.objects.filter(last_read_message_id__gt=0).iterator():
+        Message.objects.filter(chat_id=membership.chat_id, id__lte=membership.last_read_message_id).exclude(sender_id=membership.user_id).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0003_chatmembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmembership',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(watermarks_from_is_read, is_read_from_watermarks),
+        migrations.RemoveField(
+            model_name='chatmembership',
+            name='unread_count',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:02
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def last_message_ids(apps, schema_editor):
+    Chat = apps.get_model('social_app', 'Chat')
+    ChatMembership = apps.get_model('social_app', 'ChatMembership')
+    Message = apps.get_model('social_app', 'Message')
+    for model, chat_field in ((Chat, 'pk'), (ChatMembership, 'chat_id')):
+        newest = Message.objects.filter(chat_id=OuterRef(chat_field)).order_by().values('chat_id').annotate(newest=Max('id')).values('newest')
+        model.objects.update(last_message_id=Coalesce(Subquery(newest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0004_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='last_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(last_message_ids, migrations.RunPython.noop),
+    ]
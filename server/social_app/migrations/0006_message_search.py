@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:15
+
+from django.db import migrations
+
+
+def create_fts_table(apps, schema_editor):
+    # Only the fts5 search backend needs a table; other databases use their own backend.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE social_app_message_fts USING fts5("
+        "content, content='social_app_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    schema_editor.execute("INSERT INTO social_app_message_fts(social_app_message_fts) VALUES ('rebuild')")
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS social_app_message_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0005_last_message_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
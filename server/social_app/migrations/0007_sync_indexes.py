@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0006_message_search'),
+        ('users_app', '0004_user_email_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmembership',
+            index=models.Index(fields=['user', 'updated_at'], name='membership_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmembership',
+            index=models.Index(fields=['chat', 'updated_at'], name='membership_chat_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'updated_at', 'id'], name='message_chat_sync_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:57
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0007_sync_indexes'),
+        ('users_app', '0004_user_email_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserEventSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='users_app.user')),
+                ('seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('frame', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users_app.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='user_event_created_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'seq'), name='unique_user_event_seq')],
+            },
+        ),
+    ]
@@ -0,0 +1,90 @@
+from django.db import migrations, models
+from django.db.models import Max, Min
+from django.utils import timezone
+
+
+def direct_chat_key(user1_id, user2_id):
+    return f'{min(user1_id, user2_id)}:{max(user1_id, user2_id)}'
+
+
+def merged_watermark(Message, chats, user_id, watermarks):
+    # The highest id below which the user had read every message of every merged chat.
+    first_unread = []
+    for chat_id in chats:
+        unread = Message.objects.filter(chat_id=chat_id, id__gt=watermarks.get(chat_id, 0)).exclude(sender_id=user_id).aggregate(first=Min('id'))['first']
+        if unread is not None:
+            first_unread.append(unread)
+    if first_unread:
+        return min(first_unread) - 1
+    return max(watermarks.values(), default=0)
+
+
+def merge_chats(apps, keeper_id, duplicate_ids):
+    Chat = apps.get_model('social_app', 'Chat')
+    Message = apps.get_model('social_app', 'Message')
+    ChatMembership = apps.get_model('social_app', 'ChatMembership')
+    chats = [keeper_id, *duplicate_ids]
+    watermarks = {}
+    for chat_id, user_id, watermark in ChatMembership.objects.filter(chat_id__in=chats).values_list('chat_id', 'user_id', 'last_read_message_id'):
+        watermarks.setdefault(user_id, {})[chat_id] = watermark
+    reads = {user_id: merged_watermark(Message, chats, user_id, by_chat) for user_id, by_chat in watermarks.items()}
+
+    now = timezone.now()
+    Message.objects.filter(chat_id__in=duplicate_ids).update(chat_id=keeper_id, updated_at=now)
+    Chat.objects.filter(id__in=duplicate_ids).delete()
+
+    last = Message.objects.filter(chat_id=keeper_id).order_by('-id').values('id', 'content', 'created_at').first()
+    if last is not None:
+        Chat.objects.filter(id=keeper_id).update(last_message=last['content'], last_message_id=last['id'], updated_at=last['created_at'])
+    for membership in ChatMembership.objects.filter(chat_id=keeper_id):
+        if last is not None:
+            membership.last_message = last['content'][:200]
+            membership.last_message_id = last['id']
+            membership.last_activity_at = max(membership.last_activity_at, last['created_at'])
+        membership.last_read_message_id = reads.get(membership.user_id, membership.last_read_message_id)
+        membership.updated_at = now
+        membership.save()
+
+
+def fill_direct_keys(apps, schema_editor):
+    """
+    Gives every chat its pair's key. Pairs with several chats (created by
+    simultaneous requests) are merged into the oldest one: the other chats' messages
+    move to it, read watermarks are combined so nothing read becomes unread, and the
+    duplicates are deleted.
+    """
+    Chat = apps.get_model('social_app', 'Chat')
+    members = {}
+    for chat_id, user_id in Chat.users.through.objects.values_list('chat_id', 'user_id'):
+        members.setdefault(chat_id, set()).add(user_id)
+    by_key = {}
+    for chat_id in Chat.objects.order_by('id').values_list('id', flat=True):
+        users = sorted(members.get(chat_id, ()))
+        if 1 <= len(users) <= 2:
+            by_key.setdefault(direct_chat_key(users[0], users[-1]), []).append(chat_id)
+    for key, chat_ids in by_key.items():
+        keeper_id, *duplicate_ids = chat_ids
+        if duplicate_ids:
+            merge_chats(apps, keeper_id, duplicate_ids)
+        Chat.objects.filter(id=keeper_id).update(direct_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('social_app', '0008_user_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='direct_key',
+            field=models.CharField(editable=False, max_length=41, null=True),
+        ),
+        migrations.RunPython(fill_direct_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chat',
+            name='direct_key',
+            field=models.CharField(editable=False, max_length=41, null=True, unique=True),
+        ),
+    ]
@@ -1,34 +1,267 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from users_app.models import User
+from social_app.pagination import STREAM_CHUNK_SIZE, keyset_page, keyset_rows
+from social_app.search import message_search
+
+MESSAGES_PAGE_SIZE = 50
+MAX_MESSAGES_PAGE_SIZE = 200
+CHATS_PAGE_SIZE = 30
+MAX_CHATS_PAGE_SIZE = 100
+LAST_MESSAGE_PREVIEW_LENGTH = 200
+MAX_MESSAGE_LENGTH = 4000
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+
+def direct_chat_key(user1_id, user2_id):
+    # The same for both orders of the pair, so one unique index covers it.
+    return f'{min(user1_id, user2_id)}:{max(user1_id, user2_id)}'
+
+def write_through_messages(messages):
+    """
+    Hands messages the current transaction stores to the recent messages cache once
+    it commits. Must run before the chats' last_message_id moves to them.
+    """
+    from social_app.recent import recent_messages
+    chat_ids = recent_messages.cached({message.chat_id for message in messages})
+    if not chat_ids:
+        return
+    previous = dict(Chat.objects.filter(id__in=chat_ids).values_list('id', 'last_message_id'))
+    transaction.on_commit(lambda: recent_messages.add_messages([message for message in messages if message.chat_id in chat_ids], previous))
+
+def write_through_read(chat, user, watermark):
+    from social_app.recent import recent_messages
+    recent_messages.record_read(getattr(chat, 'id', chat), getattr(user, 'id', user), watermark)
 
 class ChatManager(models.Manager):
     def get_chat(self, chatId):
         return self.get(id=chatId)
     def create_chat(self, user1, user2):
-        chat = self.create()
-        chat.users.add(user1, user2)
+        with transaction.atomic():
+            chat = self.create(direct_key=direct_chat_key(user1.id, user2.id))
+            chat.users.add(user1, user2)
+            ChatMembership.objects.create_memberships(chat, [user1, user2])
         return chat
+    def get_direct_chat(self, user1, user2):
+        return self.filter(direct_key=direct_chat_key(user1.id, user2.id)).first()
+    def get_or_create_direct_chat(self, user1, user2):
+        """
+        Returns the chat between `user1` and `user2` and whether it was just created.
+        Both the lookup and the unique index that settles concurrent creations work on
+        the pair's direct_key, so simultaneous requests end up with the same chat.
+        """
+        chat = self.get_direct_chat(user1, user2)
+        if chat is not None:
+            return chat, False
+        try:
+            return self.create_chat(user1, user2), True
+        except IntegrityError:
+            # Someone else created it between the lookup and the insert.
+            return self.get(direct_key=direct_chat_key(user1.id, user2.id)), False
+    def record_message(self, message):
+        # Conditional, so a sender whose transaction commits late cannot replace a newer preview.
+        return self.filter(id=message.chat_id, last_message_id__lt=message.id).update(
+            last_message=message.content,
+            last_message_id=message.id,
+            updated_at=message.created_at,
+        )
     def get_user_active_chats(self, user):
         return self.filter(users=user)
-    def get_chat_messages(self, chatId):
+    def get_chat_messages(self, chatId, before=None, after=None, limit=MESSAGES_PAGE_SIZE, fields=None):
+        """
+        Returns one page of a chat's history, oldest first, plus a flag telling whether
+        more messages exist in the direction walked. Pages are cut with keyset pagination
+        over (created_at, id) so the newest page costs the same regardless of chat size.
+        With `fields` the page holds .values() rows instead of messages.
+        """
+        chat = self.get(id=chatId)
+        messages = Message.objects.filter(chat=chat)
+        messages = messages.values(*fields) if fields else messages.select_related('sender')
+        page, has_more = keyset_page(messages, ('created_at', 'id'), min(limit, MAX_MESSAGES_PAGE_SIZE), before=before, after=after)
+        page.reverse()
+        return page, has_more
+    def iter_chat_messages(self, chatId, fields, after=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterates a chat's whole history as .values() rows, oldest first, starting past
+        the `after` cursor. Rows are fetched `chunk_size` at a time, never all at once.
+        """
         chat = self.get(id=chatId)
-        return chat.chat_messages.all()
+        messages = Message.objects.filter(chat=chat).values(*fields)
+        return keyset_rows(messages, ('created_at', 'id'), after, descending=False).iterator(chunk_size=chunk_size)
     def mark_chat_messages_as_read(self, chat, user):
-        messages = chat.chat_messages.exclude(sender=user).filter(is_read=False)        
-        for message in messages:
-            message.is_read = True
-            message.save()
+        return ChatMembership.objects.mark_read(chat, user)
 
 class MessageManager(models.Manager):
     def create_message(self, sender, chat, content):
-        chat.last_message = content
-        chat.save()
-        message = self.create(sender=sender, chat=chat, content=content)
+        """
+        Inserts a message and moves the chat and inbox previews to it in one transaction,
+        touching only the preview columns.
+        """
+        with transaction.atomic():
+            message = self.create(sender=sender, chat=chat, content=content)
+            message_search.index([message])
+            write_through_messages([message])
+            Chat.objects.record_message(message)
+            ChatMembership.objects.record_message(message)
         return message
+    def create_messages(self, messages):
+        """
+        Stores (sender_id, chat_id, content) triples in one transaction and moves each
+        touched chat's preview to its newest message. Returns the saved messages in order.
+        """
+        with transaction.atomic():
+            created = self.bulk_create([self.model(sender_id=sender_id, chat_id=chat_id, content=content) for sender_id, chat_id, content in messages])
+            message_search.index(created)
+            write_through_messages(created)
+            newest = {message.chat_id: message for message in created}
+            for message in newest.values():
+                Chat.objects.record_message(message)
+                ChatMembership.objects.record_message(message)
+        return created
+
+    def search(self, user, query, chat_id=None, after=None, limit=SEARCH_PAGE_SIZE):
+        """
+        Returns one page of messages matching `query` in the user's chats, best match
+        first, plus a flag telling whether more follow. Each message carries the
+        `search_rank` and highlighted `search_snippet` of its hit.
+        """
+        hits, has_more = message_search.search(getattr(user, 'id', user), query, chat_id=chat_id, after=after, limit=min(limit, MAX_SEARCH_PAGE_SIZE))
+        messages = self.select_related('sender').in_bulk([hit.message_id for hit in hits])
+        page = []
+        for hit in hits:
+            message = messages[hit.message_id]
+            message.search_rank = hit.rank
+            message.search_snippet = hit.snippet
+            page.append(message)
+        return page, has_more
+
+class ChatMembershipManager(models.Manager):
+    def display_for(self, user, members):
+        """
+        Returns the (chat name, contact image) pair `user` sees for a chat with `members`.
+        """
+        others = sorted((m for m in members if m.id != user.id), key=lambda m: m.id)
+        if not others:
+            return f"{user.full_name()} (You)", user.profile_picture
+        if len(others) > 1:
+            return f"{others[0].full_name()} and {len(others) - 1} others", others[0].profile_picture or ''
+        return others[0].full_name(), others[0].profile_picture or ''
+    def create_memberships(self, chat, members):
+        members = list({m.id: m for m in members}.values())
+        memberships = []
+        for member in members:
+            chat_name, contact_image = self.display_for(member, members)
+            others = [m.id for m in members if m.id != member.id]
+            memberships.append(self.model(
+                chat=chat, user=member, other_user_id=min(others) if others else member.id,
+                chat_name=chat_name, contact_image=contact_image,
+                last_message=chat.last_message[:LAST_MESSAGE_PREVIEW_LENGTH], last_activity_at=chat.updated_at,
+            ))
+        return self.bulk_create(memberships)
+    def record_message(self, message):
+        now = timezone.now()
+        self.filter(chat_id=message.chat_id, last_message_id__lt=message.id).update(
+            last_message=message.content[:LAST_MESSAGE_PREVIEW_LENGTH],
+            last_message_id=message.id,
+            last_activity_at=message.created_at,
+            updated_at=now,
+        )
+    def _read_queries(self, chat, user, up_to):
+        chat_id = getattr(chat, 'id', chat)
+        user_id = getattr(user, 'id', user)
+        messages = Message.objects.filter(chat_id=chat_id)
+        if up_to is not None:
+            messages = messages.filter(id__lte=up_to)
+        newest = Subquery(messages.order_by('-id').values('id')[:1])
+        behind = self.filter(chat_id=chat_id, user_id=user_id, last_read_message_id__lt=newest)
+        current = self.filter(chat_id=chat_id, user_id=user_id).values_list('last_read_message_id', flat=True)
+        return behind, newest, current
+    def mark_read(self, chat, user, up_to=None):
+        """
+        Moves `user`'s read watermark in `chat` forward to message `up_to`, or to the chat's
+        newest message when it is omitted, in a single conditional UPDATE. The watermark
+        never moves backwards. Returns the member's watermark afterwards, or None when
+        `user` is not a member of `chat`.
+        """
+        behind, newest, current = self._read_queries(chat, user, up_to)
+        behind.update(last_read_message_id=newest, updated_at=timezone.now())
+        watermark = current.first()
+        write_through_read(chat, user, watermark)
+        return watermark
+    async def amark_read(self, chat, user, up_to=None):
+        behind, newest, current = self._read_queries(chat, user, up_to)
+        await behind.aupdate(last_read_message_id=newest, updated_at=timezone.now())
+        watermark = await current.afirst()
+        write_through_read(chat, user, watermark)
+        return watermark
+    def read_watermarks(self, chat):
+        """
+        Returns {user_id: last read message id} for every member of `chat`.
+        """
+        return dict(self.filter(chat_id=getattr(chat, 'id', chat)).values_list('user_id', 'last_read_message_id'))
+    def member_activity(self, user):
+        """
+        Returns {user_id: last_activity} for everyone in a chat with `user`, themself
+        included when they are, for PresenceTracker.online_among.
+        """
+        return dict(self.filter(chat__memberships__user=user).values_list('user_id', 'user__last_activity').distinct())
+    def version(self, **lookup):
+        """
+        Summarizes the memberships matching `lookup` in one aggregate query. Every write
+        to a membership bumps its updated_at, and new messages and reads also move
+        last_message_id and last_read_message_id, so the summary changes whenever
+        anything rendered from these rows, or from their chats' messages, does.
+        """
+        return self.filter(**lookup).aggregate(
+            count=Count('id'), updated_at=Max('updated_at'),
+            last_message_id=Max('last_message_id'), read=Sum('last_read_message_id'),
+        )
+    def refresh_contact(self, user):
+        """
+        Re-copies a user's display name and picture into the inbox rows that show them.
+        Only direct chats name a single contact, which is all create_chat produces.
+        """
+        from social_app.recent import recent_messages
+        # Cached message pages carry the old name and picture too.
+        recent_messages.forget_member(user.id)
+        now = timezone.now()
+        self.filter(other_user=user).exclude(user=user).update(chat_name=user.full_name(), contact_image=user.profile_picture or '', updated_at=now)
+        self.filter(other_user=user, user=user).update(chat_name=f"{user.full_name()} (You)", contact_image=user.profile_picture or '', updated_at=now)
+        # The user's own inbox lists them among each chat's users, so its version must move too.
+        self.filter(user=user).exclude(other_user=user).update(updated_at=now)
+    def get_inbox(self, user, before=None, after=None, limit=CHATS_PAGE_SIZE, fields=None):
+        """
+        Returns one page of `user`'s chats, most recently active first, plus a flag telling
+        whether more chats exist in the direction walked. The page costs two queries
+        (memberships and their chats' users) however many chats the user has. With
+        `fields` the page holds .values() rows and the chats' users are not fetched.
+        """
+        memberships = self.with_unread_count(user)
+        memberships = memberships.values(*fields) if fields else memberships.select_related('chat').prefetch_related('chat__users')
+        return keyset_page(memberships, ('last_activity_at', 'id'), min(limit, MAX_CHATS_PAGE_SIZE), before=before, after=after)
+    def iter_inbox(self, user, fields, before=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterates all of `user`'s chats as .values() rows, most recently active first,
+        starting past the `before` cursor, `chunk_size` rows per fetch.
+        """
+        memberships = self.with_unread_count(user).values(*fields)
+        return keyset_rows(memberships, ('last_activity_at', 'id'), before).iterator(chunk_size=chunk_size)
+    def with_unread_count(self, user):
+        unread = (
+            Message.objects.filter(chat_id=OuterRef('chat_id'), id__gt=OuterRef('last_read_message_id'))
+            .exclude(sender_id=OuterRef('user_id')).order_by().values('chat_id').annotate(count=Count('id')).values('count')
+        )
+        return self.filter(user=user).annotate(unread_count=Coalesce(Subquery(unread), 0))
 
 class Chat(models.Model):
     users = models.ManyToManyField(User, related_name="chats")
+    # "<smaller user id>:<larger user id>" for a one-to-one chat; see direct_chat_key.
+    direct_key = models.CharField(max_length=41, null=True, unique=True, editable=False)
     last_message = models.TextField(default="")
+    # Id of the message in `last_message`; guards the preview against out-of-order writers.
+    last_message_id = models.BigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = ChatManager()
@@ -39,9 +272,67 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sent_messages")
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="chat_messages")
     content = models.TextField()
-    is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = MessageManager()
     class Meta:
-        ordering = ['created_at']
\ No newline at end of file
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_history_idx'),
+            models.Index(fields=['chat', 'updated_at', 'id'], name='message_chat_sync_idx'),
+        ]
+
+class ChatMembership(models.Model):
+    """
+    Per-member inbox row: a denormalized projection of a chat as one member sees it,
+    kept current by the message and read paths so the chat list never has to
+    inspect other members or messages.
+
+    `last_read_message_id` is the member's read watermark: every message in the chat
+    with an id at or below it has been read by them. Read receipts and unread counts
+    are derived from it instead of being stored per message. `last_message_id` names
+    the message the preview shows, so a preview only ever moves to a newer message.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="memberships")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chat_memberships")
+    other_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    chat_name = models.CharField(max_length=255)
+    contact_image = models.CharField(max_length=255, blank=True, default='')
+    last_message = models.TextField(default="")
+    last_message_id = models.BigIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    last_read_message_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = ChatMembershipManager()
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_chat_membership'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'last_activity_at', 'id'], name='membership_inbox_idx'),
+            models.Index(fields=['user', 'updated_at'], name='membership_sync_idx'),
+            models.Index(fields=['chat', 'updated_at'], name='membership_chat_sync_idx'),
+        ]
+
+class UserEventSequence(models.Model):
+    # Number of the last event sent to the user's sockets; see social_app.events.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="+")
+    seq = models.BigIntegerField(default=0)
+
+class UserEvent(models.Model):
+    """
+    A chat event as it was sent to one user's sockets, numbered in that user's
+    sequence. Kept for a while so a socket that reconnects can be sent what it missed.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    seq = models.BigIntegerField()
+    frame = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'seq'], name='unique_user_event_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at'], name='user_event_created_idx'),
+        ]
@@ -0,0 +1,105 @@
+import base64
+import json
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+STREAM_CHUNK_SIZE = 500
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if hasattr(v, 'isoformat') else v for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, *types):
+    """
+    Decodes a cursor produced by encode_cursor back into typed values.
+    `types` lists the expected type of every position ('datetime', 'int', 'float' or 'str').
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(types):
+            raise InvalidCursor("Malformed cursor")
+        decoded = []
+        for value, kind in zip(values, types):
+            if kind == 'datetime':
+                value = parse_datetime(value)
+                if value is None:
+                    raise InvalidCursor("Malformed cursor")
+            elif kind == 'int':
+                value = int(value)
+            elif kind == 'float':
+                value = float(value)
+            else:
+                value = str(value)
+            decoded.append(value)
+        return decoded
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor("Malformed cursor")
+
+def parse_limit(value, default, maximum):
+    if value in (None, ''):
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise InvalidCursor("Invalid page size")
+    if limit < 1:
+        raise InvalidCursor("Invalid page size")
+    return min(limit, maximum)
+
+def keyset_page(queryset, fields, limit, before=None, after=None, descending=True):
+    """
+    Returns one page of `queryset` using keyset pagination over `fields`
+    (e.g. ('created_at', 'id')), which must be unique together and backed by an index.
+
+    Without a cursor the page holds the `limit` largest keys. `before` / `after`
+    are tuples of field values taken from a previous page and select the keys
+    directly below / above them. Rows always come back largest key first, along
+    with a flag telling whether more rows exist past the end of the page in the
+    direction that was walked. With `descending=False` everything is mirrored:
+    pages start at the smallest keys and rows come back smallest key first.
+    """
+    if before is not None and after is not None:
+        raise InvalidCursor("Use either before or after, not both")
+    # `onward` continues in the page order; `back` walks against it and is flipped afterwards.
+    onward, back = (before, after) if descending else (after, before)
+    onward_op, back_op = ('lt', 'gt') if descending else ('gt', 'lt')
+    if back is not None:
+        queryset = queryset.filter(_keyset_filter(fields, back, back_op)).order_by(*[f if descending else f'-{f}' for f in fields])
+    else:
+        if onward is not None:
+            queryset = queryset.filter(_keyset_filter(fields, onward, onward_op))
+        queryset = queryset.order_by(*[f'-{f}' if descending else f for f in fields])
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if back is not None:
+        rows.reverse()
+    return rows, has_more
+
+def keyset_rows(queryset, fields, start=None, descending=True):
+    """
+    Every row of `queryset` past the key `start`, in the order keyset_page walks
+    onward (largest key first unless `descending=False`). This is what paging on with
+    keyset_page would return, as a single queryset to iterate when streaming a
+    whole result.
+    """
+    if start is not None:
+        queryset = queryset.filter(_keyset_filter(fields, start, 'lt' if descending else 'gt'))
+    return queryset.order_by(*[f'-{f}' if descending else f for f in fields])
+
+def _keyset_filter(fields, values, op):
+    # (a, b) < (x, y)  <=>  a <= x AND (a < x OR (a = x AND b < y))
+    # The leading a <= x term gives the database a plain range to seek on.
+    condition = Q()
+    for i, field in enumerate(fields):
+        term = Q(**{f'{field}__{op}': values[i]})
+        for previous, value in zip(fields[:i], values[:i]):
+            term &= Q(**{previous: value})
+        condition |= term
+    return Q(**{f'{fields[0]}__{op}e': values[0]}) & condition
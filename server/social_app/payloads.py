@@ -0,0 +1,127 @@
+import json
+from django.http import HttpResponse
+from django.utils import timezone
+from server.profiling import profiled_section
+from social_app.models import Chat, ChatMembership
+from social_app.presence import presence_tracker
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+USER_FIELDS = ['id', 'first_name', 'last_name', 'profile_picture', 'email', 'date_of_birth', 'gender']
+MESSAGE_FIELDS = ['id', 'chat_id', 'sender_id', 'content', 'created_at', 'updated_at'] + [f'sender__{f}' for f in USER_FIELDS[1:]]
+CONTACT_FIELDS = USER_FIELDS + ['search_name', 'last_activity']
+INBOX_FIELDS = ['id', 'chat_id', 'last_message', 'chat_name', 'contact_image', 'unread_count', 'chat__created_at', 'last_activity_at']
+
+def format_datetime(value):
+    # What DRF's DateTimeField renders: the current time zone in ISO 8601, with 'Z' for UTC.
+    if value is None:
+        return None
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    text = value.isoformat()
+    return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+def format_date(value):
+    return value.isoformat() if value else None
+
+def user_payload(row, prefix='', user_id=None):
+    """Builds what UserSerializer renders from a .values() row with USER_FIELDS under `prefix`."""
+    first_name = row[prefix + 'first_name']
+    last_name = row[prefix + 'last_name']
+    return {
+        'id': row[prefix + 'id'] if user_id is None else user_id,
+        'fullName': f"{first_name} {last_name}",
+        'profile_picture': row[prefix + 'profile_picture'],
+        'first_name': first_name,
+        'last_name': last_name,
+        'email': row[prefix + 'email'],
+        'date_of_birth': format_date(row[prefix + 'date_of_birth']),
+        'gender': row[prefix + 'gender'],
+    }
+
+def with_presence(users, last_activity):
+    """Adds `is_online` to user payloads, given {user_id: last_activity} for all of them."""
+    online = presence_tracker.online_among(last_activity)
+    for user in users:
+        user['is_online'] = user['id'] in online
+    return users
+
+class MessagePayloads:
+    """
+    Renders MESSAGE_FIELDS rows in MessageSerializer's shape. Per-request facts are
+    worked out once: the viewer, each sender's user payload and, per (chat, sender),
+    the highest watermark of the other members. Pass `read_watermarks` for the chats
+    involved to avoid a lookup per chat, as with MessageSerializer.
+    """
+    def __init__(self, current_user_id, read_watermarks=None):
+        self.current_user_id = current_user_id
+        self.read_watermarks = dict(read_watermarks or {})
+        self.senders = {}
+        self.read_up_to = {}
+
+    def read_up_to_for(self, chat_id, sender_id):
+        key = (chat_id, sender_id)
+        if key not in self.read_up_to:
+            if chat_id not in self.read_watermarks:
+                self.read_watermarks[chat_id] = ChatMembership.objects.read_watermarks(chat_id)
+            self.read_up_to[key] = max((w for user_id, w in self.read_watermarks[chat_id].items() if user_id != sender_id), default=0)
+        return self.read_up_to[key]
+
+    def build(self, row):
+        sender_id = row['sender_id']
+        sender = self.senders.get(sender_id)
+        if sender is None:
+            sender = self.senders[sender_id] = user_payload(row, 'sender__', user_id=sender_id)
+        is_read = self.read_up_to_for(row['chat_id'], sender_id) >= row['id']
+        return {
+            'id': row['id'],
+            'sender': sender,
+            'content': row['content'],
+            'isFromCurrentUser': sender_id == self.current_user_id if self.current_user_id else False,
+            'is_read': is_read,
+            'status': 'read' if is_read else 'sent',
+            'createdAt': format_datetime(row['created_at']),
+            'updatedAt': format_datetime(row['updated_at']),
+        }
+
+    @profiled_section('MessagePayloads')
+    def build_many(self, rows):
+        return [self.build(row) for row in rows]
+
+@profiled_section('inbox_payloads')
+def inbox_payloads(rows):
+    """
+    Renders INBOX_FIELDS rows in InboxSerializer's shape, with each member's
+    `is_online`. The members of every chat on the page are fetched in one query.
+    """
+    users = {}
+    last_activity = {}
+    memberships = Chat.users.through.objects.filter(chat_id__in={row['chat_id'] for row in rows}).order_by('id')
+    for member in memberships.values('chat_id', 'user__last_activity', *[f'user__{f}' for f in USER_FIELDS]):
+        users.setdefault(member['chat_id'], []).append(user_payload(member, 'user__'))
+        last_activity[member['user__id']] = member['user__last_activity']
+    with_presence([user for members in users.values() for user in members], last_activity)
+    return [{
+        'id': row['chat_id'],
+        'users': users.get(row['chat_id'], []),
+        'last_message': row['last_message'],
+        'chatName': row['chat_name'],
+        'contactImage': row['contact_image'],
+        'unreadCount': row['unread_count'],
+        'createdAt': format_datetime(row['chat__created_at']),
+        'updatedAt': format_datetime(row['last_activity_at']),
+    } for row in rows]
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+class FastJsonResponse(HttpResponse):
+    """JsonResponse for payloads already made of plain JSON types, encoded with orjson when installed."""
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
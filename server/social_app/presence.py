@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+from server.metrics import registry
+from users_app.models import User
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESENCE = {
+    'FLUSH_INTERVAL': 30,
+    'ONLINE_WINDOW': 90,
+}
+FLUSH_BATCH_SIZE = 500
+MAX_PRESENCE_LOOKUP = 200
+
+class PresenceTracker:
+    """
+    Who is online, kept in memory from websocket connects, disconnects and heartbeats.
+
+    A user is online while at least one of their sockets is open in this process.
+    `last_activity` is not written per event. Activity collects in memory and is
+    written every FLUSH_INTERVAL seconds in batched UPDATEs, which also refresh
+    every user still connected here. The flusher is a thread started by the first
+    activity recorded, from a socket or an HTTP request alike, and it stops once
+    nobody is connected and nothing is left to write. Users connected to other workers are seen
+    through that column: they count as online while their `last_activity` is
+    within ONLINE_WINDOW, so the window must be longer than the flush interval.
+    """
+    def __init__(self, flush_interval, online_window):
+        self.flush_interval = flush_interval
+        self.online_window = online_window
+        self.connections = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def connect(self, user_id):
+        """Counts a new socket for `user_id`; returns True if the user just came online."""
+        with self.lock:
+            count = self.connections.get(user_id, 0) + 1
+            self.connections[user_id] = count
+            self.record(user_id)
+        return count == 1
+
+    def disconnect(self, user_id):
+        """Forgets one socket of `user_id`; returns True if that was the user's last."""
+        with self.lock:
+            count = self.connections.get(user_id, 0) - 1
+            if count > 0:
+                self.connections[user_id] = count
+            else:
+                self.connections.pop(user_id, None)
+            self.record(user_id)
+        return count == 0
+
+    def heartbeat(self, user_id):
+        with self.lock:
+            self.record(user_id)
+
+    def record(self, user_id):
+        # Called with the lock held.
+        self.pending[user_id] = timezone.now()
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_periodically, name='presence-flush', daemon=True)
+            self.flusher.start()
+
+    def is_connected(self, user_id):
+        with self.lock:
+            return user_id in self.connections
+
+    def online_users(self, user_ids):
+        """Returns the subset of `user_ids` that is online, with at most one query."""
+        user_ids = set(user_ids)
+        with self.lock:
+            online = {user_id for user_id in user_ids if user_id in self.connections}
+        elsewhere = user_ids - online
+        if elsewhere:
+            cutoff = timezone.now() - timedelta(seconds=self.online_window)
+            online.update(User.objects.filter(id__in=elsewhere, last_activity__gte=cutoff).values_list('id', flat=True))
+        return online
+
+    def online_among(self, last_activity):
+        """
+        Like online_users for {user_id: last_activity} already read with other rows,
+        so the answer costs no query.
+        """
+        cutoff = timezone.now() - timedelta(seconds=self.online_window)
+        with self.lock:
+            return {user_id for user_id, seen in last_activity.items() if user_id in self.connections or seen >= cutoff}
+
+    def flush(self):
+        """Writes collected activity to `last_activity`; returns the number of users written."""
+        now = timezone.now()
+        with self.lock:
+            activity, self.pending = self.pending, {}
+            # Anyone still connected is active now, whatever their last heartbeat said.
+            activity.update(dict.fromkeys(self.connections, now))
+        user_ids = sorted(activity)
+        for start in range(0, len(user_ids), FLUSH_BATCH_SIZE):
+            batch = user_ids[start:start + FLUSH_BATCH_SIZE]
+            User.objects.filter(id__in=batch).update(last_activity=Case(
+                *[When(id=user_id, then=Value(activity[user_id])) for user_id in batch],
+                output_field=DateTimeField(),
+            ))
+        return len(user_ids)
+
+    def clear(self):
+        with self.lock:
+            self.connections.clear()
+            self.pending.clear()
+
+    def flush_periodically(self):
+        try:
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Error in presence flush")
+                with self.lock:
+                    if not self.connections and not self.pending:
+                        self.flusher = None
+                        return
+        finally:
+            connection.close()
+
+def build_presence():
+    config = dict(DEFAULT_PRESENCE, **getattr(settings, 'PRESENCE', {}))
+    return PresenceTracker(config['FLUSH_INTERVAL'], config['ONLINE_WINDOW'])
+
+presence_tracker = build_presence()
+
+registry.gauge('securetalk_online_users', "Users with at least one websocket open in this process.", function=lambda: len(presence_tracker.connections))
@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from server.metrics import registry
+from server.profiling import profiled_section
+from social_app.models import Chat, ChatMembership, MAX_MESSAGES_PAGE_SIZE
+from social_app.payloads import MESSAGE_FIELDS, USER_FIELDS, format_datetime, user_payload
+
+DEFAULT_RECENT_MESSAGES = {
+    'ENABLED': True,
+    'RING_SIZE': 100,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'MAX_AGE': 60,
+}
+
+# Rough memory of a cached message besides its text, and of a member's payload,
+# counted against MAX_BYTES.
+MESSAGE_OVERHEAD = 400
+MEMBER_OVERHEAD = 800
+
+recent_requests = registry.counter('securetalk_recent_messages_requests_total', "Newest-page requests by cache result: hit, miss (filled from the database) or bypass.", ('result',))
+recent_evictions = registry.counter('securetalk_recent_messages_evictions_total', "Chats evicted from the recent messages cache to stay within its memory budget.")
+
+class CachedMessage:
+    """The viewer-independent part of a message payload, plus its page key."""
+    __slots__ = ('id', 'sender_id', 'sender', 'content', 'created_at', 'created', 'updated')
+
+    def __init__(self, id, sender_id, sender, content, created_at, updated_at):
+        self.id = id
+        self.sender_id = sender_id
+        self.sender = sender
+        self.content = content
+        self.created_at = created_at
+        self.created = format_datetime(created_at)
+        self.updated = format_datetime(updated_at)
+
+    @property
+    def key(self):
+        return (self.created_at, self.id)
+
+    @property
+    def size(self):
+        return MESSAGE_OVERHEAD + len(self.content)
+
+class RecentChat:
+    """
+    The newest messages of one chat, oldest first, with its members' payloads and
+    read watermarks. `complete` tells whether they are the chat's whole history.
+    """
+    def __init__(self, messages, complete, members, watermarks):
+        self.messages = messages
+        self.complete = complete
+        self.members = members
+        self.watermarks = watermarks
+        self.last_message_id = max((message.id for message in messages), default=0)
+        self.filled_at = time.monotonic()
+        self.size = sum(message.size for message in messages) + MEMBER_OVERHEAD * len(members)
+
+    def matches(self, version):
+        """
+        Whether the entry still shows the chat as ChatMembership.objects.version()
+        describes it. New messages move last_message_id and reads only ever raise
+        watermarks, so a write this process did not see makes these differ.
+        """
+        return (
+            version['count'] == len(self.watermarks)
+            and (version['last_message_id'] or 0) == self.last_message_id
+            and (version['read'] or 0) == sum(self.watermarks.values())
+        )
+
+@profiled_section('MessagePayloads')
+def render(messages, watermarks, viewer_id):
+    """Builds MessagePayloads' output for `viewer_id` from cached messages."""
+    read_up_to = {}
+    payloads = []
+    for message in messages:
+        up_to = read_up_to.get(message.sender_id)
+        if up_to is None:
+            up_to = read_up_to[message.sender_id] = max((w for user_id, w in watermarks.items() if user_id != message.sender_id), default=0)
+        is_read = up_to >= message.id
+        payloads.append({
+            'id': message.id,
+            'sender': message.sender,
+            'content': message.content,
+            'isFromCurrentUser': message.sender_id == viewer_id,
+            'is_read': is_read,
+            'status': 'read' if is_read else 'sent',
+            'createdAt': message.created,
+            'updatedAt': message.updated,
+        })
+    return payloads
+
+class RecentMessagesCache:
+    """
+    The newest RING_SIZE messages of recently opened chats, ready to render, so
+    reopening a chat does not read or serialize its newest page again.
+
+    Chats are evicted least recently used first to keep the estimated size within
+    MAX_BYTES. New messages and reads are written through by the model managers
+    after they commit. Writes made by other processes are not seen, so each entry
+    is checked against the membership version the view's conditional GET
+    already loaded, and is refilled when it differs or is older than MAX_AGE
+    seconds. MAX_AGE also bounds how long other processes' profile changes stay
+    hidden in the cached sender payloads.
+    """
+    def __init__(self, enabled, ring_size, max_bytes, max_age):
+        self.enabled = enabled
+        self.ring_size = min(ring_size, MAX_MESSAGES_PAGE_SIZE)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def newest_page(self, chat_id, version, viewer_id, limit):
+        """
+        Returns (payloads, has_more, first, last) for the newest `limit` messages of
+        `chat_id` as `viewer_id` sees them, where first and last are the page's
+        oldest and newest CachedMessage (or None). `version` is the chat's current
+        ChatMembership.objects.version(). Returns None when the page must come
+        from the database.
+        """
+        if not self.enabled or limit > self.ring_size or not version['count']:
+            recent_requests.inc(result='bypass')
+            return None
+        chat_id = int(chat_id)
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is not None and entry.matches(version) and time.monotonic() - entry.filled_at <= self.max_age:
+                self.entries.move_to_end(chat_id)
+                messages, watermarks, complete = entry.messages[-limit:], dict(entry.watermarks), entry.complete
+                result = 'hit'
+            else:
+                entry = None
+        if entry is None:
+            entry = self.fill(chat_id)
+            messages, watermarks, complete = entry.messages[-limit:], dict(entry.watermarks), entry.complete
+            result = 'miss'
+        recent_requests.inc(result=result)
+        has_more = len(entry.messages) > limit or not complete
+        return render(messages, watermarks, viewer_id), has_more, messages[0] if messages else None, messages[-1] if messages else None
+
+    def fill(self, chat_id):
+        rows, has_more = Chat.objects.get_chat_messages(chat_id, limit=self.ring_size, fields=MESSAGE_FIELDS)
+        members, watermarks = {}, {}
+        for member in ChatMembership.objects.filter(chat_id=chat_id).values('user_id', 'last_read_message_id', *[f'user__{f}' for f in USER_FIELDS]):
+            members[member['user_id']] = user_payload(member, 'user__')
+            watermarks[member['user_id']] = member['last_read_message_id']
+        messages = [CachedMessage(
+            row['id'], row['sender_id'], members.get(row['sender_id']) or user_payload(row, 'sender__', user_id=row['sender_id']),
+            row['content'], row['created_at'], row['updated_at'],
+        ) for row in rows]
+        entry = RecentChat(messages, not has_more, members, watermarks)
+        with self.lock:
+            self._store(chat_id, entry)
+        return entry
+
+    def cached(self, chat_ids):
+        """The ids among `chat_ids` that have an entry."""
+        if not self.enabled:
+            return set()
+        with self.lock:
+            return {chat_id for chat_id in chat_ids if chat_id in self.entries}
+
+    def add_messages(self, messages, previous):
+        """
+        Writes through messages a transaction stored. `previous` maps each chat id to
+        its last_message_id before the transaction; an entry that did not end at that
+        message missed another writer, so it is dropped instead.
+        """
+        by_chat = {}
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+        with self.lock:
+            for chat_id, added in by_chat.items():
+                entry = self.entries.get(chat_id)
+                if entry is None:
+                    continue
+                if entry.last_message_id != previous.get(chat_id) or any(message.sender_id not in entry.members for message in added):
+                    self._drop(chat_id)
+                    continue
+                for message in added:
+                    cached = CachedMessage(message.id, message.sender_id, entry.members[message.sender_id], message.content, message.created_at, message.updated_at)
+                    bisect.insort(entry.messages, cached, key=lambda m: m.key)
+                    entry.size += cached.size
+                    entry.last_message_id = max(entry.last_message_id, message.id)
+                self.size += sum(MESSAGE_OVERHEAD + len(message.content) for message in added)
+                while len(entry.messages) > self.ring_size:
+                    dropped = entry.messages.pop(0)
+                    entry.size -= dropped.size
+                    self.size -= dropped.size
+                    entry.complete = False
+            self._evict()
+
+    def record_read(self, chat_id, user_id, watermark):
+        if watermark is None:
+            return
+        with self.lock:
+            entry = self.entries.get(int(chat_id))
+            if entry is not None and user_id in entry.watermarks:
+                entry.watermarks[user_id] = max(entry.watermarks[user_id], watermark)
+
+    def forget_member(self, user_id):
+        # Members' names and pictures are copied into the entries of their chats.
+        with self.lock:
+            for chat_id in [chat_id for chat_id, entry in self.entries.items() if user_id in entry.members]:
+                self._drop(chat_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _store(self, chat_id, entry):
+        self._drop(chat_id)
+        self.entries[chat_id] = entry
+        self.size += entry.size
+        self._evict()
+
+    def _drop(self, chat_id):
+        entry = self.entries.pop(chat_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            recent_evictions.inc()
+
+def build_recent_messages():
+    config = dict(DEFAULT_RECENT_MESSAGES, **getattr(settings, 'RECENT_MESSAGES', {}))
+    return RecentMessagesCache(config['ENABLED'], config['RING_SIZE'], config['MAX_BYTES'], config['MAX_AGE'])
+
+recent_messages = build_recent_messages()
+
+registry.gauge('securetalk_recent_messages_bytes', "Estimated memory held by the recent messages cache.", function=lambda: recent_messages.size)
+registry.gauge('securetalk_recent_messages_chats', "Chats in the recent messages cache.", function=lambda: len(recent_messages.entries))
@@ -0,0 +1,134 @@
+import html
+import re
+from collections import namedtuple
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+# Private-use characters FTS5 puts around matches, turned into the tags once the
+# text is escaped.
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+MATCH = re.compile(f'{MATCH_START}([^{MATCH_START}{MATCH_END}]*){MATCH_END}')
+SNIPPET_TOKENS = 12
+FTS_TABLE = 'social_app_message_fts'
+
+DEFAULT_MESSAGE_SEARCH = {
+    # None picks 'fts5' on SQLite and 'basic' on other engines.
+    'BACKEND': None,
+}
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+def highlight(snippet):
+    """
+    HTML for a snippet with MATCH_START/MATCH_END around its matches: the message
+    text is escaped, so the <mark> tags are its only markup. Markers the message
+    itself contained are dropped.
+    """
+    marked = MATCH.sub(lambda match: HIGHLIGHT_START + match.group(1) + HIGHLIGHT_END, html.escape(snippet))
+    return marked.replace(MATCH_START, '').replace(MATCH_END, '')
+
+# `snippet` is HTML: escaped message text with matches in <mark> tags.
+SearchHit = namedtuple('SearchHit', ['message_id', 'rank', 'snippet'])
+
+class SQLiteFTSBackend:
+    """
+    Message search on an SQLite FTS5 table (created by migration 0006) that indexes
+    social_app_message.content as external content, so the text is stored once.
+
+    Rows are added by `index` inside the transaction that inserts the messages.
+    Results are ranked by bm25 and paged with (rank, id) cursors. A message deleted
+    from social_app_message drops out of results through the join, though its
+    terms stay in the index until the next `rebuild`.
+    """
+    def index(self, messages):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {FTS_TABLE}(rowid, content) VALUES (%s, %s)', [(m.id, m.content) for m in messages])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+    def match_expression(self, query):
+        # Each word is quoted so user input can never be parsed as FTS5 syntax;
+        # the last one matches as a prefix so results appear while typing.
+        terms = ['"%s"' % term for term in search_terms(query)]
+        if terms:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, user_id, query, chat_id=None, after=None, limit=20):
+        """
+        Returns up to `limit` hits for `query` in chats `user_id` is a member of, best
+        first, plus a flag telling whether more follow. `after` is the (rank, message id)
+        of the last hit of the previous page.
+        """
+        expression = self.match_expression(query)
+        if not expression:
+            return [], False
+        sql = [
+            f"SELECT m.id, bm25({FTS_TABLE}) AS rank, snippet({FTS_TABLE}, 0, %s, %s, '…', %s)",
+            f"FROM {FTS_TABLE} JOIN social_app_message m ON m.id = {FTS_TABLE}.rowid",
+            "JOIN social_app_chatmembership cm ON cm.chat_id = m.chat_id AND cm.user_id = %s",
+            f"WHERE {FTS_TABLE} MATCH %s",
+        ]
+        params = [MATCH_START, MATCH_END, SNIPPET_TOKENS, user_id, expression]
+        if chat_id is not None:
+            sql.append("AND m.chat_id = %s")
+            params.append(chat_id)
+        if after is not None:
+            sql.append(f"AND (bm25({FTS_TABLE}) > %s OR (bm25({FTS_TABLE}) = %s AND m.id < %s))")
+            params += [after[0], after[0], after[1]]
+        sql.append("ORDER BY rank, m.id DESC LIMIT %s")
+        params.append(limit + 1)
+        with connection.cursor() as cursor:
+            cursor.execute(' '.join(sql), params)
+            rows = cursor.fetchall()
+        hits = [SearchHit(message_id, rank, highlight(snippet)) for message_id, rank, snippet in rows[:limit]]
+        return hits, len(rows) > limit
+
+class BasicSearchBackend:
+    """
+    Portable fallback for databases without a configured full-text backend: every
+    word must appear in the message (icontains, so no index is used). Results are
+    newest first, and the snippet is the start of the message.
+    """
+    def index(self, messages):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, user_id, query, chat_id=None, after=None, limit=20):
+        from social_app.models import LAST_MESSAGE_PREVIEW_LENGTH, Message
+        terms = search_terms(query)
+        if not terms:
+            return [], False
+        messages = Message.objects.filter(chat__memberships__user_id=user_id)
+        for term in terms:
+            messages = messages.filter(content__icontains=term)
+        if chat_id is not None:
+            messages = messages.filter(chat_id=chat_id)
+        if after is not None:
+            messages = messages.filter(id__lt=after[1])
+        rows = list(messages.order_by('-id').values_list('id', 'content')[:limit + 1])
+        hits = [SearchHit(message_id, 0.0, html.escape(content[:LAST_MESSAGE_PREVIEW_LENGTH])) for message_id, content in rows[:limit]]
+        return hits, len(rows) > limit
+
+def build_message_search():
+    config = dict(DEFAULT_MESSAGE_SEARCH, **getattr(settings, 'MESSAGE_SEARCH', {}))
+    backend = config['BACKEND']
+    if backend is None:
+        # Only SQLite has the FTS5 table; elsewhere indexing every insert would fail.
+        backend = 'fts5' if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' else 'basic'
+    if backend == 'fts5':
+        return SQLiteFTSBackend()
+    if backend == 'basic':
+        return BasicSearchBackend()
+    return import_string(backend)()
+
+message_search = build_message_search()
@@ -1,9 +1,10 @@
 from rest_framework import serializers
-from social_app.models import Chat, Message
+from server.profiling import ProfiledSerializerMixin
+from social_app.models import Chat, ChatMembership, Message
 from users_app.models import User
 from users_app.serializers import UserSerializer
 
-class ChatSerializer(serializers.ModelSerializer):
+class ChatSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     users = UserSerializer(many=True)
     chatName = serializers.SerializerMethodField()
     contactImage = serializers.SerializerMethodField()
@@ -51,9 +52,23 @@ class ChatSerializer(serializers.ModelSerializer):
         profile_picture_url = other_users.first().profile_picture if other_users.first().profile_picture else ''
         return profile_picture_url
 
-class MessageSerializer(serializers.ModelSerializer):
+class InboxSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='chat_id')
+    users = UserSerializer(source='chat.users', many=True)
+    chatName = serializers.CharField(source='chat_name')
+    contactImage = serializers.CharField(source='contact_image')
+    unreadCount = serializers.IntegerField(source='unread_count')
+    createdAt = serializers.DateTimeField(source='chat.created_at')
+    updatedAt = serializers.DateTimeField(source='last_activity_at')
+
+    class Meta:
+        model = ChatMembership
+        fields = ['id', 'users', 'last_message', 'chatName', 'contactImage', 'unreadCount', 'createdAt', 'updatedAt']
+
+class MessageSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     sender = UserSerializer()
     isFromCurrentUser = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
     status = serializers.SerializerMethodField()
     createdAt = serializers.DateTimeField(source='created_at')
     updatedAt = serializers.DateTimeField(source='updated_at')
@@ -63,8 +78,16 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'sender', 'content', 'isFromCurrentUser', 'is_read', 'status', 'createdAt', 'updatedAt']
     
     def get_isFromCurrentUser(self, obj):
+        # Outside a request (the websocket send path) the viewer is passed as `current_user_id`.
         request = self.context.get('request')
-        current_user = request.user if request else None
-        return obj.sender.id == current_user.id if current_user else False
+        current_user_id = request.user.id if request else self.context.get('current_user_id')
+        return obj.sender_id == current_user_id if current_user_id else False
+    def get_is_read(self, obj):
+        # A message is read once any member other than its sender has a watermark past it.
+        # Pass `read_watermarks` in the context to avoid the lookup; otherwise it runs once per chat.
+        watermarks = self.context.setdefault('read_watermarks', {})
+        if obj.chat_id not in watermarks:
+            watermarks[obj.chat_id] = ChatMembership.objects.read_watermarks(obj.chat_id)
+        return any(watermark >= obj.id for user_id, watermark in watermarks[obj.chat_id].items() if user_id != obj.sender_id)
     def get_status(self, obj):
-        return 'read' if obj.is_read else 'sent'
\ No newline at end of file
+        return 'read' if self.get_is_read(obj) else 'sent'
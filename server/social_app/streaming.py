@@ -0,0 +1,57 @@
+import itertools
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from server.database import reading_replica, replica_iterator
+from social_app.pagination import STREAM_CHUNK_SIZE
+from social_app.payloads import dumps
+
+def wants_stream(request):
+    return request.GET.get('stream') in ('1', 'true')
+
+def stream_envelope(key, rows, render, tail, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the JSON object {key: [...], **tail(first, last)} piece by piece.
+
+    `rows` is consumed `chunk_size` rows at a time and `render` turns each chunk into
+    its payloads, so only one chunk is held in memory whatever the size of the
+    result. `tail` receives the first and last row (None when there were none) and
+    returns the keys written after the array, such as the cursors.
+    """
+    yield b'{' + dumps(key) + b':['
+    rows = iter(rows)
+    first = last = None
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        separator = b'' if first is None else b','
+        first = chunk[0] if first is None else first
+        last = chunk[-1]
+        yield separator + b','.join(dumps(payload) for payload in render(chunk))
+    extra = dumps(tail(first, last))
+    yield b'],' + extra[1:] if len(extra) > 2 else b']}'
+
+async def read_in_thread(parts):
+    # Every chunk is produced on the request's sync thread, which owns the database
+    # connection the rows are being read from.
+    next_part = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (part := await next_part(parts, None)) is not None:
+            yield part
+    finally:
+        await sync_to_async(parts.close, thread_sensitive=True)()
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    """
+    Streams the pieces of a JSON document, typically from stream_envelope.
+
+    Served over ASGI, Django reads a plain iterator into a list before sending any of
+    it; the pieces are therefore handed over as an async iterator there, so the first
+    bytes leave as soon as the first chunk is ready and memory stays flat. A stream
+    started in a read_only view reads from the replica to the end.
+    """
+    def __init__(self, request, parts, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        if reading_replica.get():
+            parts = replica_iterator(parts)
+        if isinstance(request, ASGIRequest):
+            parts = read_in_thread(parts)
+        super().__init__(parts, **kwargs)
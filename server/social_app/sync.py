@@ -0,0 +1,73 @@
+from datetime import timedelta
+from django.db.models import F, Subquery, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from social_app.models import ChatMembership, Message
+from social_app.pagination import InvalidCursor, decode_cursor, encode_cursor
+from social_app.payloads import INBOX_FIELDS, MESSAGE_FIELDS, MessagePayloads, inbox_payloads
+
+# Changes committed up to this long after they were stamped are still picked up.
+SYNC_OVERLAP = timedelta(seconds=5)
+MAX_SYNC_CHATS = 200
+SYNC_MESSAGES_PER_CHAT = 100
+
+def decode_sync_cursor(cursor, user):
+    since, user_id = decode_cursor(cursor, 'datetime', 'int')
+    if user_id != user.id:
+        raise InvalidCursor("Cursor belongs to another user")
+    return since
+
+def changes_since(user, since):
+    """
+    What changed for `user` after `since`, plus the cursor for the next call.
+
+    Every change a user can see bumps a ChatMembership.updated_at: new messages and
+    contact edits touch the rows of every member, reads the reader's own row. So
+    - `chats` are the user's memberships updated since, rendered as in the inbox;
+    - `messages` are those chats' messages updated since, newest
+      SYNC_MESSAGES_PER_CHAT per chat, with `hasMore` when older ones were left out
+      (page back with get_chat_messages);
+    - `reads` are the other members' watermarks in the user's chats, from their
+      rows updated since.
+    Each is one indexed range scan, so a catch-up costs what changed rather than
+    the history. Cursors are timestamps taken SYNC_OVERLAP before the call, so
+    writes committed late are not skipped; the overlap can repeat a few items,
+    which clients merge by id. Without `since`, or when more than MAX_SYNC_CHATS
+    chats changed, nothing is listed and `fullResync` asks for a full reload.
+    """
+    cursor = encode_cursor(timezone.now() - SYNC_OVERLAP, user.id)
+    result = {'chats': [], 'messages': [], 'reads': [], 'cursor': cursor, 'fullResync': True}
+    if since is None:
+        return result
+    memberships = ChatMembership.objects.with_unread_count(user).filter(updated_at__gt=since)
+    rows = list(memberships.order_by('-last_activity_at', '-id').values(*INBOX_FIELDS)[:MAX_SYNC_CHATS + 1])
+    if len(rows) > MAX_SYNC_CHATS:
+        return result
+    result['fullResync'] = False
+    result['chats'] = inbox_payloads(rows)
+
+    my_chats = ChatMembership.objects.filter(user=user).values('chat_id')
+    others = ChatMembership.objects.filter(chat_id__in=Subquery(my_chats), updated_at__gt=since).exclude(user=user)
+    result['reads'] = list(others.order_by('chat_id', 'user_id').values('chat_id', 'user_id', 'last_read_message_id'))
+
+    chat_ids = [row['chat_id'] for row in rows]
+    if chat_ids:
+        newest_first = Window(RowNumber(), partition_by=[F('chat_id')], order_by=F('id').desc())
+        messages = (
+            Message.objects.filter(chat_id__in=chat_ids, updated_at__gt=since)
+            .annotate(position=newest_first).filter(position__lte=SYNC_MESSAGES_PER_CHAT + 1)
+            .order_by('chat_id', 'id').values(*MESSAGE_FIELDS, 'position')
+        )
+        watermarks = {}
+        for chat_id, user_id, watermark in ChatMembership.objects.filter(chat_id__in=chat_ids).values_list('chat_id', 'user_id', 'last_read_message_id'):
+            watermarks.setdefault(chat_id, {})[user_id] = watermark
+        payloads = MessagePayloads(user.id, watermarks)
+        groups = {}
+        for row in messages:
+            group = groups.setdefault(row['chat_id'], {'chat_id': row['chat_id'], 'messages': [], 'hasMore': False})
+            if row['position'] > SYNC_MESSAGES_PER_CHAT:
+                group['hasMore'] = True
+            else:
+                group['messages'].append(payloads.build(row))
+        result['messages'] = list(groups.values())
+    return result
@@ -1,3 +1,1269 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+import jwt
+import logging
+from asgiref.sync import async_to_sync
+from django.apps import apps as django_apps
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from server.asgi import application
+from server.database import SQLITE_CONN_MAX_AGE, ReadReplicaRouter, read_only, replica_iterator, sqlite_database
+from server import metrics
+from server.log import KeyValueFormatter
+from server.profiling import ProfileSpool, StackSampler, request_profiler
+from social_app.benchmarks import SEED_PASSWORD, seed_dataset, skewed_counts
+from social_app.events import event_log
+from social_app.fanout import chat_members, publish_to_chat_members
+from social_app.layers import BrokerChannelLayer, ChannelBroker, read_frame
+from social_app.models import Chat, ChatMembership, Message, UserEvent, MAX_MESSAGES_PAGE_SIZE
+from social_app.payloads import INBOX_FIELDS, MESSAGE_FIELDS, MessagePayloads, inbox_payloads
+from social_app.presence import PresenceTracker, presence_tracker
+from social_app.recent import recent_messages
+from social_app.search import BasicSearchBackend, SQLiteFTSBackend, build_message_search
+from social_app.serializers import InboxSerializer, MessageSerializer
+from social_app.writebehind import MessageWriteBuffer, write_messages
+from users_app.cache import auth_cache
+from users_app.models import User
+from users_app.passwords import password_hasher
 
-# Create your tests here.
+def make_user(first_name, email=None):
+    return User.objects.create(first_name=first_name, last_name='Tester', email=email or f'{first_name.lower()}@example.com', password='x', date_of_birth=datetime.date(1990, 1, 1), gender='other', last_activity=timezone.now())
+
+def make_token(user):
+    return jwt.encode({'user_id': user.id}, settings.SECRET_KEY, algorithm='HS256')
+
+def auth_header(user):
+    return {'HTTP_AUTHORIZATION': f'Bearer {make_token(user)}'}
+
+async def receive_event(socket):
+    # Sockets open with a session frame and presence updates arrive whenever a contact
+    # connects; skip them to reach the event under test.
+    while True:
+        frame = await socket.receive_json_from()
+        if frame['type'] not in ('presence', 'session'):
+            return frame
+
+async def open_session(socket):
+    await socket.connect()
+    return await socket.receive_json_from()
+
+class SocialTestCase(TestCase):
+    def setUp(self):
+        # Row ids are reused once a test's transaction rolls back, so cached rows must not outlive a test.
+        auth_cache.clear()
+        chat_members.clear()
+        presence_tracker.clear()
+        event_log.clear()
+        recent_messages.clear()
+
+class ChatMessagesPaginationTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+        self.messages = [Message.objects.create_message(self.alice if i % 2 else self.bob, self.chat, f'message {i}') for i in range(12)]
+
+    def get_page(self, **params):
+        response = self.client.get(f'/securetalk/api/social/chats/{self.chat.id}/messages', params, **auth_header(self.alice))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_newest_page_is_returned_oldest_first(self):
+        page = self.get_page(limit=5)
+        self.assertEqual([m['id'] for m in page['messages']], [m.id for m in self.messages[-5:]])
+        self.assertTrue(page['hasMore'])
+
+    def test_before_and_after_cursors_walk_the_history(self):
+        newest = self.get_page(limit=5)
+        older = self.get_page(limit=5, before=newest['before'])
+        self.assertEqual([m['id'] for m in older['messages']], [m.id for m in self.messages[2:7]])
+        oldest = self.get_page(limit=5, before=older['before'])
+        self.assertEqual([m['id'] for m in oldest['messages']], [m.id for m in self.messages[:2]])
+        self.assertFalse(oldest['hasMore'])
+        newer = self.get_page(limit=3, after=older['after'])
+        self.assertEqual([m['id'] for m in newer['messages']], [m.id for m in self.messages[7:10]])
+
+    def test_messages_with_identical_timestamps_are_not_skipped(self):
+        Message.objects.filter(chat=self.chat).update(created_at=self.messages[0].created_at)
+        seen = []
+        cursor = None
+        while True:
+            page = self.get_page(limit=4, **({'before': cursor} if cursor else {}))
+            seen = [m['id'] for m in page['messages']] + seen
+            cursor = page['before']
+            if not page['hasMore']:
+                break
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+    def test_page_size_is_capped(self):
+        page = self.get_page(limit=100000)
+        self.assertEqual(len(page['messages']), 12)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(f'/securetalk/api/social/chats/{self.chat.id}/messages', {'before': 'garbage'}, **auth_header(self.alice))
+        self.assertEqual(response.status_code, 400)
+
+class InboxTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.contacts = [make_user(f'Contact{i}') for i in range(6)]
+        self.chats = [Chat.objects.create_chat(contact, self.alice) for contact in self.contacts]
+
+    def get_inbox(self, user, **params):
+        response = self.client.get('/securetalk/api/social/chats', params, **auth_header(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_inbox_is_sorted_by_recent_activity(self):
+        Message.objects.create_message(self.contacts[2], self.chats[2], 'hello')
+        Message.objects.create_message(self.contacts[4], self.chats[4], 'hi there')
+        chats = self.get_inbox(self.alice)['chats']
+        self.assertEqual([c['id'] for c in chats[:2]], [self.chats[4].id, self.chats[2].id])
+        self.assertEqual(chats[0]['chatName'], self.contacts[4].full_name())
+        self.assertEqual(chats[0]['last_message'], 'hi there')
+        self.assertEqual(chats[0]['unreadCount'], 1)
+        self.assertEqual(sorted(u['id'] for u in chats[0]['users']), sorted([self.alice.id, self.contacts[4].id]))
+
+    def test_unread_count_is_cleared_by_the_read_path(self):
+        Message.objects.create_message(self.contacts[0], self.chats[0], 'one')
+        Message.objects.create_message(self.contacts[0], self.chats[0], 'two')
+        Message.objects.create_message(self.alice, self.chats[0], 'three')
+        self.assertEqual(self.get_inbox(self.alice)['chats'][0]['unreadCount'], 2)
+        self.assertEqual(self.get_inbox(self.contacts[0])['chats'][0]['unreadCount'], 1)
+        self.client.post(f'/securetalk/api/social/chats/{self.chats[0].id}/messages/mark_as_read', **auth_header(self.alice))
+        self.assertEqual(self.get_inbox(self.alice)['chats'][0]['unreadCount'], 0)
+
+    def test_inbox_pages_cost_a_constant_number_of_queries(self):
+        header = auth_header(self.alice)
+        # user lookup (then cached), ETag validators and members' activity, memberships page, chat users
+        with self.assertNumQueries(5):
+            first = self.client.get('/securetalk/api/social/chats', {'limit': 4}, **header).json()
+        with self.assertNumQueries(4):
+            second = self.client.get('/securetalk/api/social/chats', {'limit': 4, 'before': first['before']}, **header).json()
+        self.assertEqual(len(first['chats']), 4)
+        self.assertEqual(len(second['chats']), 2)
+        self.assertFalse(second['hasMore'])
+        self.assertEqual({c['id'] for c in first['chats'] + second['chats']}, {c.id for c in self.chats})
+
+    def test_contact_profile_changes_reach_the_inbox(self):
+        User.objects.update_profile_picture(self.contacts[1], 'https://example.com/new.jpg')
+        chat = next(c for c in self.get_inbox(self.alice)['chats'] if c['id'] == self.chats[1].id)
+        self.assertEqual(chat['contactImage'], 'https://example.com/new.jpg')
+
+class ConditionalGetTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+        Message.objects.create_message(self.bob, self.chat, 'hello')
+
+    def get(self, path, user, **extra):
+        return self.client.get(f'/securetalk/api/social/{path}', **auth_header(user), **extra)
+
+    def assertRevalidates(self, path, change, num_queries=1):
+        first = self.get(path, self.alice)
+        self.assertEqual(first.status_code, 200)
+        # The unchanged re-fetch: index searches only, no payload.
+        with CaptureQueriesContext(connection) as queries:
+            unchanged = self.get(path, self.alice, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.content, b'')
+        self.assertEqual(len(queries), num_queries)
+        for query in queries:
+            plan = ' '.join(str(row[-1]) for row in connection.cursor().execute('EXPLAIN QUERY PLAN ' + query['sql']).fetchall())
+            self.assertRegex(plan, r'^SEARCH .* USING (COVERING )?INDEX')
+        self.assertNotEqual(self.get(path, self.bob, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        change()
+        changed = self.get(path, self.alice, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertIn('private', changed['Cache-Control'])
+        self.assertNotIn('Last-Modified', changed)
+        self.assertEqual(self.get(path, self.alice, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60)).status_code, 200)
+
+    def test_inbox_revalidates_until_a_message_arrives(self):
+        # The second query reads the members' activity, for their presence.
+        self.assertRevalidates('chats', lambda: Message.objects.create_message(self.bob, self.chat, 'again'), num_queries=2)
+
+    def test_contacts_coming_online_invalidate_the_inbox(self):
+        User.objects.filter(id__in=[self.alice.id, self.bob.id]).update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        self.assertRevalidates('chats', lambda: presence_tracker.connect(self.bob.id), num_queries=2)
+        bob, = [user for user in self.get('chats', self.alice).json()['chats'][0]['users'] if user['id'] == self.bob.id]
+        self.assertTrue(bob['is_online'])
+
+    def test_history_revalidates_until_a_member_reads_it(self):
+        Message.objects.create_message(self.alice, self.chat, 'mine')
+        # Bob reading changes the status of Alice's messages.
+        self.assertRevalidates(f'chats/{self.chat.id}/messages', lambda: ChatMembership.objects.mark_read(self.chat, self.bob))
+
+    def test_own_profile_changes_invalidate_the_inbox(self):
+        # The inbox lists every chat's users, the viewer included.
+        self.assertRevalidates('chats', lambda: User.objects.update_user_data(self.alice, {'firstName': 'Alicia', 'lastName': 'Tester', 'dateOfBirth': '1990-01-01', 'gender': 'other'}), num_queries=2)
+
+    def test_contact_profile_changes_invalidate_the_history(self):
+        self.assertRevalidates(f'chats/{self.chat.id}/messages', lambda: User.objects.update_profile_picture(self.bob, 'https://example.com/b.jpg'))
+
+class ContactsTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.viewer = make_user('Viewer')
+        self.zoe = User.objects.create(first_name='Zoë', last_name="O'Brien", email='zoe@example.com', password='x', date_of_birth=datetime.date(1990, 1, 1), gender='other')
+        for name in ['Adam', 'Beth', 'Carl', 'Dana', 'Eve']:
+            make_user(name)
+
+    def get_contacts(self, **params):
+        response = self.client.get('/securetalk/api/social/contacts', params, **auth_header(self.viewer))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_contacts_are_paged_alphabetically(self):
+        names, page = [], self.get_contacts(limit=3)
+        names += [u['first_name'] for u in page['users']]
+        while page['hasMore']:
+            page = self.get_contacts(limit=3, after=page['after'])
+            names += [u['first_name'] for u in page['users']]
+        self.assertEqual(names, ['Adam', 'Beth', 'Carl', 'Dana', 'Eve', 'Viewer', 'Zoë'])
+        previous = self.get_contacts(limit=3, before=page['before'])
+        self.assertEqual([u['first_name'] for u in previous['users']], ['Dana', 'Eve', 'Viewer'])
+
+    def test_search_matches_name_prefixes_ignoring_case_and_accents(self):
+        self.assertEqual([u['id'] for u in self.get_contacts(q='ZOE')['users']], [self.zoe.id])
+        self.assertEqual([u['id'] for u in self.get_contacts(q="o'brien z")['users']], [self.zoe.id])
+        self.assertEqual(self.get_contacts(q='oe')['users'], [])
+
+    def test_search_stays_in_sync_with_profile_updates(self):
+        User.objects.update_user_data(self.zoe, {'firstName': 'Zara', 'lastName': 'Quinn', 'dateOfBirth': '1990-01-01', 'gender': 'other'})
+        self.assertEqual(self.get_contacts(q='zoe')['users'], [])
+        self.assertEqual([u['id'] for u in self.get_contacts(q='quinn')['users']], [self.zoe.id])
+
+    def test_contacts_say_who_is_online(self):
+        User.objects.update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        presence_tracker.connect(self.zoe.id)
+        with self.assertNumQueries(2):
+            users = self.get_contacts()['users']
+        self.assertEqual([u['id'] for u in users if u['is_online']], [self.zoe.id])
+        self.assertTrue(self.get_contacts(q='zoe')['users'][0]['is_online'])
+
+    def test_search_is_an_index_range_scan(self):
+        query = User.objects.filter(search_name__gte='ad', search_name__lt='ad\U0010ffff').order_by('search_name', 'id')[:10]
+        self.assertIn('user_search_name_idx', query.explain())
+
+class MessageSearchTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = make_user('Alice'), make_user('Bob'), make_user('Carol')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+        self.other_chat = Chat.objects.create_chat(self.bob, self.carol)
+        Message.objects.create_message(self.alice, self.chat, 'Lunch at the café tomorrow?')
+        self.best = Message.objects.create_message(self.bob, self.chat, 'lunch lunch lunch, definitely lunch')
+        Message.objects.create_message(self.carol, self.other_chat, 'lunch plans with Bob')
+        Message.objects.create_message(self.alice, self.chat, 'unrelated')
+
+    def search(self, user, **params):
+        response = self.client.get('/securetalk/api/social/messages/search', params, **auth_header(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_results_are_ranked_and_scoped_to_the_users_chats(self):
+        results = self.search(self.alice, q='lunch')['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['message']['id'], self.best.id)
+        self.assertIn('<mark>lunch</mark>', results[0]['snippet'])
+        self.assertEqual({r['chat_id'] for r in results}, {self.chat.id})
+        self.assertEqual(len(self.search(self.bob, q='lunch')['results']), 3)
+        self.assertEqual(len(self.search(self.bob, q='lunch', chat_id=self.other_chat.id)['results']), 1)
+
+    def test_accents_prefixes_and_stray_syntax(self):
+        self.assertEqual(len(self.search(self.alice, q='cafe')['results']), 1)
+        self.assertEqual(len(self.search(self.alice, q='tomor')['results']), 1)
+        self.assertEqual(self.search(self.alice, q='"lunch* (')['results'][0]['message']['id'], self.best.id)
+
+    def test_cursor_walks_every_result_once(self):
+        seen, page = [], self.search(self.bob, q='lunch', limit=1)
+        seen += [r['message']['id'] for r in page['results']]
+        while page['hasMore']:
+            page = self.search(self.bob, q='lunch', limit=1, after=page['after'])
+            seen += [r['message']['id'] for r in page['results']]
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_snippets_escape_the_message_text(self):
+        Message.objects.create_message(self.alice, self.chat, '<script>alert(1)</script> <mark>picnic</mark> \ue000picnic')
+        snippet = self.search(self.alice, q='picnic')['results'][0]['snippet']
+        self.assertEqual(snippet, '&lt;script&gt;alert(1)&lt;/script&gt; &lt;mark&gt;<mark>picnic</mark>&lt;/mark&gt; picnic')
+
+    def test_backend_follows_the_database_engine(self):
+        engine = 'django.db.backends.postgresql'
+        with override_settings(DATABASES={'default': dict(settings.DATABASES['default'], ENGINE=engine)}):
+            self.assertIsInstance(build_message_search(), BasicSearchBackend)
+            with override_settings(MESSAGE_SEARCH={'BACKEND': 'fts5'}):
+                self.assertIsInstance(build_message_search(), SQLiteFTSBackend)
+        self.assertIsInstance(build_message_search(), SQLiteFTSBackend)
+
+class ReadWatermarkTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+        self.messages = [Message.objects.create_message(self.bob, self.chat, f'unread {i}') for i in range(50)]
+
+    def test_marking_as_read_is_a_single_update(self):
+        # conditional UPDATE, then reading back the watermark
+        with self.assertNumQueries(2):
+            watermark = Chat.objects.mark_chat_messages_as_read(self.chat, self.alice)
+        self.assertEqual(watermark, self.messages[-1].id)
+
+    def test_watermark_never_moves_backwards(self):
+        ChatMembership.objects.mark_read(self.chat, self.alice, up_to=self.messages[30].id)
+        self.assertEqual(ChatMembership.objects.mark_read(self.chat, self.alice, up_to=self.messages[10].id), self.messages[30].id)
+        self.assertIsNone(ChatMembership.objects.mark_read(self.chat, make_user('Mallory')))
+
+    def test_status_and_unread_count_follow_the_watermark(self):
+        ChatMembership.objects.mark_read(self.chat, self.alice, up_to=self.messages[19].id)
+        response = self.client.get(f'/securetalk/api/social/chats/{self.chat.id}/messages', {'limit': 50}, **auth_header(self.bob))
+        statuses = [m['status'] for m in response.json()['messages']]
+        self.assertEqual(statuses, ['read'] * 20 + ['sent'] * 30)
+        inbox = self.client.get('/securetalk/api/social/chats', **auth_header(self.alice)).json()
+        self.assertEqual(inbox['chats'][0]['unreadCount'], 30)
+
+class PayloadTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.carol = make_user('Carol')
+        User.objects.update_profile_picture(self.bob, 'https://example.com/bob.jpg')
+        self.chats = [Chat.objects.create_chat(self.alice, self.bob), Chat.objects.create_chat(self.carol, self.alice), Chat.objects.create_chat(self.alice, self.alice)]
+        for i in range(6):
+            Message.objects.create_message(self.bob if i % 2 else self.alice, self.chats[0], f'message {i} ✓')
+        Message.objects.create_message(self.carol, self.chats[1], 'hi')
+        ChatMembership.objects.mark_read(self.chats[0], self.bob, up_to=Message.objects.filter(chat=self.chats[0]).order_by('id')[2].id)
+
+    def assertSameJson(self, expected, actual):
+        # Byte for byte, so key order and number/date formatting match as well.
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+    def test_message_payloads_match_the_serializer(self):
+        for time_zone in ('UTC', 'Asia/Hebron'):
+            with self.subTest(time_zone=time_zone), override_settings(TIME_ZONE=time_zone):
+                messages, _ = Chat.objects.get_chat_messages(self.chats[0].id)
+                rows, _ = Chat.objects.get_chat_messages(self.chats[0].id, fields=MESSAGE_FIELDS)
+                expected = MessageSerializer(messages, many=True, context={'current_user_id': self.alice.id}).data
+                self.assertSameJson(expected, MessagePayloads(self.alice.id).build_many(rows))
+                self.assertEqual({m['status'] for m in expected}, {'read', 'sent'})
+
+    def test_inbox_payloads_match_the_serializer(self):
+        memberships, _ = ChatMembership.objects.get_inbox(self.alice)
+        rows, _ = ChatMembership.objects.get_inbox(self.alice, fields=INBOX_FIELDS)
+        expected = InboxSerializer(memberships, many=True).data
+        for chat in expected:
+            chat['users'] = [dict(user, is_online=user['id'] == self.bob.id) for user in sorted(chat['users'], key=lambda user: user['id'])]
+        User.objects.update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        presence_tracker.connect(self.bob.id)
+        self.assertSameJson(expected, inbox_payloads(rows))
+
+class StreamingTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.contacts = [make_user(f'Contact{i}') for i in range(5)]
+        self.chats = [Chat.objects.create_chat(self.alice, contact) for contact in self.contacts]
+        self.messages = [Message.objects.create_message(self.contacts[i % 5], self.chats[i % 5], f'message {i}') for i in range(12)]
+
+    def get(self, path, **params):
+        response = self.client.get(f'/securetalk/api/social/{path}', params, **auth_header(self.alice))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def stream(self, path, **params):
+        response = self.get(path, stream=1, **params)
+        self.assertTrue(response.streaming)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_streams_match_the_pages(self):
+        chat = self.chats[0]
+        page = self.get(f'chats/{chat.id}/messages').json()
+        streamed = self.stream(f'chats/{chat.id}/messages')
+        self.assertEqual(streamed, dict(page, hasMore=False))
+        inbox = self.get('chats').json()
+        self.assertEqual(self.stream('chats'), dict(inbox, hasMore=False))
+        contacts = self.get('contacts').json()
+        self.assertEqual(self.stream('contacts'), dict(contacts, hasMore=False))
+
+    def test_streams_resume_from_a_cursor(self):
+        chat = self.chats[1]
+        newest = self.get(f'chats/{chat.id}/messages', limit=2).json()
+        rest = self.stream(f'chats/{chat.id}/messages', after=newest['before'])
+        self.assertEqual([m['content'] for m in rest['messages']], ['message 11'])
+        older = self.stream('chats', before=self.get('chats', limit=2).json()['before'])
+        self.assertEqual(len(older['chats']), 3)
+        empty = self.stream('contacts', after=self.stream('contacts')['after'])
+        self.assertEqual(empty, {'users': [], 'hasMore': False, 'before': None, 'after': None})
+        response = self.client.get(f'/securetalk/api/social/chats/{chat.id}/messages', {'stream': 1, 'before': rest['before']}, **auth_header(self.alice))
+        self.assertEqual(response.status_code, 400)
+
+class SyncTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.carol = make_user('Carol')
+        self.with_bob = Chat.objects.create_chat(self.alice, self.bob)
+        self.with_carol = Chat.objects.create_chat(self.alice, self.carol)
+        for i in range(30):
+            Message.objects.create_message(self.bob, self.with_bob, f'old {i}')
+        Message.objects.create_message(self.alice, self.with_carol, 'hi carol')
+        # Everything so far happened long before the client's last sync.
+        long_ago = timezone.now() - datetime.timedelta(days=1)
+        ChatMembership.objects.update(updated_at=long_ago)
+        Message.objects.update(updated_at=long_ago)
+        self.cursor = self.sync(self.alice)['cursor']
+
+    def sync(self, user, **params):
+        response = self.client.get('/securetalk/api/social/sync', params, **auth_header(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_first_sync_asks_for_a_full_reload(self):
+        first = self.sync(self.alice)
+        self.assertTrue(first['fullResync'])
+        self.assertEqual(first['chats'], [])
+        self.assertFalse(self.sync(self.alice, cursor=first['cursor'])['fullResync'])
+
+    def test_only_changes_since_the_cursor_are_returned(self):
+        new = Message.objects.create_message(self.bob, self.with_bob, 'new')
+        ChatMembership.objects.mark_read(self.with_carol, self.carol)
+        changes = self.sync(self.alice, cursor=self.cursor)
+        self.assertFalse(changes['fullResync'])
+        self.assertEqual([c['id'] for c in changes['chats']], [self.with_bob.id])
+        self.assertEqual(changes['chats'][0]['unreadCount'], 31)
+        self.assertEqual(len(changes['messages']), 1)
+        self.assertEqual(changes['messages'][0]['chat_id'], self.with_bob.id)
+        self.assertEqual([(m['id'], m['content'], m['status']) for m in changes['messages'][0]['messages']], [(new.id, 'new', 'sent')])
+        # Carol's read shows up although Alice's own row for that chat did not change.
+        hi_carol = Message.objects.get(content='hi carol')
+        self.assertIn({'chat_id': self.with_carol.id, 'user_id': self.carol.id, 'last_read_message_id': hi_carol.id}, changes['reads'])
+
+    def test_a_long_gap_is_capped_per_chat(self):
+        # As if all of Bob's messages had arrived while Alice was away.
+        Message.objects.filter(chat=self.with_bob).update(updated_at=timezone.now())
+        ChatMembership.objects.filter(chat=self.with_bob).update(updated_at=timezone.now())
+        with mock.patch('social_app.sync.SYNC_MESSAGES_PER_CHAT', 10):
+            changes = self.sync(self.alice, cursor=self.cursor)
+        group = changes['messages'][0]
+        self.assertTrue(group['hasMore'])
+        self.assertEqual([m['content'] for m in group['messages']], [f'old {i}' for i in range(20, 30)])
+
+    def test_cost_does_not_grow_with_history(self):
+        Message.objects.create_message(self.bob, self.with_bob, 'new')
+        # user lookup is cached; changed chats, their members, read states, messages, watermarks
+        self.sync(self.alice, cursor=self.cursor)
+        with self.assertNumQueries(5):
+            self.sync(self.alice, cursor=self.cursor)
+        with mock.patch('social_app.sync.MAX_SYNC_CHATS', 0):
+            self.assertTrue(self.sync(self.alice, cursor=self.cursor)['fullResync'])
+
+    def test_cursors_are_per_user(self):
+        response = self.client.get('/securetalk/api/social/sync', {'cursor': self.cursor}, **auth_header(self.bob))
+        self.assertEqual(response.status_code, 400)
+
+class DirectChatTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('Alice'), make_user('Bob')
+
+    def create(self, user, contact):
+        return self.client.post('/securetalk/api/social/chats/create', json.dumps({'contactId': contact.id}), content_type='application/json', **auth_header(user))
+
+    def test_either_member_gets_the_same_chat(self):
+        created = self.create(self.alice, self.bob)
+        existing = self.create(self.bob, self.alice)
+        self.assertEqual((created.status_code, existing.status_code), (201, 200))
+        self.assertEqual(created.json()['chat']['id'], existing.json()['chat']['id'])
+        self.assertEqual(Chat.objects.get().direct_key, f'{self.alice.id}:{self.bob.id}')
+        self.assertIn('USING INDEX', Chat.objects.filter(direct_key=Chat.objects.get().direct_key).explain())
+
+    def test_a_creation_that_loses_the_race_returns_the_winner(self):
+        winner = Chat.objects.create_chat(self.bob, self.alice)
+        with mock.patch.object(Chat.objects, 'get_direct_chat', return_value=None):
+            chat, created = Chat.objects.get_or_create_direct_chat(self.alice, self.bob)
+        self.assertEqual((chat.id, created), (winner.id, False))
+        self.assertEqual((Chat.objects.count(), ChatMembership.objects.count()), (1, 2))
+
+    def test_migration_merges_duplicate_chats(self):
+        fill_direct_keys = importlib.import_module('social_app.migrations.0009_chat_direct_key').fill_direct_keys
+        first, second = Chat.objects.create_chat(self.alice, self.bob), Chat.objects.create_chat(self.alice, make_user('Carol'))
+        # A duplicate as simultaneous requests used to create it.
+        Chat.objects.filter(id=second.id).update(direct_key=None)
+        second.users.set([self.alice, self.bob])
+        ChatMembership.objects.filter(chat=second).delete()
+        ChatMembership.objects.create_memberships(second, [self.alice, self.bob])
+        Chat.objects.filter(id=first.id).update(direct_key=None)
+        older = Message.objects.create_message(self.alice, first, 'in the first chat')
+        read = Message.objects.create_message(self.bob, second, 'read')
+        newer = Message.objects.create_message(self.bob, first, 'unread')
+        ChatMembership.objects.mark_read(second, self.alice)
+
+        fill_direct_keys(django_apps, None)
+        chat = Chat.objects.get()
+        self.assertEqual((chat.id, chat.direct_key), (first.id, f'{self.alice.id}:{self.bob.id}'))
+        self.assertEqual(list(Message.objects.filter(chat=chat).values_list('id', flat=True).order_by('id')), [older.id, read.id, newer.id])
+        self.assertEqual(ChatMembership.objects.read_watermarks(chat)[self.alice.id], read.id)
+        self.assertEqual(set(ChatMembership.objects.filter(chat=chat).values_list('last_message_id', flat=True)), {newer.id})
+
+class CreateMessageTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user('Alice')
+        self.bob = make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+
+    def test_only_the_preview_columns_of_the_chat_are_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            message = Message.objects.create_message(self.alice, self.chat, 'hello')
+        chat_writes = [q['sql'] for q in queries if 'social_app_chat"' in q['sql'] and not q['sql'].startswith('SELECT')]
+        self.assertEqual(len(chat_writes), 1)
+        self.assertNotIn('created_at', chat_writes[0])
+        chat = Chat.objects.get()
+        self.assertEqual((chat.last_message, chat.last_message_id), ('hello', message.id))
+
+    def test_a_late_writer_does_not_replace_a_newer_preview(self):
+        first = Message.objects.create_message(self.alice, self.chat, 'first')
+        second = Message.objects.create_message(self.bob, self.chat, 'second')
+        # What a sender whose transaction commits after a newer one would attempt.
+        self.assertEqual(Chat.objects.record_message(first), 0)
+        ChatMembership.objects.record_message(first)
+        self.assertEqual(Chat.objects.get().last_message_id, second.id)
+        self.assertEqual(set(ChatMembership.objects.values_list('last_message', flat=True)), {'second'})
+
+class PresenceTests(SocialTestCase):
+    def test_activity_is_written_in_one_batched_update(self):
+        alice, bob, carol = make_user('Alice'), make_user('Bob'), make_user('Carol')
+        User.objects.filter(id__in=[alice.id, bob.id, carol.id]).update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        with self.assertNumQueries(0):
+            presence_tracker.connect(alice.id)
+            User.objects.update_user_activity(bob)
+        with self.assertNumQueries(1):
+            self.assertEqual(presence_tracker.flush(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(presence_tracker.online_users([alice.id]), {alice.id})
+        # Bob's flushed heartbeat counts for other workers; Carol has been away too long.
+        response = self.client.get('/securetalk/api/social/presence', {'ids': f'{alice.id},{bob.id},{carol.id}'}, **auth_header(alice))
+        self.assertEqual(response.json()['online'], sorted([alice.id, bob.id]))
+
+class PresenceFlushTests(TransactionTestCase):
+    def test_http_heartbeats_are_flushed_without_a_socket(self):
+        alice = make_user('Alice')
+        User.objects.filter(id=alice.id).update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        tracker = PresenceTracker(flush_interval=0.05, online_window=90)
+        tracker.heartbeat(alice.id)
+        flusher = tracker.flusher
+        flusher.join(timeout=5)
+        # Nothing left to write, so the flusher stopped; the next heartbeat starts another.
+        self.assertFalse(flusher.is_alive())
+        self.assertIsNone(tracker.flusher)
+        self.assertEqual(tracker.online_users([alice.id]), {alice.id})
+
+class SeedDataTests(SocialTestCase):
+    def test_seeded_data_is_consistent_and_usable(self):
+        self.assertEqual(sum(skewed_counts(1000, 30, random.Random(1))), 1000)
+        with mock.patch.object(password_hasher, 'rounds', 4):
+            result = seed_dataset(12, 20, 400, prefix='seedtest')
+        self.assertEqual(result, {'users': 12, 'chats': 20, 'group_chats': 4, 'messages': 400})
+        self.assertEqual(Message.objects.count(), 400)
+        sizes = sorted(chat.users.count() for chat in Chat.objects.filter(direct_key__isnull=True))
+        self.assertEqual(len(sizes), 4)
+        self.assertTrue(all(3 <= size <= 12 for size in sizes))
+        self.assertEqual(ChatMembership.objects.filter(chat__direct_key__isnull=True).count(), sum(sizes))
+        for chat in Chat.objects.all():
+            newest = Message.objects.filter(chat=chat).order_by('-id').first()
+            self.assertEqual(chat.last_message_id, newest.id if newest else 0)
+            self.assertEqual(set(ChatMembership.objects.filter(chat=chat).values_list('last_message_id', flat=True)), {chat.last_message_id})
+        response = self.client.post('/securetalk/api/users/login', json.dumps({'email': 'seedtest0@example.com', 'password': SEED_PASSWORD}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # The search index is rebuilt after the bulk load.
+        hits, _ = Message.objects.search(ChatMembership.objects.filter(last_message_id__gt=0).first().user, 'message')
+        self.assertTrue(hits)
+
+    def test_too_few_users_for_a_chat(self):
+        self.assertEqual(skewed_counts(10, 0, random.Random(1)), [])
+        with mock.patch.object(password_hasher, 'rounds', 4):
+            self.assertEqual(seed_dataset(1, 5, 100, prefix='lonely'), {'users': 1, 'chats': 0, 'group_chats': 0, 'messages': 0})
+
+class DatabaseProfileTests(TestCase):
+    def test_read_only_views_read_from_the_replica(self):
+        router = ReadReplicaRouter()
+        seen = read_only(lambda: (router.db_for_read(Message), router.db_for_write(Message)))
+        self.assertEqual(seen(), ('default', 'default'))
+        with mock.patch.dict(settings.DATABASES, replica=sqlite_database(':memory:', read_only=True)):
+            self.assertEqual(seen(), ('replica', 'default'))
+            self.assertEqual(router.db_for_read(Message), 'default')
+            steps = replica_iterator(router.db_for_read(Message) for _ in range(2))
+            self.assertEqual(list(steps), ['replica', 'replica'])
+
+    def test_production_profile(self):
+        writer, reader = sqlite_database('db.sqlite3'), sqlite_database('db.sqlite3', read_only=True)
+        self.assertEqual(writer['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertIn('PRAGMA journal_mode=WAL', writer['OPTIONS']['init_command'])
+        self.assertNotIn('query_only', writer['OPTIONS']['init_command'])
+        self.assertIn('PRAGMA query_only=1', reader['OPTIONS']['init_command'])
+        self.assertEqual(reader['CONN_MAX_AGE'], SQLITE_CONN_MAX_AGE)
+
+class MetricsTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+
+    def test_requests_are_recorded_per_view(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        Chat.objects.create_chat(alice, bob)
+        self.client.get('/securetalk/api/social/chats', **auth_header(alice))
+        view = 'social_app.views.get_chats'
+        self.assertGreater(metrics.http_request_seconds.values[(view, 'GET', 200)][-1], 0)
+        queries = metrics.http_request_queries.values[(view,)]
+        self.assertEqual(sum(queries[:-1]), 1)
+        self.assertGreater(queries[-1], 0)
+        self.assertGreater(metrics.http_response_bytes.values[(view,)][-1], 0)
+
+        with override_settings(METRICS_ALLOWED_NETWORKS=['127.0.0.0/8']):
+            response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        text = response.content.decode()
+        self.assertIn('# TYPE securetalk_http_request_seconds histogram', text)
+        self.assertIn(f'securetalk_http_request_seconds_count{{view="{view}",method="GET",status="200"}} 1', text)
+        self.assertIn(f'securetalk_http_request_seconds_bucket{{view="{view}",method="GET",status="200",le="+Inf"}} 1', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('sizes', "Sizes.", ('kind',), buckets=(1, 10))
+        for value in (0.5, 5, 5, 50):
+            histogram.observe(value, kind='a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP sizes Sizes.',
+            '# TYPE sizes histogram',
+            'sizes_bucket{kind="a\\"b",le="1"} 1',
+            'sizes_bucket{kind="a\\"b",le="10"} 3',
+            'sizes_bucket{kind="a\\"b",le="+Inf"} 4',
+            'sizes_sum{kind="a\\"b"} 60.5',
+            'sizes_count{kind="a\\"b"} 4',
+        ])
+
+    def test_metrics_need_a_token_or_an_allowed_network(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='192.0.2.1').status_code, 403)
+
+    def test_log_lines_carry_extra_fields(self):
+        record = logging.LogRecord('social_app.consumers', logging.ERROR, __file__, 1, "Error in %s", ('send_chat_message',), None)
+        record.user_id = 7
+        line = KeyValueFormatter().format(record)
+        self.assertIn('level=ERROR logger=social_app.consumers message="Error in send_chat_message" user_id=7', line)
+
+class ProfilingTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('Alice'), make_user('Bob')
+        self.admin = make_user('Admin')
+        User.objects.filter(id=self.admin.id).update(is_admin=True)
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool = ProfileSpool(directory.name, 200, 10 * 1024 * 1024)
+        patcher = mock.patch.multiple(request_profiler, spool=self.spool, enabled=True, user_ids=frozenset({self.alice.id}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_are_profiled_for_chosen_users_and_admin_headers(self):
+        self.client.post(f'/securetalk/api/social/chats/{self.chat.id}/new_message', json.dumps({'content': 'hi'}), content_type='application/json', **auth_header(self.alice))
+        self.client.get('/securetalk/api/social/chats', HTTP_X_PROFILE='1', **auth_header(self.bob))
+        self.client.get('/securetalk/api/social/chats', HTTP_X_PROFILE='1', **auth_header(self.admin))
+        created, inbox = reversed(self.spool.list())
+        self.assertEqual((created['view'], created['trigger'], created['user_id']), ('social_app.views.create_chat_message', 'user', self.alice.id))
+        self.assertEqual(created['sections']['MessageSerializer']['calls'], 1)
+        self.assertEqual((inbox['view'], inbox['trigger'], inbox['user_id']), ('social_app.views.get_chats', 'header', self.admin.id))
+        with mock.patch.object(request_profiler, 'enabled', False):
+            self.client.get('/securetalk/api/social/chats', **auth_header(self.alice))
+        self.assertEqual(len(self.spool.list()), 2)
+
+    def test_payload_builders_are_timed(self):
+        self.client.post(f'/securetalk/api/social/chats/{self.chat.id}/new_message', json.dumps({'content': 'hi'}), content_type='application/json', **auth_header(self.bob))
+        self.client.get('/securetalk/api/social/chats', **auth_header(self.alice))
+        self.client.get(f'/securetalk/api/social/chats/{self.chat.id}/messages', **auth_header(self.alice))
+        messages, inbox = self.spool.list()
+        self.assertEqual(inbox['view'], 'social_app.views.get_chats')
+        self.assertEqual(inbox['sections']['inbox_payloads']['calls'], 1)
+        self.assertEqual(messages['view'], 'social_app.views.get_chat_messages')
+        self.assertEqual(messages['sections']['MessagePayloads']['calls'], 1)
+
+    def test_sampler_records_the_stacks_below_its_root(self):
+        def busy():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+
+        def root():
+            sampler = StackSampler(threading.get_ident(), sys._getframe(), 0.001)
+            sampler.start()
+            busy()
+            sampler.stop()
+            return sampler.stacks
+
+        stacks = root()
+        self.assertGreater(sum(stacks.values()), 0)
+        self.assertTrue(all(stack.startswith('social_app.tests:ProfilingTests.test_sampler_records_the_stacks_below_its_root.<locals>.root') for stack in stacks))
+        self.assertTrue(any(stack.endswith('<locals>.busy') for stack in stacks))
+
+    def test_admins_list_and_download_profiles(self):
+        profile_id = self.spool.save({'view': 'v', 'stacks': {'a;b': 3, 'a': 1}})
+        self.assertEqual(self.client.get('/securetalk/api/admin/profiles', **auth_header(self.alice)).status_code, 403)
+        listed = self.client.get('/securetalk/api/admin/profiles', **auth_header(self.admin)).json()['profiles']
+        self.assertEqual(listed, [{'id': profile_id, 'view': 'v'}])
+        folded = self.client.get(f'/securetalk/api/admin/profiles/{profile_id}?format=folded', **auth_header(self.admin))
+        self.assertEqual(folded.content.decode(), 'a;b 3\na 1\n')
+        self.assertEqual(self.client.get(f'/securetalk/api/admin/profiles/{profile_id}', **auth_header(self.admin)).json()['stacks'], {'a;b': 3, 'a': 1})
+        self.assertEqual(self.client.get('/securetalk/api/admin/profiles/..%2Fsecret', **auth_header(self.admin)).status_code, 404)
+
+    def test_spool_keeps_the_newest_profiles(self):
+        spool = ProfileSpool(self.spool.directory, 3, 10 * 1024 * 1024)
+        ids = [spool.save({'n': n}) for n in range(5)]
+        self.assertEqual([profile['n'] for profile in spool.list()], [4, 3, 2])
+        with self.assertRaises(KeyError):
+            spool.load(ids[0])
+
+class RecentMessagesTests(SocialTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        self.alice, self.bob = make_user('Alice'), make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+
+    def newest_page(self, user, chat=None, **params):
+        response = self.client.get(f'/securetalk/api/social/chats/{(chat or self.chat).id}/messages', params, **auth_header(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def assert_matches_database(self, limit):
+        for user in (self.alice, self.bob):
+            cached = self.newest_page(user, limit=limit)
+            with mock.patch.object(recent_messages, 'enabled', False):
+                self.assertEqual(cached, self.newest_page(user, limit=limit))
+
+    def results(self):
+        return {key[0]: value for key, value in metrics.registry.metrics['securetalk_recent_messages_requests_total'].values.items()}
+
+    def test_cached_pages_match_the_database_path(self):
+        rng = random.Random(0)
+        with mock.patch.object(recent_messages, 'ring_size', 20):
+            for step in range(100):
+                action = rng.random()
+                sender = rng.choice([self.alice, self.bob])
+                if action < 0.9:
+                    with self.captureOnCommitCallbacks(execute=True):
+                        if action < 0.4:
+                            Message.objects.create_message(sender, self.chat, f'message {step}')
+                        elif action < 0.6:
+                            Message.objects.create_messages([(sender.id, self.chat.id, f'batch {step} {i}') for i in range(3)])
+                        else:
+                            ChatMembership.objects.mark_read(self.chat, sender)
+                elif rng.random() < 0.5:
+                    # Writes from another process, which this cache never hears about.
+                    Message.objects.create_message(sender, self.chat, f'elsewhere {step}')
+                else:
+                    ChatMembership.objects.filter(chat=self.chat, user=sender).update(last_read_message_id=Message.objects.filter(chat=self.chat).latest('id').id)
+                # Not after every step, so local writes also land on entries that missed one.
+                if rng.random() < 0.5:
+                    self.assert_matches_database(rng.choice([1, 5, 20]))
+            self.assert_matches_database(20)
+        results = self.results()
+        self.assertGreater(results['hit'], results['miss'])
+
+    def test_hits_only_query_the_membership_version(self):
+        for i in range(3):
+            Message.objects.create_message(self.alice, self.chat, f'message {i}')
+        first = self.newest_page(self.bob)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.newest_page(self.bob), first)
+        self.assertEqual(self.results(), {'miss': 1, 'hit': 1})
+        self.newest_page(self.bob, limit=MAX_MESSAGES_PAGE_SIZE)
+        self.assertEqual(self.results()['bypass'], 1)
+
+    def test_least_recently_used_chats_are_evicted_over_budget(self):
+        carol = make_user('Carol')
+        chats = [self.chat, Chat.objects.create_chat(self.alice, carol), Chat.objects.create_chat(self.bob, carol)]
+        for chat in chats:
+            Message.objects.create_message(chat.users.first(), chat, 'x' * 1000)
+        with mock.patch.object(recent_messages, 'max_bytes', 2 * recent_messages.fill(self.chat.id).size):
+            recent_messages.clear()
+            for chat in chats:
+                self.newest_page(chat.users.first(), chat)
+            self.assertEqual(list(recent_messages.entries), [chats[1].id, chats[2].id])
+        self.assertEqual(metrics.registry.metrics['securetalk_recent_messages_evictions_total'].values, {(): 1})
+        self.assertIn('securetalk_recent_messages_chats 2', metrics.registry.render())
+
+class WebsocketTestCase(TransactionTestCase):
+    def setUp(self):
+        auth_cache.clear()
+        chat_members.clear()
+        presence_tracker.clear()
+        event_log.clear()
+        recent_messages.clear()
+
+class ReadEventsOverWebsocketTests(WebsocketTestCase):
+    def test_mark_all_as_read_moves_the_watermark_and_is_broadcast(self):
+        alice = make_user('Alice')
+        bob = make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+        message = Message.objects.create_message(bob, chat, 'hello')
+
+        async def exchange():
+            listener = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(bob)}')
+            reader = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(alice)}')
+            await listener.connect()
+            await reader.connect()
+            await reader.send_json_to({'type': 'mark_all_as_read', 'chat_id': chat.id})
+            event = await receive_event(listener)
+            await listener.disconnect()
+            await reader.disconnect()
+            return event
+
+        event = async_to_sync(exchange)()
+        self.assertEqual(event['type'], 'mark_all_as_read')
+        self.assertEqual(event['user_id'], alice.id)
+        self.assertEqual(event['last_read_message_id'], message.id)
+        self.assertEqual(ChatMembership.objects.read_watermarks(chat)[alice.id], message.id)
+
+    def test_a_bad_message_id_is_answered_with_an_error(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+        message = Message.objects.create_message(bob, chat, 'hello')
+
+        async def exchange():
+            reader = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(alice)}')
+            await reader.connect()
+            errors = []
+            for message_id in ('abc', None, True):
+                await reader.send_json_to({'type': 'mark_as_read', 'chat_id': chat.id, 'client_id': 'read', 'message_id': message_id})
+                errors.append(await receive_event(reader))
+            # The socket is still open and reads by a valid id.
+            await reader.send_json_to({'type': 'mark_as_read', 'chat_id': chat.id, 'message_id': str(message.id)})
+            event = await receive_event(reader)
+            await reader.disconnect()
+            return errors, event
+
+        errors, event = async_to_sync(exchange)()
+        self.assertEqual(errors, [{'type': 'error', 'client_id': 'read', 'error': 'A valid message_id is required'}] * 3)
+        self.assertEqual((event['type'], event['message_id'], event['last_read_message_id']), ('mark_as_read', message.id, message.id))
+
+class SendMessageOverWebsocketTests(WebsocketTestCase):
+    def test_send_is_acked_with_the_stored_message_and_fanned_out(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+
+        async def exchange():
+            home = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(bob)}')
+            sender = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(alice)}')
+            await home.connect()
+            await sender.connect()
+            await sender.send_json_to({'type': 'send_message', 'client_id': 'local-1', 'content': 'hello'})
+            await sender.send_json_to({'type': 'send_message', 'client_id': 'local-2', 'content': ''})
+            # The sender's own socket also gets the new_message echo, in no fixed order with the error.
+            frames = {frame['type']: frame for frame in [await receive_event(sender) for _ in range(3)]}
+            event = await receive_event(home)
+            await sender.disconnect()
+            await home.disconnect()
+            return frames['ack'], frames['error'], event
+
+        ack, error, event = async_to_sync(exchange)()
+        message = Message.objects.get()
+        self.assertEqual((ack['type'], ack['client_id'], ack['chat_id']), ('ack', 'local-1', chat.id))
+        self.assertEqual(ack['message']['id'], message.id)
+        self.assertTrue(ack['message']['isFromCurrentUser'])
+        self.assertEqual(ack['message']['status'], 'sent')
+        self.assertEqual((error['type'], error['client_id']), ('error', 'local-2'))
+        self.assertEqual((event['type'], event['message']['id']), ('new_message', message.id))
+        self.assertEqual(Chat.objects.get().last_message, 'hello')
+        self.assertEqual(ChatMembership.objects.get(chat=chat, user=bob).last_message, 'hello')
+
+    def test_concurrent_sends_share_a_transaction(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+        writer = MessageWriteBuffer()
+
+        async def send_many():
+            return await asyncio.gather(*(writer.submit(alice.id, chat.id, f'message {i}') for i in range(50)))
+
+        messages = async_to_sync(send_many)()
+        self.assertEqual([m.content for m in messages], [f'message {i}' for i in range(50)])
+        self.assertEqual(len({m.id for m in messages}), 50)
+        self.assertEqual(writer.batches, 1)
+        self.assertEqual(ChatMembership.objects.get(chat=chat, user=bob).last_message, 'message 49')
+        # Their events were numbered in the same transaction, in send order.
+        self.assertEqual([m.event[1] for m in messages], [{alice.id: i, bob.id: i} for i in range(1, 51)])
+        self.assertEqual([seq for seq, _ in event_log.since(bob.id, 0)], list(range(1, 51)))
+        self.assertEqual(UserEvent.objects.count(), 100)
+
+    def test_a_failed_batch_is_retried_then_written_one_by_one(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+        writer = MessageWriteBuffer()
+        calls = []
+
+        def flaky_write(messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            if any(content == 'bad' for _, _, content in messages):
+                raise ValueError('bad message')
+            return write_messages(messages)
+
+        async def send(contents):
+            return await asyncio.gather(*(writer.submit(alice.id, chat.id, content) for content in contents), return_exceptions=True)
+
+        with mock.patch('social_app.writebehind.write_messages', flaky_write), self.assertLogs('social_app.writebehind', 'WARNING'):
+            retried = async_to_sync(send)(['one', 'two'])
+            calls.clear()
+            results = async_to_sync(send)(['three', 'bad', 'four'])
+        self.assertEqual([m.content for m in retried], ['one', 'two'])
+        # The retry succeeded the first time; the batch with a bad row did not.
+        self.assertEqual(calls, [3, 3, 1, 1, 1])
+        self.assertEqual([results[0].content, results[2].content], ['three', 'four'])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ['one', 'two', 'three', 'four'])
+
+class PresenceEventsTests(WebsocketTestCase):
+    def test_contacts_see_the_first_socket_open_and_the_last_close(self):
+        alice, bob, carol = make_user('Alice'), make_user('Bob'), make_user('Carol')
+        Chat.objects.create_chat(alice, bob)
+
+        async def exchange():
+            watcher = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(bob)}')
+            stranger = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(carol)}')
+            await open_session(watcher)
+            await open_session(stranger)
+            phone = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(alice)}')
+            tablet = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(alice)}')
+            await phone.connect()
+            came_online = await watcher.receive_json_from()
+            await tablet.connect()
+            await phone.disconnect()
+            still_online = await watcher.receive_nothing()
+            await tablet.disconnect()
+            went_offline = await watcher.receive_json_from()
+            stranger_saw_nothing = await stranger.receive_nothing()
+            await watcher.disconnect()
+            await stranger.disconnect()
+            return came_online, still_online, went_offline, stranger_saw_nothing
+
+        came_online, still_online, went_offline, stranger_saw_nothing = async_to_sync(exchange)()
+        self.assertEqual((came_online['type'], came_online['user_id'], came_online['online']), ('presence', alice.id, True))
+        self.assertTrue(still_online)
+        self.assertEqual((went_offline['user_id'], went_offline['online']), (alice.id, False))
+        self.assertTrue(stranger_saw_nothing)
+
+class StreamingOverAsgiTests(WebsocketTestCase):
+    def test_history_is_sent_in_pieces(self):
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+        Message.objects.create_messages([(alice.id, chat.id, f'message {i}') for i in range(1200)])
+
+        async def fetch():
+            http = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': f'/securetalk/api/social/chats/{chat.id}/messages',
+                'query_string': b'stream=1', 'headers': [(b'host', b'localhost'), (b'authorization', f'Bearer {make_token(alice)}'.encode())],
+            })
+            await http.send_input({'type': 'http.request', 'body': b''})
+            start = await http.receive_output(10)
+            pieces = []
+            while True:
+                message = await http.receive_output(10)
+                pieces.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    return start, pieces
+
+        start, pieces = async_to_sync(fetch)()
+        self.assertEqual(start['status'], 200)
+        # Opening bracket, three chunks of rows and the closing keys.
+        self.assertGreaterEqual(len([piece for piece in pieces if piece]), 5)
+        messages = json.loads(b''.join(pieces))['messages']
+        self.assertEqual([m['content'] for m in messages], [f'message {i}' for i in range(1200)])
+
+class FanOutTests(WebsocketTestCase):
+    def test_events_reach_only_the_members_of_the_chat(self):
+        alice, bob, carol = make_user('Alice'), make_user('Bob'), make_user('Carol')
+        chat = Chat.objects.create_chat(alice, bob)
+        Chat.objects.create_chat(carol, bob)
+
+        async def exchange():
+            homes = {user.id: WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(user)}') for user in (alice, bob, carol)}
+            for home in homes.values():
+                await open_session(home)
+            sender = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(alice)}')
+            await sender.connect()
+            await sender.send_json_to({'type': 'send_message', 'client_id': 'local-1', 'content': 'hi'})
+            await receive_event(sender)
+            received = {user_id: await receive_event(home) for user_id, home in homes.items() if user_id != carol.id}
+            carol_got_nothing = await homes[carol.id].receive_nothing()
+            for socket in [sender, *homes.values()]:
+                await socket.disconnect()
+            return received, carol_got_nothing
+
+        received, carol_got_nothing = async_to_sync(exchange)()
+        self.assertEqual({event['chat_id'] for event in received.values()}, {chat.id})
+        self.assertTrue(carol_got_nothing)
+
+    def test_sockets_need_a_token_and_membership(self):
+        alice, bob, carol = make_user('Alice'), make_user('Bob'), make_user('Carol')
+        chat = Chat.objects.create_chat(alice, bob)
+
+        async def attempts():
+            anonymous = WebsocketCommunicator(application, '/ws/socket-server/home/')
+            outsider = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(carol)}')
+            return (await anonymous.connect())[0], (await outsider.connect())[0]
+
+        self.assertEqual(async_to_sync(attempts)(), (False, False))
+
+class SessionResumeTests(WebsocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('Alice'), make_user('Bob')
+        self.chat = Chat.objects.create_chat(self.alice, self.bob)
+
+    def home(self, user, last_seq=None):
+        query = f'token={make_token(user)}' + ('' if last_seq is None else f'&last_seq={last_seq}')
+        return WebsocketCommunicator(application, f'/ws/socket-server/home/?{query}')
+
+    def frame(self, text):
+        return {'type': 'new_message', 'chat_id': self.chat.id, 'message': {'content': text}}
+
+    def test_numbers_are_per_user_and_without_gaps(self):
+        self.assertEqual(event_log.append([self.alice.id, self.bob.id], self.frame('one')), {self.alice.id: 1, self.bob.id: 1})
+        self.assertEqual(event_log.append([self.bob.id], self.frame('two')), {self.bob.id: 2})
+        self.assertEqual(event_log.since(self.bob.id, 0), [(1, self.frame('one')), (2, self.frame('two'))])
+        event_log.clear()
+        with self.assertNumQueries(2):
+            self.assertEqual(event_log.since(self.bob.id, 1), [(2, self.frame('two'))])
+        self.assertEqual(event_log.since(self.alice.id, 1), [])
+
+    def test_a_reconnecting_socket_is_sent_what_it_missed(self):
+        async def exchange():
+            home = self.home(self.bob)
+            opened = await open_session(home)
+            await home.disconnect()
+            sender = WebsocketCommunicator(application, f'/ws/socket-server/{self.chat.id}/?token={make_token(self.alice)}')
+            await sender.connect()
+            for text in ('first', 'second'):
+                await sender.send_json_to({'type': 'send_message', 'client_id': text, 'content': text})
+                await receive_event(sender)
+                await receive_event(sender)
+            await sender.disconnect()
+            home = self.home(self.bob, last_seq=opened['seq'])
+            await home.connect()
+            replayed = [await home.receive_json_from() for _ in range(3)]
+            await home.disconnect()
+            return opened, replayed
+
+        opened, replayed = async_to_sync(exchange)()
+        self.assertEqual(opened, {'type': 'session', 'seq': 0})
+        self.assertEqual([(f['type'], f['seq']) for f in replayed], [('new_message', 1), ('new_message', 2), ('session', 2)])
+        self.assertEqual([f['message']['content'] for f in replayed[:2]], ['first', 'second'])
+
+    def test_a_socket_fills_a_skipped_number_from_the_log(self):
+        async def exchange():
+            home = self.home(self.bob)
+            await open_session(home)
+            # An event numbered but never delivered, as when a worker dies mid-send.
+            await database_sync_to_async(event_log.append)([self.bob.id], self.frame('lost'))
+            await publish_to_chat_members(get_channel_layer(), self.chat.id, self.frame('live'))
+            frames = [await home.receive_json_from() for _ in range(2)]
+            nothing_else = await home.receive_nothing()
+            await home.disconnect()
+            return frames, nothing_else
+
+        frames, nothing_else = async_to_sync(exchange)()
+        self.assertEqual([(f['message']['content'], f['seq']) for f in frames], [('lost', 1), ('live', 2)])
+        self.assertTrue(nothing_else)
+
+    def test_old_events_are_pruned_in_the_background(self):
+        event_log.append([self.bob.id], self.frame('old'))
+        UserEvent.objects.update(created_at=timezone.now() - event_log.retention - datetime.timedelta(seconds=1))
+        with mock.patch.multiple(event_log, prune_every=2, appends=1), mock.patch('social_app.events.threading.Thread') as thread:
+            event_log.append([self.bob.id], self.frame('new'))
+        # The send path only starts the prune.
+        thread.assert_called_once_with(target=event_log.prune_in_background, name='event-log-prune', daemon=True)
+        thread.return_value.start.assert_called_once_with()
+        self.assertEqual(UserEvent.objects.count(), 2)
+        event_log.prune_in_background()
+        self.assertFalse(event_log.pruning)
+        self.assertEqual(list(UserEvent.objects.values_list('seq', flat=True)), [2])
+
+    def test_a_gap_that_cannot_be_replayed_asks_for_a_resync(self):
+        for text in ('one', 'two', 'three'):
+            event_log.append([self.bob.id], self.frame(text))
+        event_log.clear()
+        UserEvent.objects.filter(seq=1).delete()
+
+        async def reconnect(last_seq):
+            home = self.home(self.bob, last_seq=last_seq)
+            await home.connect()
+            frame = await home.receive_json_from()
+            await home.disconnect()
+            return frame
+
+        self.assertEqual(async_to_sync(reconnect)(0), {'type': 'resync_required', 'seq': 3})
+        self.assertEqual(async_to_sync(reconnect)(1)['seq'], 2)
+        self.assertEqual(async_to_sync(reconnect)(9), {'type': 'resync_required', 'seq': 3})
+
+BROKER_WORKER = """
+import asyncio, json, sys, time
+from social_app.layers import BrokerChannelLayer
+
+async def work(path, index, expected):
+    layer = BrokerChannelLayer(path, capacity=expected)
+    channel = await layer.new_channel()
+    await layer.group_add('workers', channel)
+    await layer.group_add(f'worker_{index}', channel)
+    print('ready', flush=True)
+    started = None
+    for _ in range(expected):
+        message = await layer.receive(channel)
+        started = started or time.perf_counter()
+    print(json.dumps([index, message['origin'], expected, time.perf_counter() - started]), flush=True)
+
+asyncio.run(work(sys.argv[1], int(sys.argv[2]), int(sys.argv[3])))
+"""
+
+class SocketMetricsTests(WebsocketTestCase):
+    def test_consumer_events_and_connections_are_recorded(self):
+        metrics.registry.clear()
+        alice, bob = make_user('Alice'), make_user('Bob')
+        chat = Chat.objects.create_chat(alice, bob)
+
+        async def exchange():
+            home = WebsocketCommunicator(application, f'/ws/socket-server/home/?token={make_token(bob)}')
+            sender = WebsocketCommunicator(application, f'/ws/socket-server/{chat.id}/?token={make_token(alice)}')
+            await home.connect()
+            await sender.connect()
+            await sender.send_json_to({'type': 'send_message', 'client_id': 'local-1', 'content': 'hello'})
+            await sender.send_json_to({'type': 'bogus'})
+            await receive_event(home)
+            # Both sockets have handled a frame, so both are past go_online.
+            connected = dict(metrics.socket_connections.values)
+            await sender.disconnect()
+            await home.disconnect()
+            return connected
+
+        connected = async_to_sync(exchange)()
+        self.assertEqual(connected, {('HomeConsumer',): 1, ('ChatConsumer',): 1})
+        self.assertEqual(metrics.socket_connections.values, {('HomeConsumer',): 0, ('ChatConsumer',): 0})
+        sends = metrics.socket_event_queries.values[('ChatConsumer', 'receive.send_message')]
+        self.assertGreater(sends[-1], 0)
+        self.assertIn(('ChatConsumer', 'receive.unknown'), metrics.socket_event_seconds.values)
+        self.assertIn(('HomeConsumer', 'chat_event'), metrics.socket_event_seconds.values)
+        self.assertIn(('ChatConsumer', 'in'), metrics.socket_frame_bytes.values)
+        self.assertIn(('HomeConsumer', 'out'), metrics.socket_frame_bytes.values)
+        self.assertEqual(metrics.fanout_groups.values[('new_message',)][-1], 2)
+        self.assertIn('securetalk_online_users 0', metrics.registry.render())
+
+class BrokerChannelLayerTests(TestCase):
+    workers = 4
+    messages = 2000
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'channels.sock')
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(ChannelBroker(self.path).start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        async def shutdown():
+            self.server.close()
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_requests_fail_instead_of_waiting_forever_for_an_ack(self):
+        path = os.path.join(tempfile.mkdtemp(), 'silent.sock')
+
+        async def exchange():
+            connections = []
+
+            async def handle(reader, writer):
+                # Reads frames and never acks; the second connection is dropped after the hello.
+                connections.append(writer)
+                try:
+                    await read_frame(reader)
+                    while len(connections) == 1:
+                        await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    pass
+                writer.close()
+
+            server = await asyncio.start_unix_server(handle, path=path)
+            layer = BrokerChannelLayer(path, ack_timeout=0.2)
+            channel = await layer.new_channel()
+            with self.assertRaises(asyncio.TimeoutError):
+                await layer.group_add('chat', channel)
+            self.assertEqual(layer.acks, {})
+            await layer.close()
+            with self.assertRaises(ConnectionError):
+                await layer.group_discard('chat', channel)
+            self.assertEqual(layer.acks, {})
+            server.close()
+
+        asyncio.run(exchange())
+
+    def test_group_messages_reach_every_worker_process(self):
+        processes = [
+            subprocess.Popen([sys.executable, '-c', BROKER_WORKER, self.path, str(i), str(self.messages + 1)], cwd=settings.BASE_DIR, stdout=subprocess.PIPE, text=True)
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            self.assertEqual(process.stdout.readline().strip(), 'ready')
+
+        async def publish():
+            layer = BrokerChannelLayer(self.path)
+            started = time.perf_counter()
+            for i in range(self.messages):
+                await layer.group_send('workers', {'type': 'bench', 'origin': 'publisher'})
+            # one message per worker, addressed through each worker's own group in a single batch
+            await layer.group_send_batch([(f'worker_{i}', {'type': 'bench', 'origin': 'batch'}) for i in range(self.workers)])
+            await layer.close()
+            return time.perf_counter() - started
+
+        elapsed = asyncio.run(publish())
+        received = [json.loads(process.communicate(timeout=30)[0]) for process in processes]
+
+        self.assertEqual(sorted(index for index, _, _, _ in received), list(range(self.workers)))
+        self.assertTrue(all(origin == 'batch' and count == self.messages + 1 for _, origin, count, _ in received))
+        throughput = self.workers * self.messages / max(elapsed, max(seconds for _, _, _, seconds in received))
+        self.assertGreater(throughput, 1000)
@@ -1,37 +1,128 @@
 from django.http import JsonResponse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 import json
+import logging
 from users_app.authentication import authenticate
-from users_app.models import User
+from users_app.models import User, CONTACTS_PAGE_SIZE, MAX_CONTACTS_PAGE_SIZE
+from social_app.presence import MAX_PRESENCE_LOOKUP, presence_tracker
 from users_app.serializers import *
 from social_app.serializers import *
-from social_app.models import Chat
+from social_app.models import Chat, ChatMembership, MESSAGES_PAGE_SIZE, MAX_MESSAGES_PAGE_SIZE, CHATS_PAGE_SIZE, MAX_CHATS_PAGE_SIZE, MAX_MESSAGE_LENGTH, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
+from social_app.payloads import FastJsonResponse, MessagePayloads, CONTACT_FIELDS, INBOX_FIELDS, MESSAGE_FIELDS, inbox_payloads, user_payload, with_presence
+from social_app.conditional import conditional_on_memberships
+from social_app.recent import recent_messages
+from server.database import read_only
+from server.profiling import profiled
+from social_app.sync import changes_since, decode_sync_cursor
+from social_app.streaming import StreamingJsonResponse, stream_envelope, wants_stream
+from social_app.pagination import InvalidCursor, encode_cursor, decode_cursor, parse_limit
+
+logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @authenticate
+@profiled
+@read_only
 def get_contacts(request):
     try:
-        users = User.objects.get_all_users()
+        query = request.GET.get('q', '').strip()
+        limit = parse_limit(request.GET.get('limit'), CONTACTS_PAGE_SIZE, MAX_CONTACTS_PAGE_SIZE)
+        if query:
+            # Searches return the best `limit` matches; there is no further page.
+            users = User.objects.search(query, limit=limit)
+            return JsonResponse({'users': with_presence(UserSerializer(users, many=True).data, {user.id: user.last_activity for user in users}), 'hasMore': False}, status=200)
+        before = request.GET.get('before')
+        after = request.GET.get('after')
+        if wants_stream(request):
+            # The whole directory from `after` on, written as it is read.
+            if before:
+                raise InvalidCursor("A stream continues from an after cursor")
+            rows = User.objects.iter_contacts(CONTACT_FIELDS, after=decode_cursor(after, 'str', 'int') if after else None)
+            return StreamingJsonResponse(request, stream_envelope('users', rows, lambda chunk: with_presence([user_payload(row) for row in chunk], {row['id']: row['last_activity'] for row in chunk}), lambda first, last: {
+                'hasMore': False,
+                'before': encode_cursor(first['search_name'], first['id']) if first else None,
+                'after': encode_cursor(last['search_name'], last['id']) if last else None,
+            }), status=200)
+        users, has_more = User.objects.get_contacts_page(
+            before=decode_cursor(before, 'str', 'int') if before else None,
+            after=decode_cursor(after, 'str', 'int') if after else None,
+            limit=limit,
+        )
         serializer = UserSerializer(users, many=True)
-        return JsonResponse({'users': serializer.data}, status=200)
-    except Exception as e:
-        print(f"Error in get_contacts: {str(e)}")
+        return JsonResponse({
+            'users': with_presence(serializer.data, {user.id: user.last_activity for user in users}),
+            'hasMore': has_more,
+            'before': encode_cursor(users[0].search_name, users[0].id) if users else None,
+            'after': encode_cursor(users[-1].search_name, users[-1].id) if users else None,
+        }, status=200)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception:
+        logger.exception("Error in get_contacts")
         return JsonResponse({'error': 'Failed to fetch users'}, status=500)
 
 @csrf_exempt
 @authenticate
+@profiled
+@read_only
+@cache_control(private=True, no_cache=True)
+# The inbox shows whether each member is online, which no membership records:
+# revalidating it takes a second query, for the members' activity.
+@conditional_on_memberships(lambda request: {'user': request.user}, lambda request: sorted(presence_tracker.online_among(ChatMembership.objects.member_activity(request.user))))
 def get_chats(request):
     try:
-        user = User.objects.get_user(request.user_id)
-        chats = Chat.objects.get_user_active_chats(user)
-        serializer = ChatSerializer(chats, many=True, context={'request': request})
-        return JsonResponse({'chats': serializer.data}, status=200)
-    except Exception as e:
-        print(f"Error in get_chats: {str(e)}")
+        before = request.GET.get('before')
+        after = request.GET.get('after')
+        if wants_stream(request):
+            # Every chat from `before` on, most recent first, written as it is read.
+            if after:
+                raise InvalidCursor("A stream continues from a before cursor")
+            rows = ChatMembership.objects.iter_inbox(request.user, INBOX_FIELDS, before=decode_cursor(before, 'datetime', 'int') if before else None)
+            return StreamingJsonResponse(request, stream_envelope('chats', rows, inbox_payloads, lambda first, last: {
+                'hasMore': False,
+                'before': encode_cursor(last['last_activity_at'], last['id']) if last else None,
+                'after': encode_cursor(first['last_activity_at'], first['id']) if first else None,
+            }), status=200)
+        rows, has_more = ChatMembership.objects.get_inbox(
+            request.user,
+            before=decode_cursor(before, 'datetime', 'int') if before else None,
+            after=decode_cursor(after, 'datetime', 'int') if after else None,
+            limit=parse_limit(request.GET.get('limit'), CHATS_PAGE_SIZE, MAX_CHATS_PAGE_SIZE),
+            fields=INBOX_FIELDS,
+        )
+        # Same shape as InboxSerializer, built straight from rows.
+        return FastJsonResponse({
+            'chats': inbox_payloads(rows),
+            'hasMore': has_more,
+            'before': encode_cursor(rows[-1]['last_activity_at'], rows[-1]['id']) if rows else None,
+            'after': encode_cursor(rows[0]['last_activity_at'], rows[0]['id']) if rows else None,
+        }, status=200)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception:
+        logger.exception("Error in get_chats")
         return JsonResponse({'error': 'Failed to fetch chats'}, status=500)
 
 @csrf_exempt
 @authenticate
+@profiled
+def get_presence(request):
+    try:
+        raw_ids = [part for part in request.GET.get('ids', '').split(',') if part]
+        if not all(part.isdigit() for part in raw_ids):
+            return JsonResponse({'error': 'ids must be a comma separated list of user ids'}, status=400)
+        if len(raw_ids) > MAX_PRESENCE_LOOKUP:
+            return JsonResponse({'error': f'At most {MAX_PRESENCE_LOOKUP} ids per lookup'}, status=400)
+        online = User.objects.online_user_ids({int(part) for part in raw_ids})
+        return JsonResponse({'online': sorted(online)}, status=200)
+    except Exception:
+        logger.exception("Error in get_presence")
+        return JsonResponse({'error': 'Failed to fetch presence'}, status=500)
+
+@csrf_exempt
+@authenticate
+@profiled
 def create_chat(request):
     try:
         data = json.loads(request.body)
@@ -43,23 +134,15 @@ def create_chat(request):
         user = request.user
         contact = User.objects.get(id=contact_id)
         
-        # Check if a chat already exists between these users
-        existing_chats = Chat.objects.filter(users=user).filter(users=contact)
-        
-        if existing_chats.exists():
-            # Return the existing chat
-            chat = existing_chats.first()
-            serializer = ChatSerializer(chat, context={'request': request})
+        chat, created = Chat.objects.get_or_create_direct_chat(contact, user)
+        serializer = ChatSerializer(chat, context={'request': request})
+        if not created:
             return JsonResponse({
                 'message': 'Chat already exists', 
                 'chat': serializer.data, 
                 'isNew': False
             }, status=200)
         
-        # Create a new chat
-        chat = Chat.objects.create_chat(contact, user)
-        serializer = ChatSerializer(chat, context={'request': request})
-        
         return JsonResponse({
             'message': 'Chat created successfully', 
             'chat': serializer.data,
@@ -69,24 +152,68 @@ def create_chat(request):
     except User.DoesNotExist:
         return JsonResponse({'error': 'User not found'}, status=404)
     except Exception as e:
-        print(f"Error in create_chat: {str(e)}")
+        logger.exception("Error in create_chat")
         return JsonResponse({'error': f'Failed to create chat: {str(e)}'}, status=500)
     
 @csrf_exempt
 @authenticate
+@profiled
+@read_only
+@cache_control(private=True, no_cache=True)
+@conditional_on_memberships(lambda request, chat_id: {'chat_id': chat_id})
 def get_chat_messages(request, chat_id):
     try:
-        messages = Chat.objects.get_chat_messages(chat_id)
-        serializer = MessageSerializer(messages, many=True, context={'request': request})
-        return JsonResponse({'messages': serializer.data}, status=200)
+        before = request.GET.get('before')
+        after = request.GET.get('after')
+        if wants_stream(request):
+            # The whole history from `after` on, oldest first, written as it is read.
+            if before:
+                raise InvalidCursor("A stream continues from an after cursor")
+            rows = Chat.objects.iter_chat_messages(chat_id, MESSAGE_FIELDS, after=decode_cursor(after, 'datetime', 'int') if after else None)
+            payloads = MessagePayloads(request.user.id, {chat_id: ChatMembership.objects.read_watermarks(chat_id)})
+            return StreamingJsonResponse(request, stream_envelope('messages', rows, payloads.build_many, lambda first, last: {
+                'hasMore': False,
+                'before': encode_cursor(first['created_at'], first['id']) if first else None,
+                'after': encode_cursor(last['created_at'], last['id']) if last else None,
+            }), status=200)
+        limit = parse_limit(request.GET.get('limit'), MESSAGES_PAGE_SIZE, MAX_MESSAGES_PAGE_SIZE)
+        if not before and not after:
+            # The newest page is what reopening a chat asks for; see social_app.recent.
+            page = recent_messages.newest_page(chat_id, request.membership_version, request.user.id, limit)
+            if page is not None:
+                payloads, has_more, first, last = page
+                return FastJsonResponse({
+                    'messages': payloads,
+                    'hasMore': has_more,
+                    'before': encode_cursor(first.created_at, first.id) if first else None,
+                    'after': encode_cursor(last.created_at, last.id) if last else None,
+                }, status=200)
+        messages, has_more = Chat.objects.get_chat_messages(
+            chat_id,
+            before=decode_cursor(before, 'datetime', 'int') if before else None,
+            after=decode_cursor(after, 'datetime', 'int') if after else None,
+            limit=limit,
+            fields=MESSAGE_FIELDS,
+        )
+        # Same shape as MessageSerializer, built straight from rows.
+        payloads = MessagePayloads(request.user.id, {chat_id: ChatMembership.objects.read_watermarks(chat_id)})
+        return FastJsonResponse({
+            'messages': payloads.build_many(messages),
+            'hasMore': has_more,
+            'before': encode_cursor(messages[0]['created_at'], messages[0]['id']) if messages else None,
+            'after': encode_cursor(messages[-1]['created_at'], messages[-1]['id']) if messages else None,
+        }, status=200)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Chat.DoesNotExist:
         return JsonResponse({'error': 'Chat not found'}, status=404)
-    except Exception as e:
-        print(f"Error in get_chat_messages: {str(e)}")
+    except Exception:
+        logger.exception("Error in get_chat_messages")
         return JsonResponse({'error': 'Failed to fetch messages'}, status=500)
 
 @csrf_exempt
 @authenticate
+@profiled
 def mark_chat_messages_as_read(request, chat_id):
     try:
         user = request.user
@@ -95,12 +222,13 @@ def mark_chat_messages_as_read(request, chat_id):
         return JsonResponse({'message': 'Messages marked as read'}, status=200)
     except Chat.DoesNotExist:
         return JsonResponse({'error': 'Chat not found'}, status=404)
-    except Exception as e:
-        print(f"Error in mark_chat_messages_as_read: {str(e)}")
+    except Exception:
+        logger.exception("Error in mark_chat_messages_as_read")
         return JsonResponse({'error': 'Failed to mark messages as read'}, status=500)
 
 @csrf_exempt
 @authenticate
+@profiled
 def create_chat_message(request, chat_id):
     try:
         data = json.loads(request.body)
@@ -108,6 +236,8 @@ def create_chat_message(request, chat_id):
         
         if not content:
             return JsonResponse({'error': 'Message content is required'}, status=400)
+        if len(content) > MAX_MESSAGE_LENGTH:
+            return JsonResponse({'error': 'Message content is too long'}, status=400)
         
         user = request.user
         chat = Chat.objects.get_chat(chat_id)
@@ -119,6 +249,54 @@ def create_chat_message(request, chat_id):
         
     except Chat.DoesNotExist:
         return JsonResponse({'error': 'Chat not found'}, status=404)
-    except Exception as e:
-        print(f"Error in create_chat_message: {str(e)}")
-        return JsonResponse({'error': 'Failed to create message'}, status=500)
\ No newline at end of file
+    except Exception:
+        logger.exception("Error in create_chat_message")
+        return JsonResponse({'error': 'Failed to create message'}, status=500)
+
+@csrf_exempt
+@authenticate
+@profiled
+def search_messages(request):
+    try:
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'error': 'Search query is required'}, status=400)
+        chat_id = request.GET.get('chat_id')
+        if chat_id is not None and not chat_id.isdigit():
+            return JsonResponse({'error': 'Invalid chat id'}, status=400)
+        after = request.GET.get('after')
+        messages, has_more = Message.objects.search(
+            request.user,
+            query,
+            chat_id=int(chat_id) if chat_id else None,
+            after=decode_cursor(after, 'float', 'int') if after else None,
+            limit=parse_limit(request.GET.get('limit'), SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE),
+        )
+        serializer = MessageSerializer(messages, many=True, context={'request': request})
+        return JsonResponse({
+            'results': [
+                {'chat_id': message.chat_id, 'snippet': message.search_snippet, 'message': data}
+                for message, data in zip(messages, serializer.data)
+            ],
+            'hasMore': has_more,
+            'after': encode_cursor(messages[-1].search_rank, messages[-1].id) if messages else None,
+        }, status=200)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception:
+        logger.exception("Error in search_messages")
+        return JsonResponse({'error': 'Failed to search messages'}, status=500)
+
+@csrf_exempt
+@authenticate
+@profiled
+def sync(request):
+    try:
+        cursor = request.GET.get('cursor')
+        changes = changes_since(request.user, decode_sync_cursor(cursor, request.user) if cursor else None)
+        return FastJsonResponse(changes, status=200)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception:
+        logger.exception("Error in sync")
+        return JsonResponse({'error': 'Failed to sync'}, status=500)
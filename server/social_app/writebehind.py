@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import weakref
+from channels.db import database_sync_to_async
+from django.db import transaction
+from social_app.events import event_log
+from social_app.models import ChatMembership, Message
+from social_app.serializers import MessageSerializer
+from users_app.models import User
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_WRITE_BATCH_SIZE = 200
+
+def write_messages(messages):
+    """
+    Stores (sender_id, chat_id, content) messages and numbers their new_message
+    events for the chats' members in the same transaction. Each returned message
+    carries `event`, the (frame, {member id: seq}) to publish once it committed.
+    """
+    with transaction.atomic():
+        created = Message.objects.create_messages(messages)
+        senders = User.objects.in_bulk({message.sender_id for message in created})
+        members = {}
+        for chat_id, user_id in ChatMembership.objects.filter(chat_id__in={message.chat_id for message in created}).values_list('chat_id', 'user_id'):
+            members.setdefault(chat_id, []).append(user_id)
+        frames = []
+        for message in created:
+            message.sender = senders[message.sender_id]
+            # Nobody else has seen a message that was just written, so it has no read watermarks yet.
+            payload = MessageSerializer(message, context={'current_user_id': message.sender_id, 'read_watermarks': {message.chat_id: {}}}).data
+            frames.append({'message': payload, 'type': 'new_message', 'chat_id': message.chat_id})
+        numbered = event_log.append_many([(members.get(message.chat_id, ()), frame) for message, frame in zip(created, frames)])
+    for message, frame, seqs in zip(created, frames, numbered):
+        message.event = (frame, seqs)
+    return created
+
+class MessageWriteBuffer:
+    """
+    Group commit for messages sent over the websocket.
+
+    `submit` queues a message and waits for the transaction that stores it. One writer
+    per event loop drains the queue, and everything that arrived while the previous
+    batch was being written goes into the next transaction. An idle server therefore
+    writes each message immediately, while a busy one shares each commit between up to
+    `max_batch` messages.
+
+    Durability: `submit` returns only once the batch's transaction has committed, so
+    an acknowledged message is exactly as durable as a commit on the database. A
+    message still in the buffer exists only in this process's memory. If the worker
+    dies before the commit, the sender never gets an ack and has to send it again.
+
+    A batch that fails to commit is tried once more, so a transient error such as a
+    locked database does not fail it. If it fails again, its messages are written one
+    transaction each, and only the submits whose own message fails get the error.
+    """
+    def __init__(self, max_batch=MESSAGE_WRITE_BATCH_SIZE):
+        self.max_batch = max_batch
+        self.pending = weakref.WeakKeyDictionary()
+        self.writers = weakref.WeakKeyDictionary()
+        self.batches = 0
+        self.messages = 0
+
+    async def submit(self, sender_id, chat_id, content):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(loop, []).append(((sender_id, chat_id, content), future))
+        writer = self.writers.get(loop)
+        if writer is None or writer.done():
+            self.writers[loop] = loop.create_task(self.drain(self.pending[loop]))
+        return await future
+
+    async def drain(self, pending):
+        while pending:
+            batch = pending[:self.max_batch]
+            del pending[:self.max_batch]
+            messages = [message for message, _ in batch]
+            try:
+                results = await self.write(messages)
+            except Exception:
+                try:
+                    results = await self.write(messages)
+                except Exception:
+                    logger.warning("Message batch failed twice, writing its messages one by one", exc_info=True, extra={'messages': len(messages)})
+                    results = [await self.write_one(message) for message in messages]
+            for (_, future), result in zip(batch, results):
+                # A sender whose socket closed has cancelled its future; the message is stored regardless.
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def write(self, messages):
+        created = await database_sync_to_async(write_messages)(messages)
+        self.batches += 1
+        self.messages += len(created)
+        return created
+
+    async def write_one(self, message):
+        try:
+            return (await self.write([message]))[0]
+        except Exception as error:
+            return error
+
+message_writer = MessageWriteBuffer()
@@ -1,80 +1,159 @@
+import asyncio
 from functools import wraps
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from django.http import JsonResponse
 import jwt
 from django.conf import settings
+from users_app.cache import auth_cache
 from users_app.models import User
 
-def authenticate(view_func):
+def decode_token(token):
+    """
+    Verifies a JWT and returns its user id. Raises jwt.InvalidTokenError (or a subclass) on failure.
+    Tokens that already verified are answered from the auth cache until they expire.
+    """
+    user_id = auth_cache.get_token(token)
+    if user_id is not None:
+        return user_id
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+    user_id = payload.get('user_id')
+    if user_id is not None:
+        auth_cache.set_token(token, user_id, payload.get('exp'))
+    return user_id
+
+def get_authenticated_user(user_id):
+    user = auth_cache.get_user(user_id)
+    if user is None:
+        user = User.objects.get(id=user_id)
+        auth_cache.set_user(user)
+    return user
+
+def authenticate_request(request):
     """
-    Authentication decorator for Django views.
-    
-    This decorator checks for JWT token authentication in:
+    Attaches the authenticated user to `request`, or returns the error response to
+    send instead.
+
+    The token is read from:
     1. Request cookies (for browser clients)
     2. Authorization header (for API/mobile clients)
-    
-    It decodes the token, verifies it, and attaches the user object to the request.
-    If authentication fails, it returns an error response.
+
+    Verified tokens and their users are served from the auth cache when possible.
     """
-    @wraps(view_func)
-    def wrapper(request, *args, **kwargs):
+    try:
+        # First check for token in cookies
+        token = request.COOKIES.get('user_token')
+        
+        # If not in cookies, check Authorization header
+        if not token:
+            auth_header = request.headers.get('Authorization')
+            if auth_header and auth_header.startswith('Bearer '):
+                token = auth_header.split(' ')[1]
+        
+        if not token:
+            return JsonResponse({
+                "message": "Authentication failed",
+                "error": "No token provided"
+            }, status=401)
+        
         try:
-            # First check for token in cookies
-            token = request.COOKIES.get('user_token')
+            # Decode the token
+            user_id = decode_token(token)
             
-            # If not in cookies, check Authorization header
-            if not token:
-                auth_header = request.headers.get('Authorization')
-                if auth_header and auth_header.startswith('Bearer '):
-                    token = auth_header.split(' ')[1]
+            # Get the user and attach both user and user_id to request
+            user = get_authenticated_user(user_id)
+            request.user = user
+            request.user_id = user_id
+            return None
             
-            if not token:
-                return JsonResponse({
-                    "message": "Authentication failed",
-                    "error": "No token provided"
-                }, status=401)
+        except jwt.ExpiredSignatureError:
+            response = JsonResponse({
+                "message": "Authentication failed",
+                "error": "Token has expired"
+            }, status=401)
+            response.delete_cookie('user_token')
+            return response
             
-            try:
-                # Decode the token
-                payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-                user_id = payload.get('user_id')
-                
-                # Get the user and attach both user and user_id to request
-                user = User.objects.get(id=user_id)
-                request.user = user
-                request.user_id = user_id
-                
-                return view_func(request, *args, **kwargs)
-                
-            except jwt.ExpiredSignatureError:
-                response = JsonResponse({
-                    "message": "Authentication failed",
-                    "error": "Token has expired"
-                }, status=401)
-                response.delete_cookie('user_token')
-                return response
-                
-            except jwt.InvalidTokenError:
-                response = JsonResponse({
-                    "message": "Authentication failed",
-                    "error": "Invalid token"
-                }, status=401)
-                response.delete_cookie('user_token')
-                return response
-                
-            except User.DoesNotExist:
-                response = JsonResponse({
-                    "message": "Authentication failed",
-                    "error": "User not found"
-                }, status=401)
-                response.delete_cookie('user_token')
-                return response
-                
-        except Exception as e:
+        except jwt.InvalidTokenError:
             response = JsonResponse({
                 "message": "Authentication failed",
-                "error": str(e)
+                "error": "Invalid token"
             }, status=401)
             response.delete_cookie('user_token')
             return response
-    
-    return wrapper
\ No newline at end of file
+            
+        except User.DoesNotExist:
+            response = JsonResponse({
+                "message": "Authentication failed",
+                "error": "User not found"
+            }, status=401)
+            response.delete_cookie('user_token')
+            return response
+            
+    except Exception as e:
+        response = JsonResponse({
+            "message": "Authentication failed",
+            "error": str(e)
+        }, status=401)
+        response.delete_cookie('user_token')
+        return response
+
+def authenticate(view_func):
+    """
+    Authentication decorator for Django views, sync or async.
+
+    Requests that fail authenticate_request get its error response; the others reach
+    the view with request.user set. For async views the check runs in a thread.
+    """
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            error = await sync_to_async(authenticate_request)(request)
+            if error is not None:
+                return error
+            return await view_func(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        error = authenticate_request(request)
+        if error is not None:
+            return error
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+def admin_only(view_func):
+    """Answers 403 unless the user is an admin. Goes under @authenticate."""
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_admin:
+            return JsonResponse({
+                "message": "Forbidden",
+                "error": "Admins only"
+            }, status=403)
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+class TokenAuthMiddleware:
+    """
+    ASGI middleware for websocket connections.
+
+    Browsers cannot set headers on a websocket handshake, so clients pass their JWT as
+    a `token` query string parameter. A valid token puts the user id in scope['user_id'];
+    otherwise it is None and consumers decide whether to serve the connection.
+    """
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token = query.get('token', [None])[0]
+        user_id = None
+        if token:
+            try:
+                # The auth cache may be memcached or Redis, so keep its lookups off
+                # the event loop. Nothing here touches the database, so any thread will do.
+                user_id = await sync_to_async(decode_token, thread_sensitive=False)(token)
+            except jwt.InvalidTokenError:
+                user_id = None
+        return await self.inner(dict(scope, user_id=user_id), receive, send)
@@ -0,0 +1,159 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULT_AUTH_CACHE = {
+    'BACKEND': 'local',
+    'MAX_ENTRIES': 10000,
+    'TOKEN_TTL': 300,
+    'USER_TTL': 60,
+    'CACHE_ALIAS': 'default',
+}
+
+class LocalBackend:
+    """
+    In-process LRU cache with per-entry expiry. Entries are copied in and out so
+    callers never share a mutable object.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return copy.copy(value)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, copy.copy(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of Django's configured caches, so every worker shares
+    them and an invalidation in one process is seen by all the others.
+
+    The cache may be shared with other code, so keys carry an 'auth:' prefix and a
+    generation number kept in the cache itself. `clear` moves to a new generation
+    instead of flushing the cache: the old entries are no longer read and expire
+    on their own. Workers read the generation again every `generation_refresh`
+    seconds.
+    """
+    generation_key = 'auth:generation'
+
+    def __init__(self, alias, generation_refresh=1):
+        self.cache = caches[alias]
+        self.generation_refresh = generation_refresh
+        self.generation = None
+        self.generation_read_at = 0.0
+
+    def _key(self, key):
+        if self.generation is None or time.monotonic() - self.generation_read_at > self.generation_refresh:
+            generation = self.cache.get(self.generation_key)
+            if generation is None:
+                # Starting from the clock, a generation evicted from the cache is never reused.
+                self.cache.add(self.generation_key, time.time_ns(), None)
+                generation = self.cache.get(self.generation_key)
+            self.generation, self.generation_read_at = generation, time.monotonic()
+        return f'auth:{self.generation}:{key}'
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, ttl):
+        self.cache.set(self._key(key), value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+    def clear(self):
+        try:
+            generation = self.cache.incr(self.generation_key)
+        except ValueError:
+            self.cache.add(self.generation_key, time.time_ns(), None)
+            generation = self.cache.get(self.generation_key)
+        self.generation, self.generation_read_at = generation, time.monotonic()
+
+class AuthCache:
+    """
+    Cache of verified tokens (token -> user id) and of the user rows they resolve to,
+    used by the authenticate decorator so a request normally costs neither a JWT
+    verification nor a user query. Tokens are never cached past their own expiry.
+    User entries must be invalidated whenever a user row changes.
+    """
+    def __init__(self, backend, token_ttl, user_ttl):
+        self.backend = backend
+        self.token_ttl = token_ttl
+        self.user_ttl = user_ttl
+        self.lock = threading.Lock()
+        self.counters = {'token_hits': 0, 'token_misses': 0, 'user_hits': 0, 'user_misses': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_token(self, token):
+        user_id = self.backend.get(self._token_key(token))
+        self._count('token_hits' if user_id is not None else 'token_misses')
+        return user_id
+
+    def set_token(self, token, user_id, expires_at=None):
+        ttl = self.token_ttl
+        if expires_at is not None:
+            ttl = min(ttl, int(expires_at - time.time()))
+        if ttl > 0:
+            self.backend.set(self._token_key(token), user_id, ttl)
+
+    def get_user(self, user_id):
+        user = self.backend.get(f'user:{user_id}')
+        self._count('user_hits' if user is not None else 'user_misses')
+        return user
+
+    def set_user(self, user):
+        self.backend.set(f'user:{user.id}', user, self.user_ttl)
+
+    def invalidate_user(self, user_id):
+        self.backend.delete(f'user:{user_id}')
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _token_key(self, token):
+        return 'token:' + hashlib.sha256(token.encode()).hexdigest()
+
+def build_auth_cache():
+    config = dict(DEFAULT_AUTH_CACHE, **getattr(settings, 'AUTH_CACHE', {}))
+    if config['BACKEND'] == 'django':
+        backend = DjangoCacheBackend(config['CACHE_ALIAS'])
+    else:
+        backend = LocalBackend(config['MAX_ENTRIES'])
+    return AuthCache(backend, config['TOKEN_TTL'], config['USER_TTL'])
+
+auth_cache = build_auth_cache()
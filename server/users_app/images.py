@@ -0,0 +1,117 @@
+import io
+import logging
+import threading
+import uuid
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+from users_app.storage import build_image_storage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_PICTURES = {
+    'SIZE': 500,
+    'WORKERS': 2,
+    'MAX_QUEUE': 16,
+    'MAX_BYTES': 10 * 1024 * 1024,
+    'MAX_PIXELS': 40_000_000,
+}
+
+class InvalidImage(Exception):
+    pass
+
+class ProfilePicturesBusy(Exception):
+    pass
+
+class ProfilePicturePipeline:
+    """
+    Turns uploaded pictures into SIZE x SIZE JPEGs off the request thread.
+
+    `submit` only reads the image header: it answers with the URL the picture will
+    have once stored and leaves decoding, cropping and storing to a pool of WORKERS
+    threads (Pillow releases the GIL while it works). At most MAX_QUEUE more uploads
+    wait for a worker; beyond that ProfilePicturesBusy is raised. When a picture is
+    stored it becomes the user's profile picture, unless they uploaded a newer one
+    in the meantime, in which case it is deleted.
+    """
+    def __init__(self, storage, size, workers, max_queue, max_bytes, max_pixels):
+        self.storage = storage
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        # User id -> name of their newest upload still being processed.
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def check(self, data):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+        except (OSError, Image.DecompressionBombError):
+            raise InvalidImage("The file is not a supported image")
+        if width * height > self.max_pixels:
+            raise InvalidImage("The image is too large")
+
+    def render(self, data):
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEGs are decoded straight at the smallest scale that still covers the
+            # crop, which is most of the work saved for camera photos.
+            image.draft('RGB', (self.size, self.size))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            image = ImageOps.fit(image, (self.size, self.size), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85, optimize=True)
+        return output.getvalue()
+
+    def submit(self, user_id, data, base_url=''):
+        """
+        Queues `data` as the new picture of `user_id`. Returns the URL it will have and
+        the future of the work; relative storage URLs are resolved against `base_url`.
+        """
+        if len(data) > self.max_bytes:
+            raise InvalidImage("The image is too large")
+        self.check(data)
+        name = f'profile_pics/{user_id}_{uuid.uuid4().hex}.jpg'
+        url = urljoin(base_url, self.storage.url(name))
+        if not self.slots.acquire(blocking=False):
+            raise ProfilePicturesBusy()
+        with self.lock:
+            self.latest[user_id] = name
+        try:
+            future = self.executor.submit(self._run, user_id, name, data, base_url)
+        except BaseException:
+            self.slots.release()
+            raise
+        return url, future
+
+    def _run(self, user_id, name, data, base_url):
+        from users_app.models import User
+        try:
+            url = urljoin(base_url, self.storage.save(name, self.render(data)))
+            with self.lock:
+                current = self.latest.get(user_id) == name
+            user = User.objects.filter(id=user_id).first() if current else None
+            if user is None:
+                self.storage.delete(name)
+                return None
+            User.objects.update_profile_picture(user, url)
+            return url
+        except Exception:
+            logger.exception("Error processing profile picture", extra={'user_id': user_id})
+            raise
+        finally:
+            with self.lock:
+                if self.latest.get(user_id) == name:
+                    del self.latest[user_id]
+            close_old_connections()
+            self.slots.release()
+
+def build_profile_pictures():
+    config = dict(DEFAULT_PROFILE_PICTURES, **getattr(settings, 'PROFILE_PICTURES', {}))
+    return ProfilePicturePipeline(build_image_storage(), config['SIZE'], config['WORKERS'], config['MAX_QUEUE'], config['MAX_BYTES'], config['MAX_PIXELS'])
+
+profile_pictures = build_profile_pictures()
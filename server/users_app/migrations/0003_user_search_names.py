@@ -0,0 +1,54 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:40
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+def normalize_name(text):
+    # A copy of users_app.models.normalize_name as of this migration.
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+def fill_search_names(apps, schema_editor):
+    User = apps.get_model('users_app', 'User')
+    batch = []
+    for user in User.objects.only('first_name', 'last_name').iterator(chunk_size=1000):
+        user.search_name = normalize_name(f"{user.first_name} {user.last_name}")[:255]
+        user.search_name_reversed = normalize_name(f"{user.last_name} {user.first_name}")[:255]
+        batch.append(user)
+        if len(batch) == 1000:
+            User.objects.bulk_update(batch, ['search_name', 'search_name_reversed'])
+            batch = []
+    User.objects.bulk_update(batch, ['search_name', 'search_name_reversed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0002_alter_user_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_name',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='search_name_reversed',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_search_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['search_name', 'id'], name='user_search_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['search_name_reversed', 'id'], name='user_search_reversed_idx'),
+        ),
+    ]
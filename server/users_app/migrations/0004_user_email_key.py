@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+def normalize_email(email):
+    # A copy of users_app.models.normalize_email as of this migration.
+    return email.strip().lower()
+
+
+def fill_email_keys(apps, schema_editor):
+    User = apps.get_model('users_app', 'User')
+    taken = set()
+    batch = []
+    for user in User.objects.only('email').order_by('id').iterator(chunk_size=1000):
+        key = normalize_email(user.email)
+        if key in taken:
+            # Registration used to compare emails case-sensitively, so "Bob@x.com" and
+            # "bob@x.com" can both exist. The oldest account keeps the address; the
+            # others get a key no login can produce and have to be merged by hand.
+            key = f'{key}#{user.id}'
+        taken.add(key)
+        user.email_key = key
+        batch.append(user)
+        if len(batch) == 1000:
+            User.objects.bulk_update(batch, ['email_key'])
+            batch = []
+    User.objects.bulk_update(batch, ['email_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0003_user_search_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_email_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='email_key',
+            field=models.CharField(editable=False, max_length=255, unique=True),
+        ),
+    ]
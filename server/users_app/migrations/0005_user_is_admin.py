@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0004_user_email_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='is_admin',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,13 +1,28 @@
 from django.db import models
-import bcrypt
 import re
+import unicodedata
 from datetime import datetime
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Q, Value
-from django.db.models.functions import Concat
+from social_app.pagination import STREAM_CHUNK_SIZE, keyset_page, keyset_rows
+from users_app.cache import auth_cache
+from users_app.passwords import PasswordHasherBusy, password_hasher
 
 EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9.+_-]+@[a-zA-Z0-9._-]+\.[a-zA-Z]+$')
+CONTACTS_PAGE_SIZE = 50
+MAX_CONTACTS_PAGE_SIZE = 200
+
+def normalize_name(text):
+    """
+    Search key for a name: accents stripped, case folded and whitespace collapsed,
+    so "  Zoë  O'Brien" and "zoe o'brien" compare equal.
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+def normalize_email(email):
+    # The key accounts are looked up by; "  Alice@Example.com" and "alice@example.com" are one account.
+    return email.strip().lower()
 
 class UserManager(models.Manager):
     def registration_validator(self, data):
@@ -24,7 +39,7 @@ class UserManager(models.Manager):
         if not EMAIL_REGEX.match(data['email']):
             errors["email"] = "The email address you've entered is invalid."
             return errors
-        existing_email = User.objects.filter(email=data['email']).exclude(id=data.get('id'))
+        existing_email = User.objects.filter(email_key=normalize_email(data['email'])).exclude(id=data.get('id'))
         if existing_email.exists():
             errors["email"] = "This email address was already used before. Please login or use a different email address."
             return errors
@@ -54,19 +69,35 @@ class UserManager(models.Manager):
         if len(data['password']) < 1:
             errors["password"] = "Please provide a password."
             return errors
-        elif not EMAIL_REGEX.match(data['email']):
+        elif not EMAIL_REGEX.match(data['email'].strip()):
             errors["email"] = "The email address you've entered is invalid."
             return errors
-        else:
-            user = User.objects.filter(email=data['email']).first()
-            if not user:
-                errors["email"] = "No user account with this email address was found."
-                return errors
-            else:
-                if not bcrypt.checkpw(data['password'].encode(), user.password.encode()):
-                    errors["password"] = "Incorrect password."
-                    return errors
         return errors
+    async def check_login(self, email, password):
+        """
+        Returns the user and an errors dict for a login attempt that passed
+        login_validator. The user is found with one lookup on the unique email key and
+        the password is checked on the hashing pool. A password stored with another
+        bcrypt cost than the configured one is hashed again on the way.
+        """
+        user = await self.filter(email_key=normalize_email(email)).afirst()
+        if user is None:
+            return None, {"email": "No user account with this email address was found."}
+        if not await password_hasher.check(password, user.password):
+            return None, {"password": "Incorrect password."}
+        if password_hasher.needs_rehash(user.password):
+            await self.rehash_password(user, password)
+        return user, {}
+    async def rehash_password(self, user, password):
+        try:
+            hashed = await password_hasher.hash(password)
+        except PasswordHasherBusy:
+            # The login still succeeds; a later one upgrades the hash.
+            return
+        # Conditional, so a password changed in the meantime is not overwritten.
+        if await self.filter(id=user.id, password=user.password).aupdate(password=hashed):
+            user.password = hashed
+            auth_cache.invalidate_user(user.id)
     def update_data_validator(self, data):
         errors = {}
         if len(data['firstName']) < 2:
@@ -92,13 +123,26 @@ class UserManager(models.Manager):
         if len(data['newPassword']) < 8:
             errors["newPassword"] = "New password should be at least 8 characters."
             return errors
-        if not bcrypt.checkpw(data['currentPassword'].encode(), user.password.encode()):
+        if not password_hasher.check_sync(data['currentPassword'], user.password):
+            errors["currentPassword"] = "Current password is incorrect."
+            return errors
+        return errors
+    async def achange_password_validator(self, user, data):
+        errors = {}
+        if len(data['newPassword']) < 8:
+            errors["newPassword"] = "New password should be at least 8 characters."
+            return errors
+        if not await password_hasher.check(data['currentPassword'], user.password):
             errors["currentPassword"] = "Current password is incorrect."
             return errors
         return errors
     def create_user(self, data):
-        hashed_password = bcrypt.hashpw(data['password'].encode(), bcrypt.gensalt()).decode()
-        user = User.objects.create(first_name=data['firstName'], last_name=data['lastName'], email=data['email'], password=hashed_password, date_of_birth=data['dateOfBirth'], gender=data['gender'])
+        hashed_password = password_hasher.hash_sync(data['password'])
+        user = User.objects.create(first_name=data['firstName'], last_name=data['lastName'], email=data['email'].strip(), password=hashed_password, date_of_birth=data['dateOfBirth'], gender=data['gender'])
+        return user
+    async def acreate_user(self, data):
+        hashed_password = await password_hasher.hash(data['password'])
+        user = await User.objects.acreate(first_name=data['firstName'], last_name=data['lastName'], email=data['email'].strip(), password=hashed_password, date_of_birth=data['dateOfBirth'], gender=data['gender'])
         return user
     def get_user(self, id):
         return User.objects.get(id=id)
@@ -106,50 +150,110 @@ class UserManager(models.Manager):
         return User.objects.all()
     def get_full_name(self, user):
         return f"{user.first_name} {user.last_name}"
-    def search(self, search):
-        return self.annotate(
-            full_name=Concat('first_name', Value(' '), 'last_name')
-        ).filter(
-            Q(first_name__icontains=search) |
-            Q(last_name__icontains=search) |
-            Q(full_name__icontains=search)
-        )
+    def get_contacts_page(self, before=None, after=None, limit=CONTACTS_PAGE_SIZE):
+        """
+        Returns one alphabetical page of users and whether more follow, walked with
+        (search_name, id) cursors over the user_search_name_idx index.
+        """
+        return keyset_page(self.all(), ('search_name', 'id'), min(limit, MAX_CONTACTS_PAGE_SIZE), before=before, after=after, descending=False)
+    def iter_contacts(self, fields, after=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterates every user alphabetically as .values() rows, starting past the `after`
+        cursor, `chunk_size` rows per fetch.
+        """
+        return keyset_rows(self.values(*fields), ('search_name', 'id'), after, descending=False).iterator(chunk_size=chunk_size)
+    def search(self, search, limit=CONTACTS_PAGE_SIZE):
+        """
+        Returns up to `limit` users whose full name starts with `search`, followed by
+        those matching it as "last first", ignoring case and accents. Each half is a
+        range scan on one of the normalized-name indexes.
+        """
+        prefix = normalize_name(search)
+        if not prefix:
+            return []
+        # Every key starting with `prefix` sorts in [prefix, prefix + U+10FFFF).
+        upper = prefix + '\U0010ffff'
+        by_first_name = list(self.filter(search_name__gte=prefix, search_name__lt=upper).order_by('search_name', 'id')[:limit])
+        if len(by_first_name) == limit:
+            return by_first_name
+        seen = {user.id for user in by_first_name}
+        by_last_name = self.filter(search_name_reversed__gte=prefix, search_name_reversed__lt=upper).order_by('search_name_reversed', 'id')[:limit]
+        return (by_first_name + [user for user in by_last_name if user.id not in seen])[:limit]
     def update_user_activity(self, user):
-        user.last_activity = timezone.now()
-        user.save()
+        # Recorded in memory and written with the next batched presence flush.
+        from social_app.presence import presence_tracker
+        presence_tracker.heartbeat(user.id)
     def is_user_online(self, user):
-        now = timezone.now()
-        if user.last_activity > now - timedelta(minutes=5):
-            return True
-        return False
+        return user.is_online()
+    def online_user_ids(self, user_ids):
+        from social_app.presence import presence_tracker
+        return presence_tracker.online_users(user_ids)
     def update_user_data(self, user, data):
         user.first_name = data['firstName']
         user.last_name = data['lastName']
         user.date_of_birth =  datetime.fromisoformat(data['dateOfBirth'].rstrip("Z")).date()
         user.gender = data['gender']
         user.save()
+        auth_cache.invalidate_user(user.id)
+        from social_app.models import ChatMembership
+        ChatMembership.objects.refresh_contact(user)
+        return user
     def get_user_from_email(self, email):
-        return User.objects.get(email=email)
+        return User.objects.get(email_key=normalize_email(email))
     def update_user_password(self, user, new_password):
-        new_hashed_password = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
+        new_hashed_password = password_hasher.hash_sync(new_password)
+        # Only the password column: `user` may be an older copy from the auth cache.
+        User.objects.filter(pk=user.pk).update(password=new_hashed_password, updated_at=timezone.now())
         user.password = new_hashed_password
-        user.save()
+        auth_cache.invalidate_user(user.id)
+    async def aupdate_user_password(self, user, new_password):
+        new_hashed_password = await password_hasher.hash(new_password)
+        await User.objects.filter(pk=user.pk).aupdate(password=new_hashed_password, updated_at=timezone.now())
+        user.password = new_hashed_password
+        auth_cache.invalidate_user(user.id)
     def update_profile_picture(self, user, pic):
         user.profile_picture = pic
         user.save()
+        auth_cache.invalidate_user(user.id)
+        from social_app.models import ChatMembership
+        ChatMembership.objects.refresh_contact(user)
     
 class User(models.Model):
     first_name = models.CharField(max_length=45)
     last_name = models.CharField(max_length=45)
     profile_picture = models.CharField(default='profile_pics/default.jpg', max_length=255)
     email = models.CharField(max_length=255)
+    # normalize_email(email), kept in sync by save(); logins look accounts up by it.
+    email_key = models.CharField(max_length=255, unique=True, editable=False)
     password = models.CharField(max_length=255)
     date_of_birth = models.DateField()
     gender = models.CharField(max_length=45)
     last_activity = models.DateTimeField(default=datetime.now)
+    # Admins can read the request profiles (server.profiling).
+    is_admin = models.BooleanField(default=False)
+    # Normalized "first last" and "last first", kept in sync by save() for prefix search.
+    search_name = models.CharField(max_length=255, default='', editable=False)
+    search_name_reversed = models.CharField(max_length=255, default='', editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = UserManager()
+    class Meta:
+        indexes = [
+            models.Index(fields=['search_name', 'id'], name='user_search_name_idx'),
+            models.Index(fields=['search_name_reversed', 'id'], name='user_search_reversed_idx'),
+        ]
+    def save(self, *args, **kwargs):
+        self.set_search_names()
+        self.email_key = normalize_email(self.email)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'first_name', 'last_name'} & set(update_fields):
+            update_fields = kwargs['update_fields'] = {*update_fields, 'search_name', 'search_name_reversed'}
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'email_key'}
+        super().save(*args, **kwargs)
+    def set_search_names(self):
+        self.search_name = normalize_name(f"{self.first_name} {self.last_name}")[:255]
+        self.search_name_reversed = normalize_name(f"{self.last_name} {self.first_name}")[:255]
     def friends(self):
         from social_app.models import Friendship
         friendships = Friendship.objects.filter(models.Q(friend_1=self) | models.Q(friend_2=self))
@@ -158,7 +262,4 @@ class User(models.Model):
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
     def is_online(self):
-        now = timezone.now()
-        if self.last_activity > now - timedelta(minutes=5):
-            return True
-        return False
\ No newline at end of file
+        return self.id in User.objects.online_user_ids([self.id])
\ No newline at end of file
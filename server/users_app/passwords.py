@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from django.conf import settings
+
+DEFAULT_PASSWORD_HASHING = {
+    'ROUNDS': 12,
+    'WORKERS': 4,
+    'MAX_QUEUE': 32,
+}
+
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """
+    bcrypt on a small thread pool of its own.
+
+    bcrypt releases the GIL, so up to WORKERS hashes run in parallel while the
+    event loop and the request threads stay free. At most MAX_QUEUE more wait
+    for a worker; past that, new work is refused with PasswordHasherBusy. A
+    burst of logins is then answered with 503s rather than leaving every request
+    to queue behind it. Hashes are made with ROUNDS, and `needs_rehash` tells
+    which stored hashes were made with another cost.
+    """
+    def __init__(self, rounds, workers, max_queue):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            return self.executor.submit(self._run, fn, args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _run(self, fn, args):
+        # The slot is free again before the caller sees the result.
+        try:
+            return fn(*args)
+        finally:
+            self.slots.release()
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+
+    def _check(self, password, hashed):
+        try:
+            return bcrypt.checkpw(password.encode(), hashed.encode())
+        except ValueError:
+            # Not a bcrypt hash (or a password bcrypt refuses): nothing can match it.
+            return False
+
+    async def hash(self, password):
+        return await asyncio.wrap_future(self.submit(self._hash, password))
+
+    async def check(self, password, hashed):
+        return await asyncio.wrap_future(self.submit(self._check, password, hashed))
+
+    # For sync callers (scripts, the shell); they block on the same bounded pool.
+    def hash_sync(self, password):
+        return self.submit(self._hash, password).result()
+
+    def check_sync(self, password, hashed):
+        return self.submit(self._check, password, hashed).result()
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes read "$2b$<cost>$<salt and hash>".
+        parts = hashed.split('$')
+        return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.rounds
+
+def build_password_hasher():
+    config = dict(DEFAULT_PASSWORD_HASHING, **getattr(settings, 'PASSWORD_HASHING', {}))
+    return PasswordHasher(config['ROUNDS'], config['WORKERS'], config['MAX_QUEUE'])
+
+password_hasher = build_password_hasher()
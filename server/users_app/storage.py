@@ -0,0 +1,81 @@
+import io
+import os
+import tempfile
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_IMAGE_STORAGE = {
+    'BACKEND': 'local',
+    'BASE_URL': '',
+    'CLOUDINARY': {},
+}
+
+class LocalImageStorage:
+    """
+    Images as files under MEDIA_ROOT, served from MEDIA_URL. `base_url` is prefixed
+    to the URLs when they must be absolute and the app cannot build them from a
+    request. A file is written under a temporary name and renamed, so its URL
+    never serves half an image.
+    """
+    def __init__(self, root, url, base_url=''):
+        self.root = root
+        self.base_url = base_url.rstrip('/') + url
+
+    def url(self, name):
+        return self.base_url + name
+
+    def save(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(partial, path)
+        except BaseException:
+            os.unlink(partial)
+            raise
+        return self.url(name)
+
+    def delete(self, name):
+        try:
+            os.unlink(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+class CloudinaryImageStorage:
+    """
+    Images uploaded to Cloudinary, each under its name without the extension as
+    the public id. `config` holds cloud_name, api_key and api_secret.
+
+    URLs carry no version, so `url` knows an image's address before it is uploaded
+    and `save` returns that same address. Callers use a new name for each image;
+    one saved again under an old name has its CDN copies invalidated.
+    """
+    def __init__(self, **config):
+        import cloudinary
+        cloudinary.config(secure=True, **config)
+
+    def public_id(self, name):
+        return os.path.splitext(name)[0]
+
+    def url(self, name):
+        from cloudinary.utils import cloudinary_url
+        return cloudinary_url(self.public_id(name), format='jpg', secure=True)[0]
+
+    def save(self, name, data):
+        import cloudinary.uploader
+        cloudinary.uploader.upload(io.BytesIO(data), public_id=self.public_id(name), overwrite=True, invalidate=True)
+        return self.url(name)
+
+    def delete(self, name):
+        import cloudinary.uploader
+        cloudinary.uploader.destroy(self.public_id(name))
+
+def build_image_storage():
+    config = dict(DEFAULT_IMAGE_STORAGE, **getattr(settings, 'IMAGE_STORAGE', {}))
+    if config['BACKEND'] == 'local':
+        return LocalImageStorage(settings.MEDIA_ROOT, settings.MEDIA_URL, config['BASE_URL'])
+    if config['BACKEND'] == 'cloudinary':
+        return CloudinaryImageStorage(**config['CLOUDINARY'])
+    return import_string(config['BACKEND'])()
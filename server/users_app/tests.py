@@ -1,3 +1,222 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+import bcrypt
+import jwt
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from users_app.authentication import authenticate
+from PIL import Image
+from users_app.cache import AuthCache, DjangoCacheBackend, LocalBackend, auth_cache, build_auth_cache
+from users_app.images import ProfilePicturePipeline
+from users_app.models import User
+from users_app.passwords import PasswordHasher, PasswordHasherBusy, password_hasher
+from users_app.storage import CloudinaryImageStorage, LocalImageStorage
 
-# Create your tests here.
+def make_user(first_name, email=None):
+    return User.objects.create(first_name=first_name, last_name='Tester', email=email or f'{first_name.lower()}@example.com', password='x', date_of_birth=datetime.date(1990, 1, 1), gender='other', last_activity=timezone.now())
+
+def make_token(user, **claims):
+    return jwt.encode({'user_id': user.id, **claims}, settings.SECRET_KEY, algorithm='HS256')
+
+@authenticate
+def whoami(request):
+    return JsonResponse({'id': request.user.id, 'name': request.user.full_name()})
+
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        auth_cache.clear()
+        self.factory = RequestFactory()
+        self.user = make_user('Alice')
+
+    def call(self, token):
+        return whoami(self.factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+
+    def test_repeated_requests_skip_the_user_query(self):
+        token = make_token(self.user)
+        with self.assertNumQueries(1):
+            self.call(token)
+        before = auth_cache.stats()
+        with self.assertNumQueries(0):
+            response = self.call(token)
+        after = auth_cache.stats()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(after['token_hits'] - before['token_hits'], 1)
+        self.assertEqual(after['user_hits'] - before['user_hits'], 1)
+
+    def test_user_updates_invalidate_the_cached_row(self):
+        token = make_token(self.user)
+        self.call(token)
+        User.objects.update_user_data(self.user, {'firstName': 'Alicia', 'lastName': 'Tester', 'dateOfBirth': '1990-01-01', 'gender': 'other'})
+        self.assertEqual(json.loads(self.call(token).content)['name'], 'Alicia Tester')
+        User.objects.update_profile_picture(self.user, 'https://example.com/pic.jpg')
+        self.assertIsNone(auth_cache.get_user(self.user.id))
+
+    def test_invalid_and_expired_tokens_are_not_cached(self):
+        expired = make_token(self.user, exp=int(time.time()) - 10)
+        self.assertEqual(self.call(expired).status_code, 401)
+        self.assertEqual(self.call('not-a-token').status_code, 401)
+        self.assertIsNone(auth_cache.get_token(expired))
+
+    def test_local_backend_evicts_least_recently_used(self):
+        cache = AuthCache(LocalBackend(max_entries=2), token_ttl=60, user_ttl=60)
+        users = [make_user(f'User{i}') for i in range(3)]
+        cache.set_user(users[0])
+        cache.set_user(users[1])
+        cache.get_user(users[0].id)
+        cache.set_user(users[2])
+        self.assertIsNotNone(cache.get_user(users[0].id))
+        self.assertIsNone(cache.get_user(users[1].id))
+
+    @override_settings(AUTH_CACHE={'BACKEND': 'django'}, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_django_cache_backend(self):
+        cache = build_auth_cache()
+        cache.set_user(self.user)
+        self.assertEqual(cache.get_user(self.user.id).email, self.user.email)
+        cache.invalidate_user(self.user.id)
+        self.assertIsNone(cache.get_user(self.user.id))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_django_cache_backend_clears_only_its_own_entries(self):
+        caches['default'].set('unrelated', 'kept')
+        backend, other_worker = DjangoCacheBackend('default'), DjangoCacheBackend('default', generation_refresh=0)
+        backend.set('user:1', 'alice', 60)
+        self.assertEqual(other_worker.get('user:1'), 'alice')
+        backend.clear()
+        self.assertIsNone(backend.get('user:1'))
+        self.assertIsNone(other_worker.get('user:1'))
+        self.assertEqual(caches['default'].get('unrelated'), 'kept')
+
+def low_cost_hash(password, rounds=4):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+@mock.patch.object(password_hasher, 'rounds', 4)
+class PasswordTests(TestCase):
+    def setUp(self):
+        auth_cache.clear()
+        self.user = make_user('Alice')
+        User.objects.filter(id=self.user.id).update(password=low_cost_hash('correct horse'))
+
+    def post(self, path, data, **extra):
+        return self.client.post(f'/securetalk/api/users/{path}', json.dumps(data), content_type='application/json', **extra)
+
+    def test_login_is_one_lookup_on_the_normalized_email(self):
+        with self.assertNumQueries(1):
+            response = self.post('login', {'email': '  ALICE@Example.com ', 'password': 'correct horse'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(jwt.decode(response.json()['token'], settings.SECRET_KEY, algorithms=['HS256'])['user_id'], self.user.id)
+        self.assertEqual(self.post('login', {'email': 'alice@example.com', 'password': 'wrong'}).json()['errors'], {'password': 'Incorrect password.'})
+        self.assertIn('email', self.post('login', {'email': 'nobody@example.com', 'password': 'x'}).json()['errors'])
+
+    def test_emails_differing_only_in_case_are_one_account(self):
+        response = self.post('register', {'firstName': 'Alicia', 'lastName': 'Tester', 'email': 'Alice@EXAMPLE.com', 'password': 'another secret', 'dateOfBirth': '1990-01-01', 'gender': 'other'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.json()['errors'])
+
+    def test_hash_is_upgraded_when_the_cost_changes(self):
+        with mock.patch.object(password_hasher, 'rounds', 5):
+            self.assertEqual(self.post('login', {'email': 'alice@example.com', 'password': 'correct horse'}).status_code, 200)
+        stored = User.objects.get(id=self.user.id).password
+        self.assertTrue(stored.startswith('$2b$05$'))
+        self.assertTrue(bcrypt.checkpw(b'correct horse', stored.encode()))
+        self.assertEqual(self.post('login', {'email': 'alice@example.com', 'password': 'correct horse'}).status_code, 200)
+
+    def test_change_password(self):
+        header = {'HTTP_AUTHORIZATION': f'Bearer {make_token(self.user)}'}
+        wrong = self.post('change_password', {'currentPassword': 'nope', 'newPassword': 'battery staple'}, **header)
+        self.assertEqual(wrong.json()['errors'], {'currentPassword': 'Current password is incorrect.'})
+        self.assertEqual(self.post('change_password', {'currentPassword': 'correct horse', 'newPassword': 'battery staple'}, **header).status_code, 200)
+        self.assertEqual(self.post('login', {'email': 'alice@example.com', 'password': 'battery staple'}).status_code, 200)
+        self.assertEqual(self.post('change_password', {'currentPassword': 'x', 'newPassword': 'y' * 8}).status_code, 401)
+
+    def test_a_password_change_writes_only_the_password(self):
+        stale = User.objects.get(id=self.user.id)
+        User.objects.filter(id=self.user.id).update(first_name='Alicia', profile_picture='profile_pics/new.jpg')
+        async_to_sync(User.objects.aupdate_user_password)(stale, 'battery staple')
+        User.objects.update_user_password(stale, 'correct horse battery')
+        user = User.objects.get(id=self.user.id)
+        self.assertEqual((user.first_name, user.profile_picture), ('Alicia', 'profile_pics/new.jpg'))
+        self.assertEqual(User.objects.change_password_validator(user, {'currentPassword': 'correct horse battery', 'newPassword': 'y' * 8}), {})
+
+    def test_a_full_pool_refuses_work(self):
+        hasher = PasswordHasher(rounds=4, workers=1, max_queue=1)
+        release = threading.Event()
+        blocked = [hasher.submit(release.wait), hasher.submit(release.wait)]
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.submit(release.wait)
+        with mock.patch('users_app.models.password_hasher', hasher):
+            response = self.post('login', {'email': 'alice@example.com', 'password': 'correct horse'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        release.set()
+        for future in blocked:
+            future.result()
+        self.assertTrue(hasher.submit(bcrypt.checkpw, b'correct horse', User.objects.get(id=self.user.id).password.encode()).result())
+
+def image_file(width, height, name='photo.png'):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'teal').save(output, 'PNG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+class ProfilePictureTests(TransactionTestCase):
+    def setUp(self):
+        auth_cache.clear()
+        self.user = make_user('Alice')
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.pipeline = ProfilePicturePipeline(LocalImageStorage(self.media.name, '/media/'), size=500, workers=1, max_queue=4, max_bytes=1024 * 1024, max_pixels=10_000_000)
+        patcher = mock.patch('users_app.views.profile_pictures', self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, file):
+        return self.client.post('/securetalk/api/users/upload_profile_pic', {'file': file}, HTTP_AUTHORIZATION=f'Bearer {make_token(self.user)}')
+
+    def stored_files(self):
+        return os.listdir(os.path.join(self.media.name, 'profile_pics'))
+
+    def test_upload_returns_the_pending_url_and_is_cropped_in_the_background(self):
+        response = self.upload(image_file(1200, 800))
+        self.assertEqual(response.status_code, 202)
+        url = response.json()['imageUrl']
+        self.assertRegex(url, rf'^http://testserver/media/profile_pics/{self.user.id}_\w+\.jpg$')
+        self.pipeline.executor.shutdown(wait=True)
+        self.assertEqual(User.objects.get(id=self.user.id).profile_picture, url)
+        with Image.open(os.path.join(self.media.name, 'profile_pics', url.rsplit('/', 1)[1])) as stored:
+            self.assertEqual((stored.format, stored.size), ('JPEG', (500, 500)))
+
+    def test_the_newest_upload_wins(self):
+        first, _ = self.pipeline.submit(self.user.id, image_file(600, 600).read())
+        second, _ = self.pipeline.submit(self.user.id, image_file(700, 700).read())
+        self.pipeline.executor.shutdown(wait=True)
+        self.assertEqual(User.objects.get(id=self.user.id).profile_picture, second)
+        self.assertEqual(self.stored_files(), [second.rsplit('/', 1)[1]])
+
+    def test_cloudinary_urls_are_known_before_the_upload(self):
+        pipeline = ProfilePicturePipeline(CloudinaryImageStorage(cloud_name='securetalk', api_key='key', api_secret='secret'), size=500, workers=1, max_queue=4, max_bytes=1024 * 1024, max_pixels=10_000_000)
+        with mock.patch('cloudinary.uploader.upload', return_value={'secure_url': 'https://res.cloudinary.com/securetalk/image/upload/v1700000000/x.jpg'}) as upload:
+            pending, future = pipeline.submit(self.user.id, image_file(600, 600).read())
+            self.assertEqual(future.result(), pending)
+        self.assertRegex(pending, rf'^https://res\.cloudinary\.com/securetalk/image/upload/v1/profile_pics/{self.user.id}_\w+\.jpg$')
+        self.assertEqual(User.objects.get(id=self.user.id).profile_picture, pending)
+        self.assertTrue(upload.call_args.kwargs['invalidate'])
+
+    def test_storage_failures_are_logged_and_answered_with_an_error(self):
+        with mock.patch.object(self.pipeline.storage, 'url', side_effect=OSError('storage unavailable')), self.assertLogs('users_app.views', 'ERROR'):
+            response = self.upload(image_file(600, 600))
+        self.assertEqual((response.status_code, response.json()), (500, {'message': 'storage unavailable'}))
+
+    def test_files_that_are_not_images_are_refused(self):
+        self.assertEqual(self.upload(SimpleUploadedFile('notes.png', b'not an image')).status_code, 400)
+        self.assertEqual(self.upload(image_file(5000, 5000)).status_code, 400)
+        self.assertEqual(User.objects.get(id=self.user.id).profile_picture, 'profile_pics/default.jpg')
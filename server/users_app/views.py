@@ -1,34 +1,44 @@
 from users_app.models import User
+from users_app.passwords import PasswordHasherBusy
+from django.db import IntegrityError
 from django.http import JsonResponse
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 import jwt
 import datetime
 import pytz
 import json
+import logging
 from users_app.serializers import UserSerializer
 from users_app.authentication import authenticate
-import cloudinary
-import cloudinary.uploader
-from cloudinary.utils import cloudinary_url
+from users_app.images import InvalidImage, ProfilePicturesBusy, profile_pictures
+
+logger = logging.getLogger(__name__)
 
 SECRET_KEY = settings.SECRET_KEY
 palestine_tz = pytz.timezone('Asia/Hebron')
 
-cloudinary.config( 
-    cloud_name = "dowuigpg4", 
-    api_key = "994269655154433", 
-    api_secret = "b_QAsrw0KqwWwKM0_qAJFBxbEwU",
-    secure=True
-)
+def busy_response():
+    # A worker pool (password hashing, picture processing) is full; the client should retry shortly.
+    response = JsonResponse({"message": "Server is busy, please try again in a moment."}, status=503)
+    response['Retry-After'] = '1'
+    return response
 
 @csrf_exempt
-def register(request):
+async def register(request):
     data = json.loads(request.body)
-    errors = User.objects.registration_validator(data)
+    errors = await sync_to_async(User.objects.registration_validator)(data)
     if errors:
         return JsonResponse({"message": "Validation errors", "errors": errors}, status=400)
-    user = User.objects.create_user(data)
+    try:
+        user = await User.objects.acreate_user(data)
+    except PasswordHasherBusy:
+        return busy_response()
+    except IntegrityError:
+        # Another registration took the same email after validation.
+        errors = {"email": "This email address was already used before. Please login or use a different email address."}
+        return JsonResponse({"message": "Validation errors", "errors": errors}, status=400)
 
     # Create JWT token with user ID
     payload = {
@@ -41,12 +51,16 @@ def register(request):
     return JsonResponse({"message": "User registered successfully", "token": token}, status=200)
 
 @csrf_exempt
-def login(request):
+async def login(request):
     data = json.loads(request.body)
     errors = User.objects.login_validator(data)
+    if not errors:
+        try:
+            user, errors = await User.objects.check_login(data["email"], data["password"])
+        except PasswordHasherBusy:
+            return busy_response()
     if errors:
         return JsonResponse({"message": "Validation errors", "errors": errors}, status=400)
-    user = User.objects.get_user_from_email(data["email"])
     payload = {
         'user_id': user.id,
         'exp': datetime.datetime.now(palestine_tz) + datetime.timedelta(days=14),  # Set expiration to 14 days
@@ -69,7 +83,7 @@ def get_user_details(request):
         serializer = UserSerializer(user)
         return JsonResponse(serializer.data, status=200)
     except Exception as e:
-        print(e)
+        logger.exception("Error in get_user_details")
         return JsonResponse({"message": str(e)}, status=500)
 
 @csrf_exempt
@@ -85,41 +99,44 @@ def update_profile(request):
         serializer = UserSerializer(user)
         return JsonResponse(serializer.data, status=200)
     except Exception as e:
-        print(e)
+        logger.exception("Error in update_profile")
         return JsonResponse({"message": str(e)}, status=500)
 
 @csrf_exempt
 @authenticate
 def upload_profile_pic(request):
+    # Answered at once with the URL the picture will have; it becomes the profile
+    # picture when processing finishes (see users_app.images).
     try:
-        user = request.user
         if 'file' not in request.FILES:
             return JsonResponse({"message": "No file provided"}, status=400)
-        
         file = request.FILES['file']
-        
-        upload_result = cloudinary.uploader.upload(file)
-        file_url = upload_result.get("secure_url")
-        
-        auto_crop_url, _ = cloudinary_url(file_url, width=500, height=500, crop="fill", gravity="auto")
-        
-        User.objects.update_profile_picture(user, auto_crop_url)
-        return JsonResponse({"imageUrl": auto_crop_url}, status=200)
+        if file.size > profile_pictures.max_bytes:
+            return JsonResponse({"message": "The image is too large"}, status=400)
+        # Resolved here: the request is gone by the time the background work stores the picture.
+        url, _ = profile_pictures.submit(request.user.id, file.read(), request.build_absolute_uri('/'))
+        return JsonResponse({"imageUrl": url, "status": "pending"}, status=202)
+    except InvalidImage as e:
+        return JsonResponse({"message": str(e)}, status=400)
+    except ProfilePicturesBusy:
+        return busy_response()
     except Exception as e:
-        print(e)
+        logger.exception("Error in upload_profile_pic")
         return JsonResponse({"message": str(e)}, status=500)
 
 @csrf_exempt
 @authenticate
-def change_password(request):
+async def change_password(request):
     try:
         data = json.loads(request.body)
         user = request.user
-        errors = User.objects.change_password_validator(user, data)
+        errors = await User.objects.achange_password_validator(user, data)
         if errors:
             return JsonResponse({"message": "Validation errors", "errors": errors}, status=400)
-        User.objects.update_user_password(user, data["newPassword"])
+        await User.objects.aupdate_user_password(user, data["newPassword"])
         return JsonResponse({"message": "Password updated successfully"}, status=200)
+    except PasswordHasherBusy:
+        return busy_response()
     except Exception as e:
-        print(e)
+        logger.exception("Error in change_password")
         return JsonResponse({"message": str(e)}, status=500)
\ No newline at end of file